@@ -0,0 +1,558 @@
+# coding=utf8
+""" Campaigns Benchmark
+
+Seeds the local DB with synthetic projects, senders, contacts, and \
+campaigns, sends every campaign to a local SMTP sink using the daemon's own \
+functions, and reports the throughput and latency of each stage
+
+Run from the rest directory:
+
+	python -m benchmarks.campaigns [--contacts N] [--campaigns N] \
+		[--senders N] [--async] [--keep]
+
+Everything seeded is removed at the end unless --keep is passed. Meant for \
+a local or CI database only, never one used by a running daemon
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-17"
+
+# Ouroboros imports
+from config import config
+import jsonb
+import record_mysql
+from record_mysql.server import escape, execute
+
+# Pip imports
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+# Python imports
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from os import devnull
+from pathlib import Path
+from random import choice, randint
+import socket
+from string import ascii_lowercase
+from time import perf_counter
+from typing import Callable, Dict, List
+from uuid import uuid4
+
+# Record imports
+from records.admin import \
+	campaign, campaign_contact, campaign_sender, contact, project, sender
+
+# Daemon imports
+from daemons import campaigns
+
+# Shared imports
+from shared import scheduler, smtp, templates
+
+CONTENT = '<html><body><p>Hi {alias},</p>%s' \
+	'<p>Sent to {email_address} at {company}.</p>' \
+	'<p><a href="{unsubscribe_url}">Unsubscribe</a></p></body></html>' % (
+		'<p>%s</p>' % ('Lorem ipsum dolor sit amet. ' * 20) * 5
+	)
+"""The content of every campaign, roughly the size of a real one"""
+
+DEFINITIONS = Path(__file__).parent.parent.resolve() / 'definitions' / 'admin'
+"""The directory holding the record definitions"""
+
+class Sink(object):
+	"""Sink
+
+	An aiosmtpd handler that accepts and counts every message
+	"""
+
+	def __init__(self):
+		"""Constructor
+
+		Creates a new instance
+
+		Returns:
+			Sink
+		"""
+		self.count = 0
+
+	async def handle_DATA(self, server, session, envelope) -> str:
+		"""Handle DATA
+
+		Called by aiosmtpd with each message received
+
+		Returns:
+			str
+		"""
+		self.count += 1
+		return '250 Message accepted'
+
+class Timings(object):
+	"""Timings
+
+	Collects the duration of each call to the functions wrapped
+	"""
+
+	def __init__(self):
+		"""Constructor
+
+		Creates a new instance
+
+		Returns:
+			Timings
+		"""
+		self._stages: Dict[str, List[float]] = {}
+
+	def wrap(self, stage: str, func: Callable) -> Callable:
+		"""Wrap
+
+		Returns a version of func that records how long each call takes
+
+		Arguments:
+			stage (str): The name of the stage the call belongs to
+			func (callable): The function to time
+
+		Returns:
+			callable
+		"""
+		lTimes = self._stages.setdefault(stage, [])
+		def wrapped(*args, **kwargs):
+			fStart = perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				lTimes.append(perf_counter() - fStart)
+		return wrapped
+
+	def wrap_async(self, stage: str, func: Callable) -> Callable:
+		"""Wrap Async
+
+		The coroutine version of wrap()
+
+		Arguments:
+			stage (str): The name of the stage the call belongs to
+			func (callable): The coroutine function to time
+
+		Returns:
+			callable
+		"""
+		lTimes = self._stages.setdefault(stage, [])
+		async def wrapped(*args, **kwargs):
+			fStart = perf_counter()
+			try:
+				return await func(*args, **kwargs)
+			finally:
+				lTimes.append(perf_counter() - fStart)
+		return wrapped
+
+	def report(self) -> List[str]:
+		"""Report
+
+		Returns a line for each stage with the count of calls, and the mean, \
+		p50, and p99 in milliseconds
+
+		Returns:
+			str[]
+		"""
+		lLines = [ '%-8s %8s %10s %10s %10s' % (
+			'stage', 'calls', 'mean ms', 'p50 ms', 'p99 ms'
+		) ]
+		for sStage, lTimes in self._stages.items():
+			if not lTimes:
+				continue
+			lSorted = sorted(lTimes)
+			lLines.append('%-8s %8d %10.3f %10.3f %10.3f' % (
+				sStage,
+				len(lSorted),
+				sum(lSorted) / len(lSorted) * 1000,
+				percentile(lSorted, 50) * 1000,
+				percentile(lSorted, 99) * 1000
+			))
+		return lLines
+
+def percentile(values: List[float], p: int) -> float:
+	"""Percentile
+
+	Returns the nearest-rank percentile of already sorted values
+
+	Arguments:
+		values (float[]): The sorted values
+		p (uint): The percentile, 0 to 100
+
+	Returns:
+		float
+	"""
+	return values[max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))]
+
+def synthesise(name: str, values: dict) -> dict:
+	"""Synthesise
+
+	Generates a row for a record using its definition, any field not in \
+	values gets a random value of the right type and size, or one of its \
+	options if it has any. Fields the DB fills in itself, and optional \
+	timestamps, are left out
+
+	Arguments:
+		name (str): The name of the definition file, without the extension
+		values (dict): The fields to set instead of generating
+
+	Returns:
+		dict
+	"""
+
+	# Load the definition
+	dDefinition = jsonb.load('%s/%s.json' % (DEFINITIONS, name))
+
+	# Go through each field
+	dRow = {}
+	for sField, dNode in dDefinition.items():
+
+		# Skip anything that isn't a simple field, or is set by the DB
+		if sField.startswith('__') or \
+			sField in [ '_created', '_updated' ] or \
+			not isinstance(dNode.get('__type__'), str):
+			continue
+
+		# If we were given the value, use it
+		if sField in values:
+			dRow[sField] = values[sField]
+			continue
+
+		# If it has options, pick one
+		if '__options__' in dNode:
+			dRow[sField] = choice(dNode['__options__'])
+			continue
+
+		# Generate it by type
+		sType = dNode['__type__']
+		if sType == 'uuid':
+			dRow[sField] = str(uuid4())
+		elif sType == 'string':
+			dRow[sField] = ''.join(
+				choice(ascii_lowercase) for _ in range(randint(
+					dNode.get('__minimum__', 1),
+					min(dNode.get('__maximum__', 32), 32)
+				))
+			)
+		elif sType == 'uint':
+			dRow[sField] = randint(0, 1000)
+		elif sType == 'bool':
+			dRow[sField] = False
+		elif not dNode.get('__optional__'):
+			raise ValueError(sField, 'no generator for type %s' % sType)
+
+	# Return the row
+	return dRow
+
+def insert(storage: record_mysql.Storage, rows: List[dict], chunk: int = 1000):
+	"""Insert
+
+	Inserts synthetic rows with multi-row INSERT statements, skipping the \
+	revisions the records would normally add
+
+	Arguments:
+		storage (record_mysql.Storage): The storage the rows belong to
+		rows (dict[]): The rows to insert, all with the same fields
+		chunk (uint): The maximum rows per statement
+
+	Returns:
+		None
+	"""
+
+	# If there's nothing, do nothing
+	if not rows:
+		return
+
+	# Get the struct and the fields
+	dStruct = storage._parent._table._struct
+	lFields = list(rows[0].keys())
+
+	# Go through the rows a chunk at a time
+	for i in range(0, len(rows), chunk):
+		execute(
+			"INSERT INTO `%s`.`%s` (`%s`) VALUES\n%s" % (
+				dStruct.db,
+				dStruct.name,
+				'`, `'.join(lFields),
+				',\n'.join(
+					'(%s)' % ', '.join(
+						'NULL' if d[f] is None else
+						(str(int(d[f])) if isinstance(d[f], (bool, int)) else
+							"'%s'" % escape(d[f], host = dStruct.host))
+						for f in lFields
+					)
+					for d in rows[i:i + chunk]
+				)
+			),
+			dStruct.host
+		)
+
+def seed(args: argparse.Namespace, port: int) -> dict:
+	"""Seed
+
+	Adds a project with senders pointing at the sink, contacts, and \
+	campaigns that include every contact, are already due, and can send as \
+	fast as possible
+
+	Arguments:
+		args (argparse.Namespace): The command line arguments
+		port (uint): The port of the SMTP sink
+
+	Returns:
+		dict, the IDs of everything added
+	"""
+
+	# Add the project
+	dProject = synthesise('project', { 'short_code': 'BNCH' })
+	insert(project.Project, [ dProject ])
+
+	# Add the senders
+	lSenders = [
+		synthesise('sender', {
+			'_project': dProject['_id'],
+			'email_address': 'sender%d@benchmark.local' % i,
+			'host': '127.0.0.1',
+			'port': port,
+			'tls': False,
+			'rate': None,
+			'burst': None
+		}) for i in range(args.senders)
+	]
+	insert(sender.Sender, lSenders)
+
+	# Add the contacts
+	insert(contact.Contact, [
+		synthesise('contact', {
+			'_project': dProject['_id'],
+			'email_address': 'contact%d@benchmark.local' % i
+		}) for i in range(args.contacts)
+	])
+
+	# Add the campaigns, each one with every sender, and every contact, and
+	#	an audience that's already been built
+	lCampaigns = [
+		synthesise('campaign', {
+			'_project': dProject['_id'],
+			'_sender': lSenders[0]['_id'],
+			'next_trigger': '2000-01-01 00:00:00',
+			'min_interval': 0,
+			'max_interval': 0,
+			'subject': 'Hello {name}',
+			'content': CONTENT,
+			'audience_state': 'ready',
+			'audience_cursor': None,
+			'audience_added': 0
+		}) for _ in range(args.campaigns)
+	]
+	insert(campaign.Campaign, lCampaigns)
+	insert(campaign_sender.CampaignSender, [
+		synthesise('campaign_sender', {
+			'_campaign': dCampaign['_id'],
+			'_sender': dSender['_id'],
+			'weight': 1
+		})
+		for dCampaign in lCampaigns for dSender in lSenders[1:]
+	])
+	for dCampaign in lCampaigns:
+		campaign_contact.add_contacts_all(dCampaign['_id'], dProject['_id'])
+
+	# Return the IDs
+	return {
+		'project': dProject['_id'],
+		'campaigns': [ d['_id'] for d in lCampaigns ]
+	}
+
+def clean(seeded: dict) -> None:
+	"""Clean
+
+	Removes everything added by seed()
+
+	Arguments:
+		seeded (dict): The IDs returned by seed()
+
+	Returns:
+		None
+	"""
+
+	# Generate the statements, children first
+	lSQL = []
+	for oStorage, sField, mIDs in [
+		( campaign_contact.CampaignContact, '_campaign', seeded['campaigns'] ),
+		( campaign_sender.CampaignSender, '_campaign', seeded['campaigns'] ),
+		( campaign.Campaign, '_project', seeded['project'] ),
+		( contact.Contact, '_project', seeded['project'] ),
+		( sender.Sender, '_project', seeded['project'] ),
+		( project.Project, '_id', seeded['project'] )
+	]:
+		dStruct = oStorage._parent._table._struct
+		if isinstance(mIDs, str):
+			mIDs = [ mIDs ]
+		lSQL.append("DELETE FROM `%s`.`%s` WHERE `%s` IN ('%s')" % (
+			dStruct.db,
+			dStruct.name,
+			sField,
+			"','".join(escape(s, host = dStruct.host) for s in mIDs)
+		))
+
+	# Run them
+	execute(lSQL, campaign.Campaign._parent._table._struct.host)
+
+def run(lCampaigns: List[dict], claim: dict) -> None:
+	"""Run
+
+	Sends every campaign until it's paused, one message per campaign in \
+	turn, the same way the blocking daemon does
+
+	Arguments:
+		lCampaigns (dict[]): The campaigns, as returned by fetch_due()
+		claim (dict): The count and lease used to claim contacts
+
+	Returns:
+		None
+	"""
+	with smtp.Pool() as oPool:
+		lActive = list(lCampaigns)
+		while lActive:
+			for dCampaign in list(lActive):
+				if campaigns.send_next(
+					dCampaign, oPool, 'https://localhost/unsubscribe/', claim
+				) is None:
+					lActive.remove(dCampaign)
+
+async def run_async(lCampaigns: List[dict], claim: dict) -> None:
+	"""Run Async
+
+	Sends every campaign until it's paused, each campaign as its own task, \
+	the same way the asyncio daemon does
+
+	Arguments:
+		lCampaigns (dict[]): The campaigns, as returned by fetch_due()
+		claim (dict): The count and lease used to claim contacts
+
+	Returns:
+		None
+	"""
+
+	# Create the pool and the DB executor
+	oPool = smtp.AsyncPool()
+	oDB = ThreadPoolExecutor(1, 'benchmark-db')
+
+	# Send a campaign until it's paused
+	async def one(campaign_: dict):
+		while await campaigns.send_next_async(
+			campaign_, oPool, oDB, 'https://localhost/unsubscribe/', claim
+		) is not None:
+			pass
+
+	# Run them all, then clean up
+	try:
+		await asyncio.gather(*[ one(d) for d in lCampaigns ])
+	finally:
+		await oPool.close()
+		oDB.shutdown()
+
+def main():
+	"""Main
+
+	Parses the arguments, seeds the DB, runs the campaigns, and prints the \
+	report
+	"""
+
+	# Parse the arguments
+	oParser = argparse.ArgumentParser(
+		description = 'Measures the throughput of the campaigns daemon'
+	)
+	oParser.add_argument('--contacts', type = int, default = 2000)
+	oParser.add_argument('--campaigns', type = int, default = 2)
+	oParser.add_argument('--senders', type = int, default = 1)
+	oParser.add_argument('--claim', type = int, default = 50)
+	oParser.add_argument('--async', dest = 'async_', action = 'store_true')
+	oParser.add_argument('--keep', action = 'store_true')
+	oArgs = oParser.parse_args()
+
+	# Add the primary host and make sure the tables exist
+	record_mysql.add_host(config.mysql.primary({
+		'charset': 'utf8',
+		'host': 'localhost',
+		'passwd': '',
+		'port': 3306,
+		'user': 'mysql'
+	}))
+	record_mysql.db_create(config.mysql.db('contact'))
+	for oStorage in [
+		campaign.Campaign, campaign_contact.CampaignContact,
+		campaign_sender.CampaignSender, contact.Contact, project.Project,
+		sender.Sender
+	]:
+		oStorage.install()
+
+	# Find a free port and start the sink on it
+	with socket.socket() as oSocket:
+		oSocket.bind(( '127.0.0.1', 0 ))
+		iPort = oSocket.getsockname()[1]
+	oSink = Sink()
+	oController = Controller(
+		oSink,
+		hostname = '127.0.0.1',
+		port = iPort,
+		auth_require_tls = False,
+		authenticator = lambda *a: AuthResult(success = True)
+	)
+	oController.start()
+
+	# Time every stage
+	oTimings = Timings()
+	campaign_contact.claim = oTimings.wrap('claim', campaign_contact.claim)
+	templates.Template.render = oTimings.wrap(
+		'render', templates.Template.render
+	)
+	smtp.Pool.send = oTimings.wrap('send', smtp.Pool.send)
+	smtp.AsyncPool.send = oTimings.wrap_async('send', smtp.AsyncPool.send)
+	campaign_contact.sent = oTimings.wrap('status', campaign_contact.sent)
+	campaign_contact.sent_and_delivered = oTimings.wrap(
+		'status', campaign_contact.sent_and_delivered
+	)
+
+	# Seed the DB
+	print('seeding %d contacts and %d campaigns with %d senders' % (
+		oArgs.contacts, oArgs.campaigns, oArgs.senders
+	))
+	dSeeded = seed(oArgs, iPort)
+
+	try:
+
+		# Fetch the campaigns the same way the daemon does
+		lCampaigns = campaigns.fetch_due(
+			dSeeded['campaigns'], scheduler.Scheduler(scheduler.Local())
+		)
+		dClaim = { 'count': oArgs.claim, 'lease': 600 }
+
+		# Send everything, hiding the daemon's output
+		fStart = perf_counter()
+		with open(devnull, 'w') as oNull, redirect_stdout(oNull):
+			if oArgs.async_:
+				asyncio.run(run_async(lCampaigns, dClaim))
+			else:
+				run(lCampaigns, dClaim)
+			campaigns._status.flush()
+		fElapsed = perf_counter() - fStart
+
+	# No matter what, stop the sink and remove the data
+	finally:
+		oController.stop()
+		if not oArgs.keep:
+			clean(dSeeded)
+
+	# Print the report
+	print('%d messages in %.2fs, %.1f messages/s' % (
+		oSink.count, fElapsed, oSink.count / fElapsed
+	))
+	for sLine in oTimings.report():
+		print(sLine)
+
+# Only run if called directly
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,168 @@
+# coding=utf8
+""" Render Benchmark
+
+Compares the CPU each message costs when it's built as MIME objects and \
+serialised, the way it used to be, against splicing the contact's details \
+into the campaign's pre-encoded skeleton. Needs no DB or SMTP server
+
+Run from the rest directory:
+
+	python -m benchmarks.render [--messages N]
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-23"
+
+# Python imports
+import argparse
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from random import choice, randint
+from string import ascii_lowercase
+from time import perf_counter, process_time
+from typing import Callable, List
+
+# Benchmark imports
+from benchmarks.campaigns import CONTENT, percentile
+
+# Shared imports
+from shared import render, templates
+
+SUBJECT = 'A message for {name} at {company}'
+"""The subject of the campaign"""
+
+UNSUBSCRIBE = 'https://localhost/unsubscribe/'
+"""The root of the unsubscribe links"""
+
+def contacts(count: int) -> List[dict]:
+	"""Contacts
+
+	Returns synthetic contacts, some with names that need encoding
+
+	Arguments:
+		count (uint): The number of contacts
+
+	Returns:
+		dict[]
+	"""
+	lRet = []
+	for i in range(count):
+		sName = ''.join(choice(ascii_lowercase) for _ in range(randint(4, 12)))
+		if i % 5 == 0:
+			sName += ' Müller'
+		lRet.append({
+			'campaign_contact_id': '%032x' % i,
+			'name': sName.title(),
+			'alias': i % 2 and sName or None,
+			'company': 'Company %d' % i,
+			'email_address': '%s%d@example.com' % (sName.replace(' ', ''), i)
+		})
+	return lRet
+
+def measure(contacts_: List[dict], build: Callable[[dict], bytes]) -> dict:
+	"""Measure
+
+	Builds the message of every contact and returns the CPU and wall time \
+	per message, and the average size
+
+	Arguments:
+		contacts_ (dict[]): The contacts
+		build (callable): Returns the bytes sent to a contact
+
+	Returns:
+		dict
+	"""
+	lTimes = []
+	iBytes = 0
+	fCPU = process_time()
+	for d in contacts_:
+		fStart = perf_counter()
+		iBytes += len(build(d))
+		lTimes.append(perf_counter() - fStart)
+	fCPU = process_time() - fCPU
+	lTimes.sort()
+	return {
+		'cpu': fCPU / len(contacts_),
+		'p50': percentile(lTimes, 50),
+		'p99': percentile(lTimes, 99),
+		'bytes': iBytes / len(contacts_)
+	}
+
+def main():
+	"""Main
+
+	Parses the arguments, makes sure both paths send the same message, \
+	measures each, and prints the report
+	"""
+
+	# Parse the arguments
+	oParser = argparse.ArgumentParser(
+		description = 'Measures the CPU spent generating each message'
+	)
+	oParser.add_argument('--messages', type = int, default = 5000)
+	oArgs = oParser.parse_args()
+
+	# Compile the campaign, and generate the contacts
+	oCache = templates.Cache()
+	oCache.set({
+		'_id': 'benchmark', '_updated': 0,
+		'subject': SUBJECT, 'content': CONTENT
+	})
+	oSubject, oContent = oCache.get('benchmark')
+	oSkeleton = oCache.skeleton('benchmark')
+	lContacts = contacts(oArgs.messages)
+
+	# The old path, build the MIME and serialise it the way smtplib does
+	def mime(contact: dict) -> bytes:
+		dValues = render.values(contact, UNSUBSCRIBE)
+		oMessage = MIMEMultipart()
+		oMessage['From'] = 'sender@example.com'
+		oMessage['To'] = contact['email_address']
+		oMessage['Subject'] = oSubject.render(dValues)
+		oMessage['List-Unsubscribe'] = '<%soneclick/%s>' % (
+			UNSUBSCRIBE, contact['campaign_contact_id']
+		)
+		oMessage.attach(MIMEText(oContent.render(dValues), 'html'))
+		return oMessage.as_bytes(
+			policy = oMessage.policy.clone(linesep = '\r\n')
+		)
+
+	# The new path, splice the contact into the skeleton
+	def skeleton(contact: dict) -> bytes:
+		return render.raw(
+			'sender@example.com', contact, oSkeleton, UNSUBSCRIBE
+		)
+
+	# Make sure both say the same thing
+	for d in lContacts[:20]:
+		if render.content(mime(d)) != render.content(skeleton(d)):
+			raise ValueError('messages differ for %s' % d['name'])
+
+	# Measure each, the old one first so any warm up favours the new one
+	#	least
+	dMIME = measure(lContacts, mime)
+	dSkeleton = measure(lContacts, skeleton)
+
+	# Print the report
+	print('%d messages, %d byte content' % (len(lContacts), len(CONTENT)))
+	print('%-9s %12s %10s %10s %10s' % (
+		'path', 'cpu us/msg', 'p50 us', 'p99 us', 'bytes'
+	))
+	for sPath, dRes in ( ('mime', dMIME), ('skeleton', dSkeleton) ):
+		print('%-9s %12.1f %10.1f %10.1f %10d' % (
+			sPath,
+			dRes['cpu'] * 1e6,
+			dRes['p50'] * 1e6,
+			dRes['p99'] * 1e6,
+			dRes['bytes']
+		))
+	print('cpu saved per message: %.1f us (%.0f%%)' % (
+		(dMIME['cpu'] - dSkeleton['cpu']) * 1e6,
+		(1 - dSkeleton['cpu'] / dMIME['cpu']) * 100
+	))
+
+# Only run if called directly
+if __name__ == '__main__':
+	main()
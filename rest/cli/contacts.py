@@ -0,0 +1,99 @@
+# coding=utf8
+""" Contacts
+
+Imports contacts into a project from a CSV or NDJSON file, reading, \
+validating, and inserting them in batches so any size of file can be used
+
+Run from the rest directory:
+
+	python -m cli.contacts --project ID [--format csv|ndjson] FILE
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-24"
+
+# Ouroboros imports
+from config import config
+import jsonb
+import record_mysql
+
+# Python imports
+import argparse
+import sys
+
+# Record imports
+from records.admin import project
+
+# Service imports
+from services.admin import REPLACE_ME
+
+# Shared imports
+from shared import importer
+
+def main() -> int:
+	"""Main
+
+	Parses the arguments, runs the import, printing every row not added as \
+	it goes, and prints the count of each outcome at the end
+
+	Returns:
+		int, the exit code
+	"""
+
+	# Parse the arguments
+	oParser = argparse.ArgumentParser(
+		description = 'Imports contacts into a project'
+	)
+	oParser.add_argument('--project', required = True)
+	oParser.add_argument('--format', choices = importer.FORMATS)
+	oParser.add_argument('--batch', type = int)
+	oParser.add_argument('file')
+	oArgs = oParser.parse_args()
+
+	# If we didn't get a format, use the file's extension
+	sFormat = oArgs.format or \
+		(oArgs.file.lower().endswith('.csv') and 'csv' or 'ndjson')
+
+	# Add the primary host
+	record_mysql.add_host(config.mysql.primary({
+		'charset': 'utf8',
+		'host': 'localhost',
+		'passwd': '',
+		'port': 3306,
+		'user': 'mysql'
+	}))
+
+	# If the project doesn't exist
+	if not project.Project.exists(oArgs.project):
+		print('project "%s" not found' % oArgs.project, file = sys.stderr)
+		return 1
+
+	# Init the counts
+	dCounts = { 'inserted': 0, 'duplicate': 0, 'unsubscribed': 0, 'invalid': 0 }
+
+	# Open the file and run each row through
+	with open(oArgs.file, encoding = 'utf-8-sig', newline = '') as oFile:
+		for iLine, sOutcome, mDetail in importer.run(
+			oFile,
+			sFormat,
+			oArgs.project,
+			{ 'user': REPLACE_ME },
+			oArgs.batch or config.importer.batch(500)
+		):
+			dCounts[sOutcome] += 1
+
+			# Print anything not added
+			if sOutcome != 'inserted':
+				print('%d\t%s\t%s' % (
+					iLine, sOutcome, jsonb.encode(mDetail)
+				), file = sys.stderr)
+
+	# Print the counts
+	print(jsonb.encode(dCounts))
+	return 0
+
+# Only run if called directly
+if __name__ == '__main__':
+	sys.exit(main())
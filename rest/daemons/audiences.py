@@ -0,0 +1,139 @@
+# coding=utf8
+"""Audiences
+
+Handles adding the contacts of new campaigns in the background, a chunk at a \
+time, so that no single statement holds locks on the contacts for long
+"""
+
+__author__		= "Chris Nasr"
+__version__		= "1.0.0"
+__maintainer__	= "Chris Nasr"
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-24"
+
+# Ouroboros imports
+from config import config
+
+# Python imports
+from time import sleep
+
+# Record imports
+from records.admin import campaign, campaign_contact
+
+# Shared imports
+from shared import daemon, log, scheduler
+
+_log = log.get('daemons.audiences')
+"""The logger for the daemon"""
+
+def build_chunk(campaign_: dict, count: int) -> bool:
+	"""Build Chunk
+
+	Adds the next chunk of contacts to the campaign's audience and records \
+	the progress. Once there's nothing left the audience is marked as ready, \
+	and the campaign daemon is told in case it has to start now. Running the \
+	same chunk twice, after a crash, adds nothing the second time
+
+	Arguments:
+		campaign_ (dict): The campaign's ID, project, audience, and cursor
+		count (uint): The number of contacts looked at in each chunk
+
+	Returns:
+		bool, True if the audience is complete
+	"""
+
+	# Get the categories, if the audience is built from them
+	dAudience = campaign_['audience']
+	lCategories = dAudience['contacts'] == 'categories' and \
+					dAudience['categories'] or None
+
+	# Find the last contact in the chunk
+	sAfter = campaign_['audience_cursor']
+	sUntil = campaign_contact.audience_bound(
+		campaign_['_project'], lCategories, sAfter, count
+	)
+
+	# Add the contacts in the chunk
+	if lCategories:
+		iAdded = campaign_contact.add_contacts_by_categories(
+			campaign_['_id'], lCategories, sAfter, sUntil
+		)
+	else:
+		iAdded = campaign_contact.add_contacts_all(
+			campaign_['_id'], campaign_['_project'], sAfter, sUntil
+		)
+
+	# If this was the last chunk
+	if sUntil is None:
+
+		# Mark the audience as ready, and let the campaign daemon know
+		campaign.audience_ready(
+			campaign_['_id'], iAdded, dAudience['start_now']
+		)
+		scheduler.notify(campaign_['_id'])
+		_log.info('ready', extra = { 'data': {
+			'campaign': campaign_['_id'],
+			'added': campaign_['audience_added'] + iAdded
+		} })
+		return True
+
+	# Record the progress and move the cursor
+	campaign.audience_progress(campaign_['_id'], sUntil, iAdded)
+	campaign_['audience_cursor'] = sUntil
+	campaign_['audience_added'] += iAdded
+	return False
+
+def main():
+	"""Main
+
+	Builds the audiences of new campaigns, forever
+	"""
+
+	# Add the primary host and start the logging
+	daemon.setup('audiences')
+
+	# Get the chunk size, the seconds to rest between chunks so that others
+	#	can get at the tables, and the longest to wait for new campaigns
+	dConf = config.audiences({
+		'chunk': 1000,
+		'pause': 0.1,
+		'max_wait': 300
+	})
+
+	# Wait on the same channel new campaigns are announced on
+	oNotifier = scheduler.notifier()
+
+	# Loop forever
+	try:
+		while True:
+
+			# Get every campaign still being built
+			lCampaigns = campaign.Campaign.filter(
+				{ 'audience_state': 'building' },
+				raw = [
+					'_id', '_project', 'audience', 'audience_cursor',
+					'audience_added'
+				]
+			)
+
+			# If there's none, sleep until a campaign is created, or it's time
+			#	to check anyway
+			if not lCampaigns:
+				oNotifier.wait(dConf['max_wait'])
+				continue
+
+			# Add one chunk to each so that a huge audience doesn't hold up
+			#	the small ones created after it
+			for d in lCampaigns:
+				build_chunk(d, dConf['chunk'])
+				sleep(dConf['pause'])
+
+	# No matter how we stop
+	finally:
+
+		# Write anything still waiting to be logged
+		log.stop()
+
+# Only run if called directly
+if __name__ == '__main__':
+	main()
@@ -12,184 +12,1396 @@ __created__		= "2024-01-21"
 
 # Ouroboros imports
 from config import config
-import record_mysql
-from strings import strtr
+
+# Pip imports
+import aiosmtplib
 
 # Python imports
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from random import uniform
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import smtplib
+from math import ceil
+from os import getpid
+from random import uniform
+from re import sub
+from socket import gethostname
 import sys
-from time import sleep, time
-
-# Pip imports
-import arrow
+from time import monotonic, time
+from typing import Dict, List, Set, Tuple
 
 # Record imports
-from records.admin import campaign, campaign_contact, contact, sender
+from records.admin import campaign, campaign_contact, campaign_sender, sender
+
+# Shared imports
+from shared import \
+	adaptive, breaker, daemon, log, metrics, ratelimit, render, retry, \
+	rotation, scheduler, smtp, status, templates
+
+WORKER = config.campaigns.worker('%s:%d' % (gethostname(), getpid()))
+"""The unique name used by this process to claim campaign contacts"""
+
+BACKLOG = metrics.Gauge(
+	'contact_campaign_backlog',
+	'Contacts not yet sent, by scheduled campaign',
+	( 'campaign', )
+)
+IN_FLIGHT = metrics.Gauge(
+	'contact_campaign_in_flight',
+	'Messages being sent right now'
+)
+MESSAGES = metrics.Counter(
+	'contact_campaign_messages_total',
+	'Messages sent, by whether the SMTP server accepted them',
+	( 'delivered', )
+)
+QUEUED = metrics.Gauge(
+	'contact_campaign_queued',
+	'Messages waiting between pipeline stages, by the stage they wait for',
+	( 'stage', )
+)
+RETRIES = metrics.Counter(
+	'contact_campaign_retries_total',
+	'Messages that failed temporarily and will be tried again later'
+)
+SCHEDULED = metrics.Gauge(
+	'contact_campaigns_scheduled',
+	'Campaigns waiting on their next trigger'
+)
+
+_log = log.get('daemons.campaigns')
+"""The logger for the daemon"""
+
+_adaptive = adaptive.Controller(**config.campaigns.adaptive({
+	'start': 0.5,
+	'increase': 0.05,
+	'decrease': 0.5,
+	'floor': 0.05,
+	'slow': 2.0,
+	'smoothing': 0.2
+}))
+"""How fast each sender can go, from how its relay has been answering"""
+
+_breaker = breaker.Breaker(
+	config.campaigns.breaker.threshold(5),
+	config.campaigns.breaker.cooldown(60)
+)
+"""The circuit breaker of each sender, shared by every campaign using it"""
+
+_claimed: Dict[str, List[dict]] = {}
+"""Campaign contacts claimed by this process but not yet sent, by campaign"""
+
+_cursor: Dict[str, int] = {}
+"""The queue position of the last contact claimed, by campaign"""
+
+_limiter: ratelimit.Local | ratelimit.Redis = ratelimit.Local()
+"""The token bucket of each sender, shared by every campaign using it"""
+
+_purged: Set[str] = set()
+"""Campaigns this process has already removed unusable contacts from"""
+
+_retry = config.campaigns.retry({
+	'attempts': 5,
+	'base': 60,
+	'cap': 3600
+})
+"""How many times, and how far apart, temporary failures are tried again"""
+
+_rotation = rotation.Rotation(_breaker)
+"""The order each campaign's senders are used in"""
+
+_templates = templates.Cache()
+"""The compiled subject and content of each campaign"""
 
-def get_next_contact(campaign_id: str) -> dict | None:
+_status = status.Writer(
+	config.campaigns.status.size(100),
+	config.campaigns.status.age(5.0)
+)
+"""The outcomes of sent messages waiting to be written to the DB"""
+
+def get_next_contact(
+	campaign_id: str,
+	count: int = 1,
+	lease: int = 600
+) -> dict | None:
 	"""Get Next Contact
 
 	Finds the next usable contact in a campaign, or None if there are none
-	left
+	left. Contacts are claimed from the campaign in batches, with their \
+	details, so that other processes sending the same campaign never get the \
+	same contact, and missing or unsubscribed contacts are skipped by the DB. \
+	Each claim starts after the last position claimed, once the end of the \
+	queue is reached it starts over to pick up released and retried contacts
 
 	Arguments:
 		campaign_id (str): The unique ID of the campaign
+		count (uint): Optional, the number of contacts to claim at once
+		lease (uint): Optional, the seconds the claim is held for
 
 	Returns:
 		dict | None
 	"""
 
-	# Loop until we get a contact, or there are no more
-	while True:
+	# If this is the first time we've seen the campaign, remove any contacts
+	#	that can't be sent to
+	if campaign_id not in _purged:
+		dCounts = campaign_contact.purge(campaign_id)
+		_purged.add(campaign_id)
+		if dCounts['orphaned'] or dCounts['unsubscribed']:
+			_log.info('purged', extra = { 'data': {
+				'campaign': campaign_id, **dCounts
+			} })
+
+	# If we have nothing left from the last claim, claim more. Anything sent
+	#	but not yet written is flushed first so it isn't claimed again
+	if not _claimed.get(campaign_id):
+		_status.flush()
+		iAfter = _cursor.get(campaign_id, 0)
+		_claimed[campaign_id] = campaign_contact.claim(
+			campaign_id, WORKER, count, lease, iAfter
+		)
+
+		# If there was nothing past the cursor, go back to the start of the
+		#	queue for anything released, or waiting to be retried, behind it
+		if not _claimed[campaign_id] and iAfter:
+			_claimed[campaign_id] = campaign_contact.claim(
+				campaign_id, WORKER, count, lease
+			)
 
-		# Get the next campaign contact
-		dCampaignContact = campaign_contact.next(campaign_id)
+		# Remember how far into the queue we've claimed
+		if _claimed[campaign_id]:
+			_cursor[campaign_id] = max(
+				d['position'] for d in _claimed[campaign_id]
+			)
 
-		# If there is none, return immediately
-		if not dCampaignContact:
-			return None
+	# If there is none, return immediately
+	if not _claimed[campaign_id]:
+		return None
 
-		# Find the contacts details
-		dContact = contact.Contact.get(dCampaignContact['_contact'], raw = True)
+	# Get the next campaign contact, which already has the contact's details
+	dContact = _claimed[campaign_id].pop(0)
 
-		# If they don't exist, remove them and start again
-		if not dContact:
-			campaign_contact.CampaignContact.remove(dCampaignContact['_id'])
-			continue
+	# Add the campaign contact ID to the data
+	dContact['campaign_contact_id'] = dContact.pop('_id')
+
+	# Return the contact
+	return dContact
+
+def put_back(campaign_id: str, contact_: dict) -> None:
+	"""Put Back
+
+	Returns a contact from get_next_contact() that wasn't sent to, so it's \
+	the next one returned. The contact is still claimed by this process
+
+	Arguments:
+		campaign_id (str): The unique ID of the campaign
+		contact_ (dict): The contact returned by get_next_contact()
+
+	Returns:
+		None
+	"""
+	contact_['_id'] = contact_.pop('campaign_contact_id')
+	_claimed.setdefault(campaign_id, []).insert(0, contact_)
+
+def fetch_due(
+	campaign_ids: List[str],
+	scheduler_: scheduler.Scheduler
+) -> List[dict]:
+	"""Fetch Due
+
+	Fetches the scheduling details and senders of the given campaigns, and \
+	makes sure the compiled subject and content of each one is current, \
+	only fetching the bodies of the campaigns that are new or have been \
+	edited. Sending doesn't change `_updated`, so a trigger set by another \
+	process is only seen here, and any campaign that isn't actually due is \
+	put back on the schedule instead of being returned
 
-		# If the contact is unsubscribed, remove them and start again
-		if dContact['unsubscribed']:
-			campaign_contact.CampaignContact.remove(dCampaignContact['_id'])
+	Arguments:
+		campaign_ids (str[]): The IDs of the campaigns that are due
+		scheduler_ (scheduler.Scheduler): The schedule to put back any that \
+			aren't
+
+	Returns:
+		dict[]
+	"""
+
+	# Fetch the campaigns without their subject and content
+	lCampaigns = campaign.Campaign.get(
+		campaign_ids,
+		raw = [
+			'_id', '_updated', '_sender', 'next_trigger', 'min_interval',
+			'max_interval'
+		]
+	)
+
+	# Put back any that were paused, or moved later, since we scheduled them
+	iNow = int(time())
+	lDue = []
+	for d in lCampaigns:
+		if d['next_trigger'] is None or d['next_trigger'] > iNow:
+			scheduler_.set(d['_id'], d['next_trigger'])
+		else:
+			lDue.append(d)
+	lCampaigns = lDue
+
+	# If there's none left, there's nothing else to do
+	if not lCampaigns:
+		return []
+
+	# Find any we don't have the current version of
+	lStale = [
+		d['_id'] for d in lCampaigns
+		if not _templates.current(d['_id'], d['_updated'])
+	]
+
+	# Add the pool of senders to each campaign
+	dPools = campaign_sender.by_campaigns(lCampaigns)
+	for d in lCampaigns:
+		d['senders'] = dPools[d['_id']]
+
+	# If we have any, fetch and compile them
+	if lStale:
+		for d in campaign.Campaign.get(
+			lStale,
+			raw = [ '_id', '_updated', 'subject', 'content' ]
+		):
+			_templates.set(d)
+
+	# Return the campaigns
+	return lCampaigns
+
+def finish(
+	campaign_: dict,
+	sender_id: str,
+	contact_: dict,
+	delivered: bool,
+	transient: bool = False,
+	code: int = None
+) -> int:
+	"""Finish
+
+	Records the result of sending a message, to be written with others, \
+	and sets the campaign's next trigger. Temporary failures that haven't \
+	used up their attempts are instead released right away to be tried \
+	again later
+
+	Arguments:
+		campaign_ (dict): The campaign record, with the count of usable \
+			senders stored by claim_next()
+		sender_id (str): The ID of the sender the message was sent with
+		contact_ (dict): The contact the message was sent to
+		delivered (bool): True if the SMTP server accepted the message
+		transient (bool): Optional, True if the failure is worth retrying
+		code (uint): Optional, the SMTP code the message failed with
+
+	Returns:
+		The timestamp of the next trigger
+	"""
+
+	# If it failed temporarily and we haven't run out of attempts, put it back
+	#	to be claimed again once it's waited long enough
+	iAttempts = (contact_.get('attempts') or 0) + 1
+	if not delivered and transient and iAttempts < _retry['attempts']:
+		iRetryAt = int(time() + retry.backoff(
+			iAttempts, _retry['base'], _retry['cap']
+		))
+		campaign_contact.retry(
+			contact_['campaign_contact_id'], iRetryAt, code
+		)
+		RETRIES.inc()
+		_log.info('retry', extra = { 'data': {
+			'campaign': campaign_['_id'],
+			'campaign_contact': contact_['campaign_contact_id'],
+			'attempts': iAttempts,
+			'code': code,
+			'retry_at': iRetryAt
+		} })
+
+	# Else, add the outcome to those waiting to be written, count it, and log
+	#	it
+	else:
+		_status.add(contact_['campaign_contact_id'], delivered, code)
+		MESSAGES.inc(delivered = delivered and 'true' or 'false')
+		_log.info('sent', extra = { 'data': {
+			'campaign': campaign_['_id'],
+			'campaign_contact': contact_['campaign_contact_id'],
+			'delivered': delivered,
+			'code': code
+		} })
+
+	# Set the next trigger for the campaign and return it. The intervals are
+	#	per sender, so the more senders the campaign can use right now, the
+	#	sooner it can send again, and how far into them we go depends on how
+	#	well the sender's relay has been keeping up. Senders that are missing
+	#	or failing don't count, or the healthy ones would send faster than
+	#	they're meant to
+	iSenders = campaign_['usable']
+	return campaign.set_next(
+		campaign_['_id'],
+		_adaptive.interval(sender_id, [
+			campaign_['min_interval'] / iSenders,
+			campaign_['max_interval'] / iSenders
+		])
+	)
+
+def observe(sender_id: str, seconds: float, error: Exception | None) -> None:
+	"""Observe
+
+	Lets the adaptive controller know how a sender's relay handled a \
+	message. Anything refused for good says nothing about how fast we can \
+	go, so it's ignored
+
+	Arguments:
+		sender_id (str): The ID of the sender
+		seconds (float): The time the relay took
+		error (Exception | None): The error the message failed with, if any
+
+	Returns:
+		None
+	"""
+	if error is None:
+		_adaptive.observe(sender_id, seconds, False)
+	elif retry.classify(error)[0]:
+		_adaptive.observe(sender_id, seconds, True)
+
+def claim_next(campaign_: dict, claim: dict) -> tuple | int | None:
+	"""Claim Next
+
+	Picks the next contact to send to and the next sender in the campaign's \
+	rotation, or pauses the campaign if there's nothing left to send, or no \
+	senders left to send with. The contact is found first so that no \
+	sender's token is spent when there's nothing to send. If none of the \
+	campaign's senders can send right now, the contact is put back and the \
+	time one can is returned
+
+	Arguments:
+		campaign_ (dict): The campaign record
+		claim (dict): The count and lease used to claim contacts
+
+	Returns:
+		The sender and the contact, the timestamp to try again at if every \
+		sender is out of tokens or failing, or every contact left is waiting \
+		to be retried, or None if the campaign was paused
+	"""
+
+	# Get the senders
+	dSenders = {
+		d['_id']: d for d in sender.Sender.get(
+			[ t[0] for t in campaign_['senders'] ],
+			raw = True
+		)
+	}
+
+	# If none of the senders exist, pause the campaign
+	if not dSenders:
+		campaign.pause(campaign_['_id'])
+		_templates.remove(campaign_['_id'])
+		_rotation.remove(campaign_['_id'])
+		return None
+
+	# Get the next contact. Never claim more contacts than can be sent before
+	#	the lease runs out, or another process could take them
+	dContact = get_next_contact(
+		campaign_['_id'],
+		max(1, min(
+			claim['count'],
+			claim['lease'] // max(1, campaign_['max_interval'])
+		)),
+		claim['lease']
+	)
+
+	# If there's none
+	if not dContact:
+
+		# If some we could claim are waiting to be retried, come back when the
+		#	first is due
+		iRetryAt = campaign_contact.retry_next(
+			campaign_['_id'], WORKER, claim['lease']
+		)
+		if iRetryAt is not None:
+			iWait = max(1, iRetryAt - int(time()))
+			return campaign.set_next(campaign_['_id'], [ iWait, iWait ])
+
+		# Else, pause the campaign
+		campaign.pause(campaign_['_id'])
+		_templates.remove(campaign_['_id'])
+		_rotation.remove(campaign_['_id'])
+		return None
+
+	# Go through the senders whose breakers are closed in the order of the
+	#	rotation and use the first one that has a token. A sender that has
+	#	cooled down only gets through if this message can be its trial, and
+	#	gives the trial back if it has no token
+	lPool = [ t for t in campaign_['senders'] if t[0] in dSenders ]
+	dSender = None
+	lWaits = []
+	for sID in _rotation.order(campaign_['_id'], lPool):
+		if not _breaker.take(sID):
 			continue
+		fWait = _limiter.take(dSenders[sID])
+		if fWait <= 0:
+			dSender = dSenders[sID]
+			break
+		_breaker.release(sID)
+		lWaits.append(fWait)
 
-		# Add the campaign contact ID to the data
-		dContact['campaign_contact_id'] = dCampaignContact['_id']
+	# If none of the senders can send right now, put the contact back, it's
+	#	still ours, and try again as soon as one of them has a token or has
+	#	cooled down
+	if dSender is None:
+		put_back(campaign_['_id'], dContact)
+		fCooling = _breaker.cooling(list(dSenders.keys()))
+		if fCooling is not None:
+			lWaits.append(fCooling)
+		return int(time()) + max(1, ceil(min(lWaits)))
 
-		# Return the contact
-		return dContact
+	# Move the sender to the back of the rotation
+	_rotation.use(campaign_['_id'], dSender['_id'], lPool)
 
-# Only run if called directly
-if __name__ == '__main__':
+	# Store how many of the senders are healthy right now so the next
+	#	trigger is only brought forward by the ones actually sending
+	campaign_['usable'] = max(1, len([
+		t for t in lPool if _breaker.closed(t[0])
+	]))
 
-	# Add the primary host
-	record_mysql.add_host(config.mysql.primary({
-		'charset': 'utf8',
-		'host': 'localhost',
-		'passwd': '',
-		'port': 3306,
-		'user': 'mysql'
-	}))
-
-	# Get the domain for unsubscribing
-	sUnsubscribeRoot = 'https://%s/unsubscribe/' % \
-						config.unsubscribe.domain('localhost')
+	# Return the sender and the contact
+	return dSender, dContact
 
-	# Loop forever
+def log_message(campaign_id: str, to: str, message: bytes) -> None:
+	"""Log Message
+
+	Logs the whole message, only when debugging
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		to (str): The e-mail address the message is for
+		message (bytes): The message generated
+
+	Returns:
+		None
+	"""
+	if _log.isEnabledFor(logging.DEBUG):
+		sSubject, sContent = render.content(message)
+		_log.debug('message', extra = { 'data': {
+			'campaign': campaign_id,
+			'to': to,
+			'subject': sSubject,
+			'content': sContent
+		} })
+
+def prepare_next(
+	campaign_: dict,
+	unsubscribe_root: str,
+	claim: dict
+) -> tuple | None:
+	"""Prepare Next
+
+	Generates the next message in the campaign using the next sender in its \
+	rotation, or pauses the campaign if there's nothing left to send, or no \
+	senders left to send with. If none of the campaign's senders can send \
+	right now, nothing is sent and the time one can is returned
+
+	Arguments:
+		campaign_ (dict): The campaign record
+		unsubscribe_root (str): The URL used to generate unsubscribe links
+		claim (dict): The count and lease used to claim contacts
+
+	Returns:
+		The sender, the contact, and the message, the timestamp to try again \
+		at if every sender is out of tokens or failing, or every contact left \
+		is waiting to be retried, or None if the campaign was paused
+	"""
+
+	# Pick the sender and the contact
+	tNext = claim_next(campaign_, claim)
+	if not isinstance(tNext, tuple):
+		return tNext
+	dSender, dContact = tNext
+
+	# Generate the message from the campaign's pre-encoded one
+	message = render.raw(
+		dSender['email_address'],
+		dContact,
+		_templates.skeleton(campaign_['_id']),
+		unsubscribe_root
+	)
+	log_message(campaign_['_id'], dContact['email_address'], message)
+
+	# Return everything needed to send it
+	return dSender, dContact, message
+
+def send_next(
+	campaign_: dict,
+	pool: smtp.Pool,
+	unsubscribe_root: str,
+	claim: dict
+) -> int | None:
+	"""Send Next
+
+	Sends the next message in the campaign and sets the campaign's next \
+	trigger, or pauses it if there's nothing left to send
+
+	Arguments:
+		campaign_ (dict): The campaign record
+		pool (smtp.Pool): The pool of SMTP connections
+		unsubscribe_root (str): The URL used to generate unsubscribe links
+		claim (dict): The count and lease used to claim contacts
+
+	Returns:
+		The timestamp of the next trigger, or None if the campaign was paused
+	"""
+
+	# Generate the message
+	tNext = prepare_next(campaign_, unsubscribe_root, claim)
+	if not isinstance(tNext, tuple):
+		return tNext
+	dSender, dContact, message = tNext
+
+	# Send the email using the sender's open connection
+	IN_FLIGHT.inc()
+	try:
+		pool.send(dSender, message, dContact['email_address'])
+		_breaker.ok(dSender['_id'])
+		bDelivered = True
+		bTransient, iCode = False, None
+	except Exception as e:
+		_log.warning('send failed', extra = { 'data': {
+			'campaign': campaign_['_id'],
+			'sender': dSender['_id'],
+			'error': str(e)
+		} })
+		if isinstance(e, smtplib.SMTPRecipientsRefused):
+			_breaker.release(dSender['_id'])
+		else:
+			_breaker.fail(dSender['_id'])
+		bDelivered = False
+		bTransient, iCode = retry.classify(e)
+	finally:
+		IN_FLIGHT.dec()
+
+	# Record the result and return the next trigger
+	return finish(
+		campaign_, dSender['_id'], dContact, bDelivered, bTransient, iCode
+	)
+
+async def deliver_async(
+	campaign_id: str,
+	pool: smtp.AsyncPool,
+	sender_: dict,
+	to: str,
+	message: bytes
+) -> Tuple[bool, bool, int | None]:
+	"""Deliver Async
+
+	Sends a message using one of the sender's connections and updates the \
+	sender's breaker
+
+	Arguments:
+		campaign_id (str): The ID of the campaign the message is from
+		pool (smtp.AsyncPool): The pool of SMTP connections
+		sender_ (dict): The sender record
+		to (str): The e-mail address to send to
+		message (bytes): The message to send
+
+	Returns:
+		True if it was delivered, True if a failure is worth retrying, and \
+		the SMTP code of the failure, if any
+	"""
+	IN_FLIGHT.inc()
+	try:
+		await pool.send(sender_, message, to)
+		_breaker.ok(sender_['_id'])
+		return True, False, None
+	except Exception as e:
+		_log.warning('send failed', extra = { 'data': {
+			'campaign': campaign_id,
+			'sender': sender_['_id'],
+			'error': str(e)
+		} })
+		if isinstance(e, aiosmtplib.SMTPRecipientsRefused):
+			_breaker.release(sender_['_id'])
+		else:
+			_breaker.fail(sender_['_id'])
+		return False, *retry.classify(e)
+	finally:
+		IN_FLIGHT.dec()
+
+async def send_next_async(
+	campaign_: dict,
+	pool: smtp.AsyncPool,
+	db: ThreadPoolExecutor,
+	unsubscribe_root: str,
+	claim: dict
+) -> int | None:
+	"""Send Next Async
+
+	The asyncio version of send_next(). Anything that touches the DB is run \
+	in the db executor so the event loop is never blocked by it
+
+	Arguments:
+		campaign_ (dict): The campaign record
+		pool (smtp.AsyncPool): The pool of SMTP connections
+		db (ThreadPoolExecutor): The executor used for DB calls
+		unsubscribe_root (str): The URL used to generate unsubscribe links
+		claim (dict): The count and lease used to claim contacts
+
+	Returns:
+		The timestamp of the next trigger, or None if the campaign was paused
+	"""
+
+	# Get the loop
+	oLoop = asyncio.get_running_loop()
+
+	# Generate the message
+	tNext = await oLoop.run_in_executor(
+		db, prepare_next, campaign_, unsubscribe_root, claim
+	)
+	if not isinstance(tNext, tuple):
+		return tNext
+	dSender, dContact, message = tNext
+
+	# Send the email using one of the sender's connections
+	bDelivered, bTransient, iCode = await deliver_async(
+		campaign_['_id'], pool, dSender, dContact['email_address'], message
+	)
+
+	# Record the result and return the next trigger
+	return await oLoop.run_in_executor(
+		db, finish, campaign_, dSender['_id'], dContact, bDelivered,
+		bTransient, iCode
+	)
+
+async def render_stage(
+	inbox: asyncio.Queue,
+	outbox: asyncio.Queue,
+	done: asyncio.Queue,
+	unsubscribe_root: str
+) -> None:
+	"""Render Stage
+
+	Takes claimed messages and generates them from the campaign's \
+	pre-encoded message, then passes them on to be sent. Splicing in a \
+	contact is only a join, so it's done right on the event loop. Runs \
+	until cancelled
+
+	Arguments:
+		inbox (asyncio.Queue): The claimed messages
+		outbox (asyncio.Queue): The messages waiting to be sent
+		done (asyncio.Queue): Where campaigns that failed are put
+		unsubscribe_root (str): The URL used to generate unsubscribe links
+
+	Returns:
+		None
+	"""
+
+	# Forever
+	while True:
+		dJob = await inbox.get()
+		try:
+
+			# Generate the message
+			dJob['message'] = render.raw(
+				dJob['sender']['email_address'],
+				dJob['contact'],
+				_templates.skeleton(dJob['campaign']['_id']),
+				unsubscribe_root
+			)
+			log_message(
+				dJob['campaign']['_id'],
+				dJob['contact']['email_address'],
+				dJob['message']
+			)
+
+			# Pass it on, waiting if the senders are behind
+			await outbox.put(dJob)
+
+		# If anything failed, let the main loop know
+		except Exception as e:
+			done.put_nowait(( dJob['campaign']['_id'], e ))
+
+		# No matter what, mark it done
+		finally:
+			inbox.task_done()
+
+async def send_stage(
+	inbox: asyncio.Queue,
+	outbox: asyncio.Queue,
+	done: asyncio.Queue,
+	pool: smtp.AsyncPool
+) -> None:
+	"""Send Stage
+
+	Takes generated messages and sends them, then passes the results on to \
+	be recorded. Several of these run at once, the pool limits how many \
+	use the same sender. Runs until cancelled
+
+	Arguments:
+		inbox (asyncio.Queue): The messages waiting to be sent
+		outbox (asyncio.Queue): The results waiting to be recorded
+		done (asyncio.Queue): Where campaigns that failed are put
+		pool (smtp.AsyncPool): The pool of SMTP connections
+
+	Returns:
+		None
+	"""
+
+	# Forever
 	while True:
+		dJob = await inbox.get()
+		try:
+
+			# Send the message and store the result
+			dJob['result'] = await deliver_async(
+				dJob['campaign']['_id'],
+				pool,
+				dJob['sender'],
+				dJob['contact']['email_address'],
+				dJob.pop('message')
+			)
+
+			# Pass it on, waiting if the DB is behind
+			await outbox.put(dJob)
+
+		# If anything failed, let the main loop know
+		except Exception as e:
+			done.put_nowait(( dJob['campaign']['_id'], e ))
+
+		# No matter what, mark it done
+		finally:
+			inbox.task_done()
+
+async def record_stage(
+	inbox: asyncio.Queue,
+	done: asyncio.Queue,
+	db: ThreadPoolExecutor
+) -> None:
+	"""Record Stage
+
+	Takes the results of sent messages, records them, and lets the main \
+	loop know when each campaign is due next. Runs until cancelled
+
+	Arguments:
+		inbox (asyncio.Queue): The results waiting to be recorded
+		done (asyncio.Queue): Where the next trigger of each campaign is put
+		db (ThreadPoolExecutor): The executor used for DB calls
+
+	Returns:
+		None
+	"""
+
+	# Get the loop
+	oLoop = asyncio.get_running_loop()
+
+	# Forever
+	while True:
+		dJob = await inbox.get()
+		try:
+			iTrigger = await oLoop.run_in_executor(
+				db,
+				finish,
+				dJob['campaign'],
+				dJob['sender']['_id'],
+				dJob['contact'],
+				*dJob['result']
+			)
+			done.put_nowait(( dJob['campaign']['_id'], iTrigger ))
 
-		# Fetch any campaigns that are at or past their trigger
-		lCampaigns = campaign.Campaign.filter(
-			{ 'next_trigger': { 'lte': int(arrow.get().timestamp()) } },
-			raw = [ '_id', '_sender', 'min_interval', 'max_interval', 'subject',
-					'content' ]
+		# If anything failed, let the main loop know
+		except Exception as e:
+			done.put_nowait(( dJob['campaign']['_id'], e ))
+
+		# No matter what, mark it done
+		finally:
+			inbox.task_done()
+
+def start_breaker() -> None:
+	"""Start Breaker
+
+	Replaces the breakers with ones that publish their state to Redis, if \
+	set, so it can be seen in the admin
+
+	Returns:
+		None
+	"""
+	global _breaker, _rotation
+	dBreaker = config.campaigns.breaker({
+		'cooldown': 60,
+		'redis': None,
+		'threshold': 5
+	})
+	if dBreaker['redis']:
+		_breaker = breaker.Breaker(
+			dBreaker['threshold'], dBreaker['cooldown'], dBreaker['redis']
 		)
+		_rotation = rotation.Rotation(_breaker)
+
+def start_metrics() -> int:
+	"""Start Metrics
+
+	Times every DB call and serves the metrics on the side port, if one is \
+	set
+
+	Returns:
+		uint, the seconds between backlog updates
+	"""
+
+	# Get the config
+	dMetrics = config.campaigns.metrics({
+		'backlog_every': 60,
+		'host': '0.0.0.0',
+		'port': 9102
+	})
+
+	# Time every DB call
+	metrics.instrument_mysql()
+
+	# If we have a port, serve the metrics on it
+	if dMetrics['port']:
+		metrics.serve(dMetrics['host'], dMetrics['port'])
+
+	# Return how often to update the backlog
+	return dMetrics['backlog_every']
+
+def update_gauges(scheduler_: scheduler.Scheduler, backlog: bool) -> None:
+	"""Update Gauges
+
+	Sets the count of scheduled campaigns, and, if requested, fetches the \
+	count of unsent contacts in each of them
+
+	Arguments:
+		scheduler_ (scheduler.Scheduler): The scheduler
+		backlog (bool): True to update the backlog, which is a DB call
 
-		# If there's none, wait for 30 seconds
-		if not lCampaigns:
-			sleep(30)
+	Returns:
+		None
+	"""
+
+	# Set the count of scheduled campaigns
+	SCHEDULED.set(len(scheduler_))
+
+	# If we need the backlog, fetch it and replace every campaign's count
+	if backlog:
+		lIDs = scheduler_.ids()
+		BACKLOG.replace({
+			( k, ): v for k, v in (
+				lIDs and campaign_contact.unsent_by_campaigns(lIDs) or {}
+			).items()
+		})
+
+def setup() -> dict:
+	"""Setup
+
+	Does everything each version of the daemon needs before it starts. Adds \
+	the primary host, starts the logging, the breakers, and the metrics, \
+	shares the sender buckets through Redis if set, and gets the config the \
+	loops use
+
+	Returns:
+		dict, the seconds between backlog updates, the claim config, the \
+		path of the worker's outcome journal and a glob matching every \
+		worker's, the max seconds to wait, the SMTP config, and the root of \
+		unsubscribe links
+	"""
+
+	# Add the primary host, and start the logging, the breakers, and the
+	#	metrics
+	daemon.setup('campaigns')
+	start_breaker()
+	iBacklogEvery = start_metrics()
+
+	# If the sender buckets are shared with other processes, use Redis
+	global _limiter
+	sRedis = config.campaigns.rate.redis(None)
+	if sRedis:
+		_limiter = ratelimit.Redis(sRedis)
+
+	# Get the path of the journal. Every worker on the host needs its own, so
+	#	the worker's name is put in it, and the journals of any that are gone
+	#	are found by putting a wildcard in its place
+	sJournal = config.campaigns.status.journal('campaigns.{worker}.journal')
+
+	# Return the config
+	return {
+		'backlog_every': iBacklogEvery,
+		'claim': config.campaigns.claim({
+			'count': 50,
+			'lease': 600
+		}),
+		'journal': sJournal.replace('{worker}', sub(r'[^\w.-]', '_', WORKER)),
+		'journals': sJournal.replace('{worker}', '*'),
+		'max_wait': config.campaigns.max_wait(300),
+		'smtp': config.campaigns.smtp({
+			'max_idle': 300,
+			'noop_after': 30,
+			'per_sender': 1,
+			'senders': {},
+			'timeouts': smtp.TIMEOUTS
+		}),
+		'unsubscribe': 'https://%s/unsubscribe/' % \
+						config.unsubscribe.domain('localhost')
+	}
+
+async def setup_async(conf: dict) -> dict:
+	"""Setup Async
+
+	Does everything the asyncio versions of the daemon need after setup(). \
+	Creates the pool of connections and the executors, writes anything left \
+	from the last run and starts journaling outcomes, and creates the \
+	scheduler
+
+	Arguments:
+		conf (dict): The config returned by setup()
+
+	Returns:
+		dict, the pool, the DB and waiter executors, the notifier, and the \
+		scheduler
+	"""
+
+	# Create the pool of connections
+	oPool = smtp.AsyncPool(
+		conf['smtp']['max_idle'],
+		conf['smtp']['noop_after'],
+		conf['smtp']['per_sender'],
+		conf['smtp']['senders'],
+		conf['smtp']['timeouts'],
+		_adaptive.concurrency,
+		observe
+	)
+
+	# Create the executors. record_mysql shares a single connection per host,
+	#	so every DB call has to go through the same thread. The notifier gets
+	#	its own so waiting on it never blocks the DB
+	oDB = ThreadPoolExecutor(1, 'campaigns-db')
+	oWaiter = ThreadPoolExecutor(1, 'campaigns-wait')
+
+	# Write anything left from the last run, and start journaling outcomes
+	await asyncio.get_running_loop().run_in_executor(
+		oDB, _status.open, conf['journal'], conf['journals']
+	)
 
-		# Go through each one
-		for dCampaign in lCampaigns:
+	# Create the notifier and the scheduler
+	oNotifier = scheduler.notifier()
 
-			# Get the sender
-			dSender = sender.Sender.get(dCampaign['_sender'], raw = True)
+	# Return everything
+	return {
+		'db': oDB,
+		'notifier': oNotifier,
+		'pool': oPool,
+		'scheduler': scheduler.Scheduler(oNotifier, conf['max_wait']),
+		'waiter': oWaiter
+	}
 
-			# If the sender does not exist, pause the campaign
-			if not dSender:
-				campaign.pause(dCampaign['_id'])
+async def stop_async(started: dict) -> None:
+	"""Stop Async
+
+	Undoes setup_async() once nothing is sending any more. Closes the \
+	connections, writes any outcomes waiting, gives back any contacts \
+	claimed but not sent, and shuts down the executors and the logging
+
+	Arguments:
+		started (dict): The values returned by setup_async()
+
+	Returns:
+		None
+	"""
+
+	# Get the loop and the DB executor
+	oLoop = asyncio.get_running_loop()
+	oDB = started['db']
+
+	# Close any open connections
+	await started['pool'].close()
+
+	# Write any outcomes waiting, then give back any contacts we claimed but
+	#	didn't get to
+	await oLoop.run_in_executor(oDB, _status.close)
+	await oLoop.run_in_executor(oDB, campaign_contact.release, WORKER)
+
+	# Shutdown the executors
+	oDB.shutdown()
+	started['waiter'].shutdown(wait = False)
+
+	# Write anything still waiting to be logged
+	log.stop()
+
+def main():
+	"""Main
+
+	Sends campaign messages as each campaign comes due, forever
+	"""
+
+	# Set everything up
+	dConf = setup()
+	fBacklogAt = 0
+
+	# Create the pool of connections so that we only login to each sender once
+	oPool = smtp.Pool(
+		dConf['smtp']['max_idle'],
+		dConf['smtp']['noop_after'],
+		dConf['smtp']['timeouts'],
+		observe = observe
+	)
+
+	# Write anything left from the last run, and start journaling outcomes
+	_status.open(dConf['journal'], dConf['journals'])
+
+	# Create the scheduler
+	oScheduler = scheduler.Scheduler(max_wait = dConf['max_wait'])
+
+	# Loop forever
+	try:
+		while True:
+
+			# Close any connections that haven't been used in a while
+			oPool.prune()
+
+			# Get any changes to the campaigns
+			oScheduler.refresh()
+
+			# Update the gauges, only fetching the backlog every so often
+			bBacklog = monotonic() >= fBacklogAt
+			if bBacklog:
+				fBacklogAt = monotonic() + dConf['backlog_every']
+			update_gauges(oScheduler, bBacklog)
+
+			# Get the campaigns that are due
+			lIDs = oScheduler.due()
+
+			# If there's none, write any outcomes waiting, then sleep until the
+			#	next one is due, or we're told something changed
+			if not lIDs:
+				_status.flush()
+				oScheduler.wait()
 				continue
 
-			# Get the next contact
-			dContact = get_next_contact(dCampaign['_id'])
-
-			# If there's none, pause the campaign and move on to the next one
-			if not dContact:
-				campaign.pause(dCampaign['_id'])
-				break
-
-			#  If the alias is missing, set it to the name
-			if 'alias' not in dContact or not dContact['alias']:
-				dContact['alias'] = dContact['name']
-
-			# Generate the translation table
-			dTpl = {
-				r'{_id}': dContact['campaign_contact_id'],
-				r'{name}': dContact['name'],
-				r'{alias}': dContact['alias'],
-				r'{company}': dContact['company'],
-				r'{email_address}': dContact['email_address'],
-				r'{unsubscribe_url}': '%s%s' % (
-					sUnsubscribeRoot, dContact['campaign_contact_id']
+			# Fetch the campaigns that are due
+			lCampaigns = fetch_due(lIDs, oScheduler)
+
+			# Go through each one, send the next message, and put it back on
+			#	the schedule
+			for dCampaign in lCampaigns:
+				oScheduler.set(
+					dCampaign['_id'],
+					send_next(
+						dCampaign, oPool, dConf['unsubscribe'], dConf['claim']
+					)
 				)
-			}
-
-			print('=' * 40)
-			print('To: %s' % dContact['email_address'])
-
-			# Generate the subject using the contacts details
-			sSubject = strtr(dCampaign['subject'], dTpl)
-			print('Subject: %s' % sSubject)
-
-			# Generate the email using the contact details
-			sContent = strtr(dCampaign['content'], dTpl)
-			print('Content: %s' % sContent)
-			print('=' * 40)
-
-			# Generate the email
-			message = MIMEMultipart()
-			message["From"] = dSender['email_address']
-			message["To"] = dContact['email_address']
-			message["Subject"] = sSubject
-			message["List-Unsubscribe"] = '<%soneclick/%s>' % (
-				sUnsubscribeRoot, dContact['campaign_contact_id']
-			)
-			message.attach(MIMEText(sContent, 'html'))
 
-			# Connect to the SMTP server
-			with smtplib.SMTP(dSender['host'], dSender['port']) as mail:
+	# No matter how we stop
+	finally:
 
-				# If we need tls
-				if dSender['tls']:
-					mail.starttls()
+		# Close any open connections
+		oPool.close()
 
-				# Login
-				mail.login(dSender['email_address'], dSender['password'])
+		# Write any outcomes waiting, this has to happen before the release or
+		#	the contacts would look unsent
+		_status.close()
 
-				# Send the email
-				try:
-					mail.send_message(message)
+		# Give back any contacts we claimed but didn't get to
+		campaign_contact.release(WORKER)
 
-					# Mark the message as sent and delivered
-					campaign_contact.sent_and_delivered(
-						dContact['campaign_contact_id']
-					)
+		# Write anything still waiting to be logged
+		log.stop()
+
+async def main_async():
+	"""Main Async
+
+	Sends campaign messages as each campaign comes due, forever, running \
+	each due campaign as its own task so that one slow SMTP server doesn't \
+	hold up any other campaign
+	"""
+
+	# Set everything up
+	dConf = setup()
+	dStarted = await setup_async(dConf)
+	oDB = dStarted['db']
+	oNotifier = dStarted['notifier']
+	oPool = dStarted['pool']
+	oScheduler = dStarted['scheduler']
+	fBacklogAt = 0
 
-				except Exception as e:
-					print(e)
+	# Get the loop
+	oLoop = asyncio.get_running_loop()
 
-					# Mark the message as sent
-					campaign_contact.sent(
-						dContact['campaign_contact_id']
+	# The running tasks by campaign ID, and the notifier wait
+	dTasks: Dict[str, asyncio.Task] = {}
+	oNotified = None
+
+	# Loop forever
+	try:
+		while True:
+
+			# Close any connections that haven't been used in a while
+			await oPool.prune()
+
+			# Get any changes to the campaigns
+			await oLoop.run_in_executor(oDB, oScheduler.refresh)
+
+			# Update the gauges, only fetching the backlog every so often
+			bBacklog = monotonic() >= fBacklogAt
+			if bBacklog:
+				fBacklogAt = monotonic() + dConf['backlog_every']
+			await oLoop.run_in_executor(
+				oDB, update_gauges, oScheduler, bBacklog
+			)
+
+			# Get the campaigns that are due and not already sending
+			lIDs = [ _id for _id in oScheduler.due() if _id not in dTasks ]
+
+			# If we have any, fetch them and start a task for each
+			if lIDs:
+				lCampaigns = await oLoop.run_in_executor(
+					oDB, fetch_due, lIDs, oScheduler
+				)
+				for dCampaign in lCampaigns:
+					dTasks[dCampaign['_id']] = asyncio.create_task(
+						send_next_async(
+							dCampaign, oPool, oDB, dConf['unsubscribe'],
+							dConf['claim']
+						),
+						name = dCampaign['_id']
 					)
 
-			# Set the next trigger for the campaign
-			campaign.set_next(
-				dCampaign['_id'],
-				[ dCampaign['min_interval'], dCampaign['max_interval'] ]
+			# If outcomes have been waiting long enough, or nothing is sending,
+			#	write them
+			if _status.due() or (not dTasks and len(_status)):
+				await oLoop.run_in_executor(oDB, _status.flush)
+
+			# If we aren't already waiting on the notifier, start
+			if oNotified is None:
+				oNotified = oLoop.run_in_executor(
+					dStarted['waiter'], oNotifier.wait, dConf['max_wait']
+				)
+
+			# Wait for a task to finish, a notification, or the next trigger
+			lDone, _ = await asyncio.wait(
+				[ oNotified, *dTasks.values() ],
+				timeout = oScheduler.timeout(),
+				return_when = asyncio.FIRST_COMPLETED
 			)
 
-		# ONLY WHILE TESTING
-		break
\ No newline at end of file
+			# If the notifier finished, clear it so we start a new one
+			if oNotified in lDone:
+				oNotified = None
+
+			# Go through each finished task and put the campaign back on the
+			#	schedule
+			for sID, oTask in list(dTasks.items()):
+				if oTask.done():
+					del dTasks[sID]
+					try:
+						oScheduler.set(sID, oTask.result())
+
+					# If it failed, try it again later
+					except Exception:
+						_log.error(
+							'campaign failed',
+							exc_info = True,
+							extra = { 'data': { 'campaign': sID } }
+						)
+						oScheduler.set(sID, int(time()) + dConf['max_wait'])
+
+	# No matter how we stop
+	finally:
+
+		# Let any tasks still sending finish
+		if dTasks:
+			await asyncio.wait(dTasks.values())
+
+		# Close the connections, write the outcomes, and release the rest
+		await stop_async(dStarted)
+
+async def main_pipeline():
+	"""Main Pipeline
+
+	Sends campaign messages as each campaign comes due, forever, in four \
+	stages connected by bounded queues. Contacts are claimed by the main \
+	loop, messages are generated from the campaign's pre-encoded message, \
+	sent by a set of I/O tasks, and recorded in the DB thread. When a later \
+	stage falls behind, the queue in front of it fills up and the stages \
+	before it wait, so nothing piles up in memory
+	"""
+
+	# Get the pipeline config
+	dPipeline = config.campaigns.pipeline({
+		'queue': 100,
+		'send': 16
+	})
+
+	# Set everything up
+	dConf = setup()
+	dStarted = await setup_async(dConf)
+	oDB = dStarted['db']
+	oNotifier = dStarted['notifier']
+	oPool = dStarted['pool']
+	oScheduler = dStarted['scheduler']
+	fBacklogAt = 0
+
+	# Get the loop
+	oLoop = asyncio.get_running_loop()
+
+	# Create the queues between the stages, and the one the stages report
+	#	finished campaigns on, which can never hold more than one entry per
+	#	campaign in flight
+	dQueues = {
+		'render': asyncio.Queue(dPipeline['queue']),
+		'send': asyncio.Queue(dPipeline['queue']),
+		'record': asyncio.Queue(dPipeline['queue'])
+	}
+	qDone = asyncio.Queue()
+
+	# Start the stages
+	lStages = [
+		asyncio.create_task(render_stage(
+			dQueues['render'], dQueues['send'], qDone, dConf['unsubscribe']
+		))
+	] + [
+		asyncio.create_task(send_stage(
+			dQueues['send'], dQueues['record'], qDone, oPool
+		))
+		for _ in range(dPipeline['send'])
+	] + [
+		asyncio.create_task(record_stage(dQueues['record'], qDone, oDB))
+	]
+
+	# The campaigns in the pipeline, and the waits on the notifier and on the
+	#	stages
+	sInFlight: Set[str] = set()
+	oNotified = None
+	oFinished = None
+
+	# Loop forever
+	try:
+		while True:
+
+			# Close any connections that haven't been used in a while
+			await oPool.prune()
+
+			# Get any changes to the campaigns
+			await oLoop.run_in_executor(oDB, oScheduler.refresh)
+
+			# Update the gauges, only fetching the backlog every so often
+			bBacklog = monotonic() >= fBacklogAt
+			if bBacklog:
+				fBacklogAt = monotonic() + dConf['backlog_every']
+			await oLoop.run_in_executor(
+				oDB, update_gauges, oScheduler, bBacklog
+			)
+			for sStage, oQueue in dQueues.items():
+				QUEUED.set(oQueue.qsize(), stage = sStage)
+
+			# Get the campaigns that are due and not already in the pipeline
+			lIDs = [ _id for _id in oScheduler.due() if _id not in sInFlight ]
+
+			# If we have any, fetch them, and claim the next message of each
+			if lIDs:
+				lCampaigns = await oLoop.run_in_executor(
+					oDB, fetch_due, lIDs, oScheduler
+				)
+				for dCampaign in lCampaigns:
+					try:
+						tNext = await oLoop.run_in_executor(
+							oDB, claim_next, dCampaign, dConf['claim']
+						)
+					except Exception:
+						_log.error(
+							'campaign failed',
+							exc_info = True,
+							extra = { 'data': { 'campaign': dCampaign['_id'] } }
+						)
+						oScheduler.set(
+							dCampaign['_id'], int(time()) + dConf['max_wait']
+						)
+						continue
+
+					# If there's nothing to send right now, put it back on the
+					#	schedule
+					if not isinstance(tNext, tuple):
+						oScheduler.set(dCampaign['_id'], tNext)
+						continue
+
+					# Else, put it in the pipeline, waiting if it's full
+					sInFlight.add(dCampaign['_id'])
+					await dQueues['render'].put({
+						'campaign': dCampaign,
+						'sender': tNext[0],
+						'contact': tNext[1]
+					})
+
+			# If outcomes have been waiting long enough, or nothing is in the
+			#	pipeline, write them
+			if _status.due() or (not sInFlight and len(_status)):
+				await oLoop.run_in_executor(oDB, _status.flush)
+
+			# If we aren't already waiting on the notifier or the stages,
+			#	start
+			if oNotified is None:
+				oNotified = oLoop.run_in_executor(
+					dStarted['waiter'], oNotifier.wait, dConf['max_wait']
+				)
+			if oFinished is None:
+				oFinished = asyncio.ensure_future(qDone.get())
+
+			# Wait for a campaign to finish, a notification, or the next
+			#	trigger
+			lDone, _ = await asyncio.wait(
+				[ oNotified, oFinished ],
+				timeout = oScheduler.timeout(),
+				return_when = asyncio.FIRST_COMPLETED
+			)
+
+			# If the notifier finished, clear it so we start a new one
+			if oNotified in lDone:
+				oNotified = None
+
+			# Get every campaign that finished
+			lFinished = []
+			if oFinished in lDone:
+				lFinished.append(oFinished.result())
+				oFinished = None
+			while not qDone.empty():
+				lFinished.append(qDone.get_nowait())
+
+			# Go through each one and put it back on the schedule
+			for sID, mTrigger in lFinished:
+				sInFlight.discard(sID)
+
+				# If it failed, try it again later
+				if isinstance(mTrigger, Exception):
+					_log.error(
+						'campaign failed',
+						exc_info = mTrigger,
+						extra = { 'data': { 'campaign': sID } }
+					)
+					oScheduler.set(sID, int(time()) + dConf['max_wait'])
+				else:
+					oScheduler.set(sID, mTrigger)
+
+	# No matter how we stop
+	finally:
+
+		# Let everything already in the pipeline finish, then stop the stages
+		for sStage in ( 'render', 'send', 'record' ):
+			await dQueues[sStage].join()
+		for oTask in lStages:
+			oTask.cancel()
+		if oFinished is not None:
+			oFinished.cancel()
+
+		# Close the connections, write the outcomes, and release the rest
+		await stop_async(dStarted)
+
+# Only run if called directly
+if __name__ == '__main__':
+
+	# If we want the pipelined version
+	if '--pipeline' in sys.argv:
+		asyncio.run(main_pipeline())
+
+	# Else, if we want the asyncio version
+	elif '--async' in sys.argv:
+		asyncio.run(main_async())
+
+	# Else, use the blocking version
+	else:
+		main()
\ No newline at end of file
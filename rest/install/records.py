@@ -17,7 +17,8 @@ import record_redis
 
 # Records
 from records.admin import \
-	campaign, campaign_contact, category, contact, project, sender
+	campaign, campaign_contact, campaign_sender, category, contact, project, \
+	sender
 
 # Only run if called directly
 if __name__ == '__main__':
@@ -39,6 +40,7 @@ if __name__ == '__main__':
 	# Create the tables
 	campaign.Campaign.install()
 	campaign_contact.CampaignContact.install()
+	campaign_sender.CampaignSender.install()
 	category.Category.install()
 	contact.Contact.install()
 	project.Project.install()
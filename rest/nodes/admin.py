@@ -11,13 +11,256 @@ __email__		= "chris@ouroboroscoding.com"
 __created__		= "2022-08-25"
 
 # Ouroboros imports
-from body import register_services, REST
+from body import Error, errors as body_errors, register_services, \
+	Response, REST
 from config import config
 import record_mysql
 
+# Pip imports
+import bottle
+
+# Python imports
+from io import TextIOWrapper
+import re
+from typing import Callable, Iterator, List
+
 # Project imports
 from . import errors
-from services.admin import Admin
+from records.admin import campaign, campaign_contact, contact, project
+from services.admin import Admin, REPLACE_ME
+from shared import exporter, importer, metrics
+
+_cors: re.Pattern | None = None
+"""The domains allowed to make requests, the same ones the REST server \
+allows"""
+
+def _allow(domains: List[str] | None) -> None:
+	"""Allow
+
+	Compiles the domains allowed to make requests to the raw routes, the \
+	same way the REST server does for its own
+
+	Arguments:
+		domains (str[]): The domains, None to not allow any
+
+	Returns:
+		None
+	"""
+	global _cors
+
+	# If we got nothing, allow nothing
+	if not domains:
+		_cors = None
+		return
+
+	# Compile the domains, and any of their sub-domains
+	if len(domains) == 1:
+		sDomains = domains[0].replace('.', '\\.')
+	else:
+		sDomains = '(?:%s)' % '|'.join([
+			s.replace('.', '\\.') for s in domains
+		])
+	_cors = re.compile('https?://(.*\\.)?%s' % sDomains)
+
+def _raw(callback: Callable) -> Callable:
+	"""Raw
+
+	Wraps a route that bottle calls directly, so that it gets the same CORS \
+	headers and OPTIONS response as the routes of the REST server
+
+	Arguments:
+		callback (callable): The route
+
+	Returns:
+		callable
+	"""
+
+	def route():
+
+		# If the origin is allowed, let the browser know
+		if _cors and \
+			'origin' in bottle.request.headers and \
+			_cors.match(bottle.request.headers['origin']):
+			bottle.response.headers['Access-Control-Allow-Origin'] = \
+				bottle.request.headers['origin']
+			bottle.response.headers['Vary'] = 'Origin'
+
+		# If the request is OPTIONS, return the headers expected and nothing
+		#	else
+		if bottle.request.method == 'OPTIONS':
+			bottle.response.headers['Access-Control-Allow-Methods'] = \
+				'DELETE, GET, POST, PUT, OPTIONS'
+			bottle.response.headers['Access-Control-Max-Age'] = 1728000
+			bottle.response.headers['Access-Control-Allow-Headers'] = \
+				'Authorization,DNT,X-CustomHeader,Keep-Alive,User-Agent,' \
+				'X-Requested-With,If-Modified-Since,Cache-Control,Content-Type'
+			bottle.response.headers['Content-Type'] = 'text/plain charset=UTF-8'
+			bottle.response.status = 204
+			return ''
+
+		# Else, call the route
+		return callback()
+
+	return route
+
+def _export(
+	page: Callable,
+	key: str,
+	fields: List[str],
+	format: str,
+	filename: str
+) -> Iterator[bytes]:
+	"""Export
+
+	Sets the headers for an export and returns the generator that streams \
+	it, bottle sends each chunk as it's yielded
+
+	Arguments:
+		page (callable): Returns each page of rows, see exporter.rows()
+		key (str): The field the pages are ordered by
+		fields (str[]): The fields to export
+		format (str): 'csv' or 'ndjson'
+		filename (str): The name of the file, without the extension
+
+	Returns:
+		iterator
+	"""
+	bottle.response.headers['Content-Type'] = exporter.CONTENT_TYPES[format]
+	bottle.response.headers['Content-Disposition'] = \
+		'attachment; filename="%s.%s"' % (filename, format)
+	return exporter.encode(
+		exporter.rows(page, key, config.exporter.page(1000)),
+		format,
+		fields
+	)
+
+def campaign_export():
+	"""Campaign Export
+
+	Streams the result of every contact in the campaign, whether it was \
+	sent, delivered, opened, or unsubscribed. Takes the campaign _id, and \
+	the format, csv by default, in the query string
+
+	Returns:
+		iterator | str
+	"""
+
+	# Errors are returned as JSON
+	bottle.response.headers['Content-Type'] = \
+		'application/json; charset=utf-8'
+
+	# Check the campaign and the format
+	sID = bottle.request.query.get('_id')
+	sFormat = bottle.request.query.get('format', 'csv')
+	if not sID:
+		return Error(body_errors.DATA_FIELDS, [ [ '_id', 'missing' ] ]).to_json()
+	if sFormat not in exporter.CONTENT_TYPES:
+		return Error(
+			body_errors.DATA_FIELDS, [ [ 'format', 'invalid' ] ]
+		).to_json()
+	if not campaign.Campaign.exists(sID):
+		return Error(body_errors.DB_NO_RECORD, [ sID, 'campaign' ]).to_json()
+
+	# Stream the results
+	return _export(
+		lambda after, count: campaign_contact.page(sID, after, count),
+		'_contact',
+		exporter.CAMPAIGN_FIELDS,
+		sFormat,
+		'campaign-%s' % sID
+	)
+
+def contacts_export():
+	"""Contacts Export
+
+	Streams every contact in the project, with the IDs of their categories. \
+	Takes the project, and the format, csv by default, in the query string
+
+	Returns:
+		iterator | str
+	"""
+
+	# Errors are returned as JSON
+	bottle.response.headers['Content-Type'] = \
+		'application/json; charset=utf-8'
+
+	# Check the project and the format
+	sProject = bottle.request.query.get('project')
+	sFormat = bottle.request.query.get('format', 'csv')
+	if not sProject:
+		return Error(
+			body_errors.DATA_FIELDS, [ [ 'project', 'missing' ] ]
+		).to_json()
+	if sFormat not in exporter.CONTENT_TYPES:
+		return Error(
+			body_errors.DATA_FIELDS, [ [ 'format', 'invalid' ] ]
+		).to_json()
+	if not project.Project.exists(sProject):
+		return Error(
+			body_errors.DB_NO_RECORD, [ sProject, 'project' ]
+		).to_json()
+
+	# Stream the contacts
+	return _export(
+		lambda after, count: contact.page(sProject, after, count),
+		'_id',
+		exporter.CONTACT_FIELDS,
+		sFormat,
+		'contacts-%s' % sProject
+	)
+
+def contacts_import():
+	"""Contacts Import
+
+	Adds the contacts in the body of the request, CSV or NDJSON, to the \
+	project, reading and inserting them in batches as the body is read. \
+	Bodies too big to keep in memory are spooled to disk by bottle. Takes \
+	the project, and the format, csv by default, in the query string, and \
+	returns the count of each outcome and the first rows not added
+
+	Returns:
+		str
+	"""
+
+	# Set the return to JSON
+	bottle.response.headers['Content-Type'] = \
+		'application/json; charset=utf-8'
+
+	# Check the project and the format
+	sProject = bottle.request.query.get('project')
+	sFormat = bottle.request.query.get('format', 'csv')
+	if not sProject:
+		return Error(
+			body_errors.DATA_FIELDS, [ [ 'project', 'missing' ] ]
+		).to_json()
+	if sFormat not in importer.FORMATS:
+		return Error(
+			body_errors.DATA_FIELDS, [ [ 'format', 'invalid' ] ]
+		).to_json()
+	if not project.Project.exists(sProject):
+		return Error(
+			body_errors.DB_NO_RECORD, [ sProject, 'project' ]
+		).to_json()
+
+	# Get the config
+	dConf = config.importer({
+		'batch': 500,
+		'max_errors': 100
+	})
+
+	# Run the import over the body and return the summary
+	return Response(importer.summary(
+		importer.run(
+			TextIOWrapper(
+				bottle.request.body, encoding = 'utf-8-sig', newline = ''
+			),
+			sFormat,
+			sProject,
+			{ 'user': REPLACE_ME },
+			dConf['batch']
+		),
+		dConf['max_errors']
+	)).to_json()
 
 def main():
 	"""Main
@@ -34,6 +277,9 @@ def main():
 		'user': 'mysql'
 	}))
 
+	# Time every DB call
+	metrics.instrument_mysql()
+
 	# Get the config
 	dConf = config.admin({
 		'verbose': False
@@ -48,15 +294,36 @@ def main():
 	# Get the admin conf
 	dAdmin = oRest['admin']
 
-	# Run the REST server with the Client instance
-	REST(
+	# Get the domains allowed to make requests
+	lAllowed = config.body.rest.allowed()
+
+	# Create the REST server with the Client instance
+	oREST = REST(
 		name = 'admin',
 		instance = oAdmin,
-		cors = config.body.rest.allowed(),
+		cors = lAllowed,
 		lists = True,
 		on_errors = errors,
 		verbose = dConf['verbose']
-	).run(
+	)
+
+	# Add the routes that stream, allowing the same domains
+	_allow(lAllowed)
+	oREST.route(
+		'/campaign/export', [ 'GET', 'OPTIONS' ], _raw(campaign_export)
+	)
+	oREST.route(
+		'/contacts/export', [ 'GET', 'OPTIONS' ], _raw(contacts_export)
+	)
+	oREST.route(
+		'/contacts/import', [ 'POST', 'OPTIONS' ], _raw(contacts_import)
+	)
+
+	# Count and time every request, and serve the metrics
+	metrics.add_routes(oREST, 'admin')
+
+	# Run the REST server
+	oREST.run(
 		host = dAdmin['host'],
 		port = dAdmin['port'],
 		workers = dAdmin['workers'],
@@ -20,6 +20,9 @@ import bottle
 # Record imports
 from records.admin import campaign_contact
 
+# Shared imports
+from shared import metrics
+
 # Constants
 with open('templates/track/1x1.png', 'rb') as f:
 	rsPixel = f.read()
@@ -48,6 +51,9 @@ class Track(bottle.Bottle):
 		# Add the routes
 		self.route('/<_id>', 'GET', getattr(self, 'index_get'))
 
+		# Count and time every request, and serve the metrics
+		metrics.add_routes(self, 'track')
+
 	def index_get(self, _id: str):
 		"""Index (GET)
 
@@ -115,6 +121,9 @@ if __name__ == "__main__":
 		'user': 'mysql'
 	}))
 
+	# Time every DB call
+	metrics.instrument_mysql()
+
 	# Get config
 	dConf = config.track({
 		'host': '0.0.0.0',
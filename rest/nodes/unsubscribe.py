@@ -21,6 +21,9 @@ from jinja2 import FileSystemLoader, Environment, select_autoescape
 # Record imports
 from records.admin import campaign_contact, project
 
+# Shared imports
+from shared import metrics
+
 # Templates
 tpl = { 'index': None, 'response': None }
 
@@ -50,6 +53,9 @@ class Unsubscribe(bottle.Bottle):
 		self.route('/<_id>', 'POST', getattr(self, 'index_post'))
 		self.route('/oneclick/<_id>', 'GET', getattr(self, 'one_click'))
 
+		# Count and time every request, and serve the metrics
+		metrics.add_routes(self, 'unsubscribe')
+
 		# Init Jinja and load templates
 		jinja = Environment(
 			loader = FileSystemLoader('templates/unsubscribe'),
@@ -207,6 +213,9 @@ if __name__ == "__main__":
 		'user': 'mysql'
 	}))
 
+	# Time every DB call
+	metrics.instrument_mysql()
+
 	# Get config
 	dConf = config.unsubscribe({
 		'host': '0.0.0.0',
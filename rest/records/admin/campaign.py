@@ -13,14 +13,17 @@ __created__		= "2024-01-16"
 # Ouroboros imports
 from config import config
 import jsonb
-from record_mysql import Storage
-from record_mysql.server import execute
+from record_mysql import server, Storage
 
 # Python imports
 from pathlib import Path
 from random import uniform
+from time import time
 from typing import List
 
+# Shared imports
+from shared import log
+
 # Create the Storage instance
 Campaign = Storage(
 
@@ -39,12 +42,14 @@ Campaign = Storage(
 			'create': [
 				'_created', '_updated', '_project', '_sender', 'name',
 				'next_trigger', 'min_interval', 'max_interval',	'subject',
-				'content'
+				'content', 'audience', 'audience_state', 'audience_cursor',
+				'audience_added'
 			],
 			'db': config.mysql.db('contact'),
 			'indexes': {
 				'i_project': '_project',
-				'i_next_trigger': 'next_trigger'
+				'i_next_trigger': 'next_trigger',
+				'i_audience_state': 'audience_state'
 			},
 			'name': 'admin_campaign',
 			'revisions': [ 'user' ]
@@ -56,14 +61,100 @@ Campaign = Storage(
 		} },
 		'_updated': { '__mysql__': {
 			'opts': 'not null default CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP'
+		} },
+		'audience': { '__mysql__': {
+			'json': True
+		} },
+		'audience_state': { '__mysql__': {
+			'opts': 'not null default \'ready\''
+		} },
+		'audience_added': { '__mysql__': {
+			'opts': 'not null default 0'
 		} }
 	}
 )
 
+_log = log.get('records.campaign')
+"""The logger for the campaign records"""
+
+def audience_progress(campaign_id: str, cursor: str, added: int) -> bool:
+	"""Audience Progress
+
+	Records how far into the contacts the campaign's audience has been \
+	built, and how many contacts were added. `_updated` is left alone, it \
+	only changes when the campaign itself is edited
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		cursor (str): The ID of the last contact looked at
+		added (uint): The number of contacts added since the last progress
+
+	Returns:
+		bool
+	"""
+
+	# Get the struct
+	dStruct = Campaign._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `_updated` = `_updated`,\n" \
+			" `audience_cursor` = '%(cursor)s',\n" \
+			" `audience_added` = `audience_added` + %(added)d\n" \
+			"WHERE `_id` = '%(_id)s'" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'cursor': cursor,
+		'added': added,
+		'_id': campaign_id
+	}
+
+	# Run the statement and return the result
+	return server.execute(sSQL, dStruct.host) and True or False
+
+def audience_ready(campaign_id: str, added: int, start_now: bool) -> bool:
+	"""Audience Ready
+
+	Marks the campaign's audience as complete, and if it was meant to start \
+	immediately, sets its next trigger so the daemon picks it up. Unlike the \
+	other updates this one changes `_updated`, it only happens once and is \
+	how the daemon's refresh finds the new trigger
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		added (uint): The number of contacts added since the last progress
+		start_now (bool): True to trigger the campaign now
+
+	Returns:
+		bool
+	"""
+
+	# Get the struct
+	dStruct = Campaign._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `audience_state` = 'ready',\n" \
+			" `audience_added` = `audience_added` + %(added)d%(trigger)s\n" \
+			"WHERE `_id` = '%(_id)s'" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'added': added,
+		'trigger': start_now and \
+			',\n `next_trigger` = CURRENT_TIMESTAMP' or '',
+		'_id': campaign_id
+	}
+
+	_log.debug('audience ready', extra = { 'data': { 'sql': sSQL } })
+
+	# Run the statement and return the result
+	return server.execute(sSQL, dStruct.host) and True or False
+
 def pause(campaign_id: str) -> bool:
 	"""Pause
 
-	Pauses an existing campaign
+	Pauses an existing campaign. `_updated` is left alone so the daemon \
+	doesn't take its own scheduling for an edit of the campaign
 
 	Arguments:
 		campaign_id (str): The ID of the campaign to pause
@@ -77,6 +168,7 @@ def pause(campaign_id: str) -> bool:
 
 	# Generate the SQL
 	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `_updated` = `_updated`,\n" \
 			" `next_trigger` = NULL\n" \
 			"WHERE `_id` = '%(_id)s'" % {
 		'db': dStruct.db,
@@ -84,21 +176,24 @@ def pause(campaign_id: str) -> bool:
 		'_id': campaign_id
 	}
 
-	print(sSQL)
+	_log.debug('pause', extra = { 'data': { 'sql': sSQL } })
 
-	# Run the statement
-	return execute(sSQL, dStruct.host) and True or False
+	# Run the statement and return the result
+	return server.execute(sSQL, dStruct.host) and True or False
 
-def set_next(campaign_id: str, minmax: List[int]) -> bool:
-	"""Pause
+def set_next(campaign_id: str, minmax: List[int]) -> int:
+	"""Set Next
 
-	Pauses an existing campaign
+	Sets the next trigger of an existing campaign to a random number of \
+	seconds from now, between the min and max. `_updated` is left alone so \
+	the daemon doesn't take its own scheduling for an edit of the campaign
 
 	Arguments:
-		campaign_id (str): The ID of the campaign to pause
+		campaign_id (str): The ID of the campaign to set
+		minmax (uint[]): The minimum and maximum seconds
 
 	Returns:
-		bool
+		The approximate timestamp of the next trigger
 	"""
 
 	# Get the struct
@@ -109,6 +204,7 @@ def set_next(campaign_id: str, minmax: List[int]) -> bool:
 
 	# Generate the SQL
 	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `_updated` = `_updated`,\n" \
 			" `next_trigger` = DATE_ADD(NOW(), INTERVAL %(interval)d second)\n" \
 			"WHERE `_id` = '%(_id)s'" % {
 		'db': dStruct.db,
@@ -117,8 +213,11 @@ def set_next(campaign_id: str, minmax: List[int]) -> bool:
 		'_id': campaign_id
 	}
 
-	print(sSQL)
+	_log.debug('set next', extra = { 'data': { 'sql': sSQL } })
 
 	# Run the statement
-	return execute(sSQL, dStruct.host) and True or False
+	server.execute(sSQL, dStruct.host)
+
+	# Return the trigger
+	return int(time()) + iInterval
 
@@ -13,13 +13,14 @@ __created__		= "2024-01-16"
 # Ouroboros imports
 from config import config
 import jsonb
-from record_mysql import Storage
-from record_mysql.server import escape, execute, select, Select
+from record_mysql import server, Storage
+from record_mysql.server import escape, Select
 import undefined
 
 # Python imports
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Literal
+from typing import Dict, Iterable, List, Literal
 
 # Other records
 from records.admin import contact
@@ -40,8 +41,10 @@ CampaignContact = Storage(
 			'charset': 'utf8mb4',
 			'collate': 'utf8mb4_bin',
 			'create': [
-				'_campaign', '_contact', 'sent', 'delivered', 'opened',
-				'unsubscribed'
+				'_campaign', '_contact', 'position', 'state', 'sent',
+				'delivered', 'opened',
+				'unsubscribed', 'claimed_by', 'claimed_at', 'attempts',
+				'retry_at', 'smtp_code'
 			],
 			'db': config.mysql.db('contact'),
 			'indexes': {
@@ -49,13 +52,52 @@ CampaignContact = Storage(
 					'fields': [ '_campaign', '_contact' ],
 					'type': 'unique'
 				},
-				'i_contact': '_contact'
+				'ui_position': {
+					'fields': 'position',
+					'type': 'unique'
+				},
+				'i_contact': '_contact',
+				'i_campaign_claimed': [ '_campaign', 'claimed_at' ],
+				'i_campaign_queue': [ '_campaign', 'state', 'position' ]
 			},
 			'name': 'admin_campaign_contact'
-		}
+		},
+
+		# Field related
+		'attempts': { '__mysql__': {
+			'opts': 'not null default 0'
+		} },
+		'position': { '__mysql__': {
+			'type': 'bigint unsigned',
+			'opts': 'not null auto_increment'
+		} },
+		'state': { '__mysql__': {
+			'opts': 'not null default \'queued\''
+		} }
 	}
 )
 
+def _ids_condition(ids: str | List[str], host: str) -> str:
+	"""IDs Condition
+
+	Returns the escaped condition to match a single ID or a list of them, \
+	to be placed after the field name in a WHERE clause
+
+	Arguments:
+		ids (str | str[]): The ID or IDs to match
+		host (str): The host to escape for
+
+	Returns:
+		str
+	"""
+
+	# If we got a single ID
+	if isinstance(ids, str):
+		return "= '%s'" % escape(ids, host = host)
+
+	# Else, we got a list
+	return "IN ('%s')" % "','".join([ escape(s, host = host) for s in ids ])
+
 def unsent_by_campaigns(campaign_ids: List[str]) -> Dict[str, int]:
 	"""Unsent by Campaigns
 
@@ -75,30 +117,130 @@ def unsent_by_campaigns(campaign_ids: List[str]) -> Dict[str, int]:
 	# Generate the SQL
 	sSQL = "SELECT `_campaign`, COUNT(`_contact`)\n" \
 			"FROM `%(db)s`.`%(table)s`\n" \
-			"WHERE `_campaign` in ('%(campaigns)s')" % {
+			"WHERE `_campaign` in ('%(campaigns)s')\n" \
+			"AND `state` = 'queued'\n" \
+			"GROUP BY `_campaign`" % {
 		'db': dStruct.db,
 		'table': dStruct.name,
 		'campaigns': '\',\''.join(campaign_ids)
 	}
 
 	# Run the search and return the result
-	return select(
+	return server.select(
 		sSQL,
 		Select.HASH,
 		host = dStruct.host
 	)
 
-def add_contacts_all(campaign_id: str, project_id: str) -> None:
+def _range_condition(
+	field: str,
+	after: str | None,
+	until: str | None,
+	host: str
+) -> str:
+	"""Range Condition
+
+	Returns the escaped conditions, each starting with a newline, to limit \
+	the IDs in the field to after one ID, and up to and including another
+
+	Arguments:
+		field (str): The field, including any table alias
+		after (str | None): The ID the range starts after, None for the start
+		until (str | None): The last ID in the range, None for no end
+		host (str): The host to escape for
+
+	Returns:
+		str
+	"""
+	sRet = ''
+	if after is not None:
+		sRet += "\nAND %s > '%s'" % (field, escape(after, host = host))
+	if until is not None:
+		sRet += "\nAND %s <= '%s'" % (field, escape(until, host = host))
+	return sRet
+
+def audience_bound(
+	project_id: str,
+	category_ids: List[str] | None,
+	after: str | None,
+	count: int
+) -> str | None:
+	"""Audience Bound
+
+	Returns the ID of the `count`th contact after `after`, in order of ID, \
+	that an audience built from the whole project, or from the categories, \
+	would look at. None is returned if there's fewer than that left, meaning \
+	the chunk ending there is the last one
+
+	Arguments:
+		project_id (str): The ID of the project to find contacts in
+		category_ids (str[] | None): The IDs of the categories to find \
+			contacts in, None for every contact in the project
+		after (str | None): The ID of the last contact in the previous chunk, \
+			None to start from the first
+		count (uint): The number of contacts in each chunk
+
+	Returns:
+		str | None
+	"""
+
+	# Get the contact structs
+	dContact = contact.Contact._parent._table._struct
+	dCategories = contact.Contact._parent._complex['categories']._table._struct
+
+	# If we are looking at the whole project
+	if category_ids is None:
+		sSQL = "SELECT `_id`\n" \
+				"FROM `%(db)s`.`%(table)s`\n" \
+				"WHERE `_project` = '%(project)s'%(range)s\n" \
+				"ORDER BY `_id`\n" \
+				"LIMIT 1 OFFSET %(offset)d" % {
+			'db': dContact.db,
+			'table': dContact.name,
+			'project': escape(project_id, host = dContact.host),
+			'range': _range_condition('`_id`', after, None, dContact.host),
+			'offset': count - 1
+		}
+
+	# Else, we are looking at the contacts in the categories
+	else:
+		sSQL = "SELECT DISTINCT `_parent`\n" \
+				"FROM `%(db)s`.`%(table)s`\n" \
+				"WHERE `_value` %(categories)s%(range)s\n" \
+				"ORDER BY `_parent`\n" \
+				"LIMIT 1 OFFSET %(offset)d" % {
+			'db': dCategories.db,
+			'table': dCategories.name,
+			'categories': _ids_condition(category_ids, dCategories.host),
+			'range': _range_condition(
+				'`_parent`', after, None, dCategories.host
+			),
+			'offset': count - 1
+		}
+
+	# Select and return the ID
+	return server.select(sSQL, Select.CELL, host = dContact.host)
+
+def add_contacts_all(
+	campaign_id: str,
+	project_id: str,
+	after: str = None,
+	until: str = None
+) -> int:
 	"""Add Contacts All
 
-	Adds every single contact in the given project's list
+	Adds every single contact in the given project's list, or only the ones \
+	in a range of IDs so large projects can be added in chunks, see \
+	audience_bound()
 
 	Arguments:
 		campaign_id (str): The ID of the campaign to add the contacts
 		project_id (str): The ID of the project to find contacts in
+		after (str): Optional, only add contacts with an ID after this one
+		until (str): Optional, only add contacts with an ID up to this one
 
 	Returns:
-		None
+		uint
 	"""
 
 	# Get the struct
@@ -113,31 +255,39 @@ def add_contacts_all(campaign_id: str, project_id: str) -> None:
 			"SELECT UUID(), '%(campaign)s', `_id`\n" \
 			"FROM `%(cdb)s`.`%(ctable)s`\n" \
 			"WHERE `_project` = '%(project)s'\n" \
-			"AND `unsubscribed` = 0" % {
+			"AND `unsubscribed` = 0%(range)s" % {
 		'db': dStruct.db,
 		'table': dStruct.name,
 		'campaign': campaign_id,
 		'cdb': dContact.db,
 		'ctable': dContact.name,
-		'project': project_id
+		'project': project_id,
+		'range': _range_condition('`_id`', after, until, dStruct.host)
 	}
 
 	# Run the insert and return the number of rows added
-	return execute(sSQL, dStruct.host)
+	return server.execute(sSQL, dStruct.host)
 
 def add_contacts_by_categories(
-	campaign_id: str, category_ids: List[str]
-) -> None:
+	campaign_id: str,
+	category_ids: List[str],
+	after: str = None,
+	until: str = None
+) -> int:
 	"""Add Contacts by Categories
 
-	Adds every single contact found in the given categories' list
+	Adds every single contact found in the given categories' list, or only \
+	the ones in a range of IDs so large categories can be added in chunks, \
+	see audience_bound()
 
 	Arguments:
 		campaign_id (str): The ID of the campaign to add the contacts
 		category_ids (str[]): The IDs of the categories to find contacts in
+		after (str): Optional, only add contacts with an ID after this one
+		until (str): Optional, only add contacts with an ID up to this one
 
 	Returns:
-		None
+		uint
 	"""
 
 	# Get the struct
@@ -155,7 +305,7 @@ def add_contacts_by_categories(
 			"JOIN `%(categories_db)s`.`%(categories_table)s` as `ca`" \
 			" ON `co`.`_id` = `ca`.`_parent`\n" \
 			"WHERE `co`.`unsubscribed` = 0\n" \
-			"AND `ca`.`_value` IN ('%(categories)s')" % {
+			"AND `ca`.`_value` IN ('%(categories)s')%(range)s" % {
 		'db': dStruct.db,
 		'table': dStruct.name,
 		'campaign': campaign_id,
@@ -163,42 +313,190 @@ def add_contacts_by_categories(
 		'contact_table': dContact.name,
 		'categories_db': dCategories.db,
 		'categories_table': dCategories.name,
-		'categories': '\',\''.join(category_ids)
+		'categories': '\',\''.join(category_ids),
+		'range': _range_condition('`co`.`_id`', after, until, dStruct.host)
 	}
 
 	# Run the insert and return the number of rows added
-	return execute(sSQL, dStruct.host)
-
-def add_contacts_list(campaign_id: str, contact_ids: List[str]) -> None:
+	return server.execute(sSQL, dStruct.host)
+
+def add_contacts_list(
+	campaign_id: str,
+	project_id: str,
+	contact_ids: Iterable[str],
+	chunk: int = 1000
+) -> Dict[str, int | List[str]]:
 	"""Add Contacts List
 
-	Adds the contacts passed to the given campaign in a single statement
+	Adds the contacts passed to the given campaign, `chunk` at a time, so \
+	that no statement grows past what the server accepts, and only one \
+	chunk of the IDs is ever turned into SQL at once. Each chunk is checked \
+	against the project's contacts with its own query, and only the ones \
+	found are added
 
 	Arguments:
 		campaign_id (str): The ID of the campaign to add the contacts
-		contact_ids (str[]): A list of contact IDs to add
+		project_id (str): The ID of the project the contacts must be in
+		contact_ids (str[]): A list, or any iterable, of contact IDs to add
+		chunk (uint): Optional, the number of contacts added per statement
 
 	Returns:
-		None
+		A dictionary with the count of contacts 'inserted', the count of \
+		'duplicates' already in the campaign, and the list of IDs 'missing' \
+		from the project
 	"""
 
-	# Get the struct
+	# Get the structs
 	dStruct = CampaignContact._parent._table._struct
+	dContact = contact.Contact._parent._table._struct
 
-	# Generate the insert template
-	sValues = "(UUID(), '%s', '%%s')" % campaign_id
+	# Generate the start of the check
+	sSelect = "SELECT `_id`\n" \
+			"FROM `%(db)s`.`%(table)s`\n" \
+			"WHERE `_project` = '%(project)s'\n" \
+			"AND `_id` " % {
+		'db': dContact.db,
+		'table': dContact.name,
+		'project': escape(project_id, host = dContact.host)
+	}
 
-	# Generate the SQL
-	sSQL = "INSERT IGNORE INTO `%(db)s`.`%(table)s`" \
+	# Generate the start of the insert
+	sInsert = "INSERT IGNORE INTO `%(db)s`.`%(table)s`" \
 			" (`_id`, `_campaign`, `_contact`)\n" \
-			"VALUES %(rows)s" % {
+			"VALUES " % {
+		'db': dStruct.db,
+		'table': dStruct.name
+	}
+
+	# Generate the template for each row
+	sValues = "(UUID(), '%s', '%%s')" % escape(campaign_id, host = dStruct.host)
+
+	# Init the counts
+	dRet = { 'inserted': 0, 'duplicates': 0, 'missing': [] }
+
+	# Go through the IDs a chunk at a time
+	oIDs = iter(contact_ids)
+	while True:
+		lChunk = list(islice(oIDs, chunk))
+		if not lChunk:
+			break
+
+		# Find the ones in the project, and note the rest
+		lFound = server.select(
+			sSelect + _ids_condition(
+				[ str(m) for m in lChunk ], dContact.host
+			),
+			Select.COLUMN,
+			host = dContact.host
+		)
+		sFound = set(lFound)
+		lMissing = [ m for m in lChunk if m not in sFound ]
+		dRet['missing'].extend(lMissing)
+		if not lFound:
+			continue
+
+		# Insert the ones found, anything else was already there, or repeated
+		#	in the list
+		iInserted = server.execute(
+			sInsert + ',\n'.join([
+				sValues % escape(s, host = dStruct.host) for s in lFound
+			]),
+			dStruct.host
+		)
+		dRet['inserted'] += iInserted
+		dRet['duplicates'] += len(lChunk) - len(lMissing) - iInserted
+
+	# Return the counts
+	return dRet
+
+def claim(
+	campaign_id: str,
+	worker: str,
+	count: int = 1,
+	lease: int = 600,
+	after: int = 0
+) -> List[dict]:
+	"""Claim
+
+	Reserves up to `count` undelivered contacts in the campaign for the given \
+	worker and returns every unsent contact the worker currently holds, along \
+	with the contact details, see next_with_contacts(). Rows held by another \
+	worker are skipped unless their lease has expired, in which case the \
+	worker most likely crashed and they are taken over
+
+	Contacts are claimed in the order of their position in the queue, \
+	starting after `after`, so a worker that passes the last position it \
+	claimed walks the queue without ever reading the rows behind it
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		worker (str): The unique name of the worker claiming the contacts
+		count (uint): Optional, the maximum number of contacts to claim
+		lease (uint): Optional, the number of seconds a claim is held before \
+			other workers can take it
+		after (uint): Optional, only claim contacts past this position
+
+	Returns:
+		dict[]
+	"""
+
+	# Get the structs
+	dStruct = CampaignContact._parent._table._struct
+	dContact = contact.Contact._parent._table._struct
+
+	# Generate the values used by the statement
+	dValues = {
 		'db': dStruct.db,
 		'table': dStruct.name,
-		'rows': ',\n'.join([ sValues % s for s in contact_ids ])
+		'contact_db': dContact.db,
+		'contact_table': dContact.name,
+		'campaign': escape(campaign_id, host = dStruct.host),
+		'worker': escape(worker, host = dStruct.host),
+		'lease': lease,
+		'count': count,
+		'after': after
 	}
 
-	# Run the insert and return the number of rows added
-	return execute(sSQL, dStruct.host)
+	# Generate the condition for rows that can be claimed by the worker, rows
+	#	waiting to be retried can't be claimed until it's time
+	sClaimable = "(`cc`.`claimed_by` IS NULL\n" \
+			" OR `cc`.`claimed_by` = '%(worker)s'\n" \
+			" OR `cc`.`claimed_at` < DATE_SUB(NOW(), INTERVAL %(lease)d SECOND))\n" \
+			" AND (`cc`.`retry_at` IS NULL OR `cc`.`retry_at` <= NOW())" % \
+		dValues
+
+	# Mark the rows as ours. Only rows with a contact that can still be sent to
+	#	are picked, so orphaned rows never use up the batch. The rows are
+	#	walked in the order of the campaign / state / position index so sent
+	#	rows are never read. The claim condition is checked again by the outer
+	#	UPDATE which locks the rows it changes, so two workers running the
+	#	same statement at once can never both claim a row
+	sSQL = "UPDATE `%(db)s`.`%(table)s` as `cc` SET\n" \
+			" `cc`.`claimed_by` = '%(worker)s',\n" \
+			" `cc`.`claimed_at` = NOW()\n" \
+			"WHERE `cc`.`_id` IN (\n" \
+			" SELECT `_id` FROM (\n" \
+			"  SELECT `cc`.`_id`\n" \
+			"  FROM `%(db)s`.`%(table)s` as `cc`\n" \
+			"  JOIN `%(contact_db)s`.`%(contact_table)s` as `c`" \
+			" ON `cc`.`_contact` = `c`.`_id`\n" \
+			"  WHERE `cc`.`_campaign` = '%(campaign)s'\n" \
+			"  AND `cc`.`state` = 'queued'\n" \
+			"  AND `cc`.`position` > %(after)d\n" \
+			"  AND `c`.`unsubscribed` = 0\n" \
+			"  AND %(claimable)s\n" \
+			"  ORDER BY `cc`.`position`\n" \
+			"  LIMIT %(count)d\n" \
+			" ) as `t`\n" \
+			")\n" \
+			"AND `cc`.`state` = 'queued'\n" \
+			"AND %(claimable)s" % dict(dValues, claimable = sClaimable)
+
+	# Run the update
+	server.execute(sSQL, dStruct.host)
+
+	# Fetch and return everything we hold
+	return next_with_contacts(campaign_id, worker = worker)
 
 def get_with_contact(_id: str) -> dict | None:
 	"""Get with Contact
@@ -231,15 +529,16 @@ def get_with_contact(_id: str) -> dict | None:
 	}
 
 	# Run the statement return the row
-	return select(sSQL, Select.ROW, host = dStruct.host)
+	return server.select(sSQL, Select.ROW, host = dStruct.host)
 
-def next(campaign_id: str) -> dict | Literal[False]:
+def next(campaign_id: str, after: int = 0) -> dict | Literal[False]:
 	"""Next
 
 	Returns the next contact in the campaign that can be delivered
 
 	Arguments:
 		campaign_id (str): The ID of the campaign
+		after (uint): Optional, the position in the queue to start after
 
 	Returns:
 		dict
@@ -249,19 +548,77 @@ def next(campaign_id: str) -> dict | Literal[False]:
 	dStruct = CampaignContact._parent._table._struct
 
 	# Generate the SQL
-	sSQL = "SELECT `_id`, `_contact`\n" \
+	sSQL = "SELECT `_id`, `_contact`, `position`\n" \
 		 	"FROM `%(db)s`.`%(table)s`\n" \
 			"WHERE `_campaign` = '%(campaign)s'\n" \
-			"AND `sent` IS NULL\n" \
-			"AND `unsubscribed` IS NULL\n" \
+			"AND `state` = 'queued'\n" \
+			"AND `position` > %(after)d\n" \
+			"ORDER BY `position`\n" \
 			"LIMIT 1" % {
 		'db': dStruct.db,
 		'table': dStruct.name,
-		'campaign': campaign_id
+		'campaign': escape(campaign_id, host = dStruct.host),
+		'after': after
 	}
 
 	# Select the statement and return the result
-	return select(sSQL, Select.ROW, host = dStruct.host)
+	return server.select(sSQL, Select.ROW, host = dStruct.host)
+
+def next_with_contacts(
+	campaign_id: str,
+	count: int = undefined,
+	worker: str = undefined
+) -> List[dict]:
+	"""Next with Contacts
+
+	Returns the next contacts in the campaign that can be delivered, along \
+	with the contact's name, alias, company, and email address. Rows whose \
+	contact no longer exists or has unsubscribed are skipped
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		count (uint): Optional, the maximum number of rows to return
+		worker (str): Optional, only return rows claimed by this worker
+
+	Returns:
+		dict[]
+	"""
+
+	# Get the structs
+	dStruct = CampaignContact._parent._table._struct
+	dContact = contact.Contact._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "SELECT `cc`.`_id`, `cc`.`_contact`, `cc`.`position`,\n" \
+			"  `cc`.`attempts`, `c`.`name`, `c`.`alias`, `c`.`company`,\n" \
+			"  `c`.`email_address`\n" \
+			"FROM `%(db)s`.`%(table)s` as `cc`\n" \
+			"JOIN `%(contact_db)s`.`%(contact_table)s` as `c`" \
+			" ON `cc`.`_contact` = `c`.`_id`\n" \
+			"WHERE `cc`.`_campaign` = '%(campaign)s'\n" \
+			"AND `cc`.`state` = 'queued'\n" \
+			"AND `c`.`unsubscribed` = 0" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'contact_db': dContact.db,
+		'contact_table': dContact.name,
+		'campaign': escape(campaign_id, host = dStruct.host)
+	}
+
+	# If we only want rows claimed by a specific worker
+	if worker is not undefined:
+		sSQL += "\nAND `cc`.`claimed_by` = '%s'" % \
+			escape(worker, host = dStruct.host)
+
+	# Keep the order of the queue
+	sSQL += "\nORDER BY `cc`.`position`"
+
+	# If we have a limit
+	if count is not undefined:
+		sSQL += "\nLIMIT %d" % count
+
+	# Select and return the rows
+	return server.select(sSQL, Select.ALL, host = dStruct.host)
 
 def opened(_id: str, contact_id: str = undefined) -> bool:
 	"""Opened
@@ -288,16 +645,195 @@ def opened(_id: str, contact_id: str = undefined) -> bool:
 	}
 
 	# Run the SQL and return the result
-	return execute(sSQL, host = dStruct.host) and True or False
+	return server.execute(sSQL, host = dStruct.host) and True or False
 
-def sent_and_delivered(_id: str) -> bool:
-	"""Sent
+def page(
+	campaign_id: str,
+	after: str | None = None,
+	count: int = 1000
+) -> List[dict]:
+	"""Page
 
-	Marks the campaign contact as being sent the message, it most likely was \
-	not delivered
+	Returns the results of the next `count` contacts in the campaign after \
+	the given contact ID, in order of contact ID, so that every result can \
+	be read a page at a time along the campaign / contact index
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		after (str | None): The contact ID of the last row of the previous \
+			page, None for the first page
+		count (uint): Optional, the most rows to return
+
+	Returns:
+		dict[]
+	"""
+
+	# Get the structs
+	dStruct = CampaignContact._parent._table._struct
+	dContact = contact.Contact._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "SELECT `cc`.`_contact`, `c`.`email_address`, `c`.`name`,\n" \
+			"  `cc`.`state`, `cc`.`sent`, `cc`.`delivered`, `cc`.`opened`,\n" \
+			"  `cc`.`unsubscribed`, `cc`.`attempts`, `cc`.`smtp_code`\n" \
+			"FROM `%(db)s`.`%(table)s` as `cc`\n" \
+			"LEFT JOIN `%(contact_db)s`.`%(contact_table)s` as `c`" \
+			" ON `cc`.`_contact` = `c`.`_id`\n" \
+			"WHERE `cc`.`_campaign` = '%(campaign)s'%(after)s\n" \
+			"ORDER BY `cc`.`_contact`\n" \
+			"LIMIT %(count)d" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'contact_db': dContact.db,
+		'contact_table': dContact.name,
+		'campaign': escape(campaign_id, host = dStruct.host),
+		'after': _range_condition('`cc`.`_contact`', after, None, dStruct.host),
+		'count': count
+	}
+
+	# Select and return the rows
+	return server.select(sSQL, Select.ALL, host = dStruct.host)
+
+def purge(campaign_id: str) -> Dict[str, int]:
+	"""Purge
+
+	Deletes every unsent contact in the campaign whose contact no longer \
+	exists, or has unsubscribed since being added, so the campaign doesn't \
+	have to skip them one at a time while sending
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+
+	Returns:
+		A dictionary with the count of 'orphaned' and 'unsubscribed' rows \
+		removed
+	"""
+
+	# Get the structs
+	dStruct = CampaignContact._parent._table._struct
+	dContact = contact.Contact._parent._table._struct
+
+	# Generate the values used by both statements
+	dValues = {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'contact_db': dContact.db,
+		'contact_table': dContact.name,
+		'campaign': escape(campaign_id, host = dStruct.host)
+	}
+
+	# Generate the SQL to delete the rows with no contact
+	sOrphaned = "DELETE `cc`\n" \
+			"FROM `%(db)s`.`%(table)s` as `cc`\n" \
+			"LEFT JOIN `%(contact_db)s`.`%(contact_table)s` as `c`" \
+			" ON `cc`.`_contact` = `c`.`_id`\n" \
+			"WHERE `cc`.`_campaign` = '%(campaign)s'\n" \
+			"AND `cc`.`state` = 'queued'\n" \
+			"AND `c`.`_id` IS NULL" % dValues
+
+	# Generate the SQL to delete the rows with an unsubscribed contact
+	sUnsubscribed = "DELETE `cc`\n" \
+			"FROM `%(db)s`.`%(table)s` as `cc`\n" \
+			"JOIN `%(contact_db)s`.`%(contact_table)s` as `c`" \
+			" ON `cc`.`_contact` = `c`.`_id`\n" \
+			"WHERE `cc`.`_campaign` = '%(campaign)s'\n" \
+			"AND `cc`.`state` = 'queued'\n" \
+			"AND `c`.`unsubscribed` = 1" % dValues
+
+	# Run each and return the counts
+	return {
+		'orphaned': server.execute(sOrphaned, host = dStruct.host),
+		'unsubscribed': server.execute(sUnsubscribed, host = dStruct.host)
+	}
+
+def release(worker: str, ids: List[str] = undefined) -> int:
+	"""Release
+
+	Gives up the claim on unsent contacts held by the worker so that other \
+	workers can pick them up immediately instead of waiting on the lease
+
+	Arguments:
+		worker (str): The unique name of the worker releasing the contacts
+		ids (str[]): Optional, the campaign contact IDs to release, if not \
+			set, every unsent contact held by the worker is released
+
+	Returns:
+		uint
+	"""
+
+	# Get the struct
+	dStruct = CampaignContact._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `claimed_by` = NULL,\n" \
+			" `claimed_at` = NULL\n" \
+			"WHERE `claimed_by` = '%(worker)s'\n" \
+			"AND `state` = 'queued'" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'worker': escape(worker, host = dStruct.host)
+	}
+
+	# If we got specific IDs
+	if ids is not undefined:
+
+		# If there's none, there's nothing to do
+		if not ids:
+			return 0
+
+		# Add them to the statement
+		sSQL += "\nAND `_id` %s" % _ids_condition(ids, dStruct.host)
+
+	# Run the SQL and return the number of rows released
+	return server.execute(sSQL, host = dStruct.host)
+
+def remove_campaign(campaign_id: str, chunk: int = 1000) -> int:
+	"""Remove Campaign
+
+	Deletes every contact in the campaign, `chunk` rows at a time so that no \
+	single statement holds its locks for long
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		chunk (uint): Optional, the most rows deleted per statement
+
+	Returns:
+		uint, the number of rows deleted
+	"""
+
+	# Get the struct
+	dStruct = CampaignContact._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "DELETE FROM `%(db)s`.`%(table)s`\n" \
+			"WHERE `_campaign` = '%(campaign)s'\n" \
+			"LIMIT %(chunk)d" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'campaign': escape(campaign_id, host = dStruct.host),
+		'chunk': chunk
+	}
+
+	# Keep deleting until there's nothing left
+	iCount = 0
+	while True:
+		iDeleted = server.execute(sSQL, host = dStruct.host)
+		iCount += iDeleted
+		if iDeleted < chunk:
+			return iCount
+
+def retry(_id: str, retry_at: int, smtp_code: int = None) -> bool:
+	"""Retry
+
+	Marks the campaign contact as failing temporarily, adding to its \
+	attempts, and releases it so that it can be claimed again once the time \
+	to retry it comes
 
 	Arguments:
 		_id (str): The campaign contact ID
+		retry_at (uint): The timestamp to try again at
+		smtp_code (uint): Optional, the SMTP code of the failure
 
 	Returns:
 		bool
@@ -308,24 +844,114 @@ def sent_and_delivered(_id: str) -> bool:
 
 	# Generate the SQL to mark it as such
 	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
-			" `sent` = NOW()\n" \
+			" `attempts` = `attempts` + 1,\n" \
+			" `retry_at` = FROM_UNIXTIME(%(retry_at)d),\n" \
+			" `smtp_code` = %(code)s,\n" \
+			" `claimed_by` = NULL,\n" \
+			" `claimed_at` = NULL\n" \
 			"WHERE `_id` = '%(_id)s'" % {
 		'db': dStruct.db,
 		'table': dStruct.name,
+		'retry_at': retry_at,
+		'code': smtp_code is None and 'NULL' or '%d' % smtp_code,
 		'_id': escape(_id, host = dStruct.host)
 	}
 
 	# Run the SQL and return the result
-	return execute(sSQL, host = dStruct.host) and True or False
+	return server.execute(sSQL, host = dStruct.host) and True or False
+
+def retry_next(
+	campaign_id: str,
+	worker: str,
+	lease: int = 600
+) -> int | None:
+	"""Retry Next
+
+	Returns the timestamp of the earliest campaign contact waiting to be \
+	retried, or None if there are none. Only rows claim() could take once \
+	they are due are counted, the contact must still be subscribed and the \
+	row can't be under another worker's lease. Rows already due are left \
+	out, if claim() didn't take them there's nothing to wait for
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+		worker (str): The unique name of the worker asking
+		lease (uint): Optional, the number of seconds a claim is held before \
+			other workers can take it
+
+	Returns:
+		uint | None
+	"""
+
+	# Get the structs
+	dStruct = CampaignContact._parent._table._struct
+	dContact = contact.Contact._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "SELECT UNIX_TIMESTAMP(MIN(`cc`.`retry_at`))\n" \
+			"FROM `%(db)s`.`%(table)s` as `cc`\n" \
+			"JOIN `%(contact_db)s`.`%(contact_table)s` as `c`" \
+			" ON `cc`.`_contact` = `c`.`_id`\n" \
+			"WHERE `cc`.`_campaign` = '%(campaign)s'\n" \
+			"AND `cc`.`state` = 'queued'\n" \
+			"AND `cc`.`retry_at` > NOW()\n" \
+			"AND `c`.`unsubscribed` = 0\n" \
+			"AND (`cc`.`claimed_by` IS NULL\n" \
+			" OR `cc`.`claimed_by` = '%(worker)s'\n" \
+			" OR `cc`.`claimed_at` < DATE_SUB(NOW(), INTERVAL %(lease)d SECOND))" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'contact_db': dContact.db,
+		'contact_table': dContact.name,
+		'campaign': escape(campaign_id, host = dStruct.host),
+		'worker': escape(worker, host = dStruct.host),
+		'lease': lease
+	}
+
+	# Select the timestamp and return it
+	mRes = server.select(sSQL, Select.CELL, host = dStruct.host)
+	return mRes is not None and int(mRes) or None
+
+def sent(_id: str | List[str], smtp_code: int = None) -> bool:
+	"""Sent
+
+	Marks the campaign contact(s) as being sent the message, it most likely \
+	was not delivered
+
+	Arguments:
+		_id (str | str[]): The campaign contact ID, or a list of IDs
+		smtp_code (uint): Optional, the SMTP code the message failed with
+
+	Returns:
+		bool
+	"""
+
+	# Get the structs
+	dStruct = CampaignContact._parent._table._struct
+
+	# Generate the SQL to mark it as such
+	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `state` = 'sent',\n" \
+			" `sent` = NOW(),\n" \
+			" `smtp_code` = %(code)s\n" \
+			"WHERE `_id` %(_id)s" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'code': smtp_code is None and 'NULL' or '%d' % smtp_code,
+		'_id': _ids_condition(_id, dStruct.host)
+	}
+
+	# Run the SQL and return the result
+	return server.execute(sSQL, host = dStruct.host) and True or False
 
-def sent_and_delivered(_id: str) -> bool:
+def sent_and_delivered(_id: str | List[str]) -> bool:
 	"""Sent and Delivered
 
-	Marks the campaign contact as being sent the message, and that it was \
+	Marks the campaign contact(s) as being sent the message, and that it was \
 	delivered, at least so far as the SMTP server is concerned
 
 	Arguments:
-		_id (str): The campaign contact ID
+		_id (str | str[]): The campaign contact ID, or a list of IDs
 
 	Returns:
 		bool
@@ -336,16 +962,17 @@ def sent_and_delivered(_id: str) -> bool:
 
 	# Generate the SQL to mark it as such
 	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `state` = 'sent',\n" \
 			" `sent` = NOW(),\n" \
 			" `delivered` = NOW()\n" \
-			"WHERE `_id` = '%(_id)s'" % {
+			"WHERE `_id` %(_id)s" % {
 		'db': dStruct.db,
 		'table': dStruct.name,
-		'_id': escape(_id, host = dStruct.host)
+		'_id': _ids_condition(_id, dStruct.host)
 	}
 
 	# Run the SQL and return the result
-	return execute(sSQL, host = dStruct.host) and True or False
+	return server.execute(sSQL, host = dStruct.host) and True or False
 
 def unsubscribe(_id: str, contact_id: str = undefined) -> bool:
 	"""Unsubscribe
@@ -363,8 +990,10 @@ def unsubscribe(_id: str, contact_id: str = undefined) -> bool:
 	# Get the structs
 	dStruct = CampaignContact._parent._table._struct
 
-	# Generate the SQL to mark it as such
+	# Generate the SQL to mark it as such, if it hadn't been sent yet it also
+	#	leaves the queue
 	sSQL = "UPDATE `%(db)s`.`%(table)s` SET\n" \
+			" `state` = IF(`state` = 'queued', 'unsubscribed', `state`),\n" \
 			" `unsubscribed` = NOW()\n" \
 			"WHERE `_id` = '%(_id)s'" % {
 		'db': dStruct.db,
@@ -376,10 +1005,10 @@ def unsubscribe(_id: str, contact_id: str = undefined) -> bool:
 	if contact_id is undefined or contact_id is None:
 
 		# Run the SQL and return the result
-		return execute(sSQL, host = dStruct.host) and True or False
+		return server.execute(sSQL, host = dStruct.host) and True or False
 
 	# Generate the contact unsubscribe SQL and make a list of the two
 	lSQL = [ sSQL, contact.unsubscribe(contact_id, return_sql = True) ]
 
 	# Execute the statements and return the result
-	return execute(lSQL, host = dStruct.host) and True or False
\ No newline at end of file
+	return server.execute(lSQL, host = dStruct.host) and True or False
\ No newline at end of file
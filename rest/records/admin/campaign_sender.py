@@ -0,0 +1,116 @@
+# coding=utf8
+""" Admin Campaign Sender Record
+
+Handles the campaign sender record structure
+"""
+
+__author__		= "Chris Nasr"
+__version__		= "1.0.0"
+__maintainer__	= "Chris Nasr"
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-16"
+
+# Ouroboros imports
+from config import config
+import jsonb
+from record_mysql import server, Storage
+from record_mysql.server import escape
+
+# Python imports
+from pathlib import Path
+from typing import Dict, List, Literal, Tuple
+
+# Create the Storage instance
+CampaignSender = Storage(
+
+	# The primary definition
+	jsonb.load(
+		'%s/definitions/admin/campaign_sender.json' % \
+			Path(__file__).parent.parent.parent.resolve()
+	),
+
+	# The extensions necessary to store the data and revisions in MySQL
+	{
+		# Table related
+		'__mysql__': {
+			'charset': 'utf8mb4',
+			'collate': 'utf8mb4_bin',
+			'create': [ '_campaign', '_sender', 'weight' ],
+			'db': config.mysql.db('contact'),
+			'indexes': {
+				'ui_campaign_sender': {
+					'fields': [ '_campaign', '_sender' ],
+					'type': 'unique'
+				},
+				'i_sender': '_sender'
+			},
+			'name': 'admin_campaign_sender'
+		}
+	}
+)
+
+def by_campaigns(
+	campaigns: List[dict]
+) -> Dict[str, List[Tuple[str, int]]]:
+	"""By Campaigns
+
+	Returns the full pool of senders for each campaign, its primary \
+	`_sender` first, followed by any additional ones, each with its weight
+
+	Arguments:
+		campaigns (dict[]): The campaign records, must include `_id` and \
+			`_sender`
+
+	Returns:
+		dict of campaign _id to (sender _id, weight)[]
+	"""
+
+	# Start each pool with the primary sender
+	dPools = {
+		d['_id']: [ ( d['_sender'], 1 ) ] for d in campaigns
+	}
+
+	# If there's no campaigns, there's nothing to add
+	if not dPools:
+		return dPools
+
+	# Fetch the additional senders and add them
+	for d in CampaignSender.filter(
+		{ '_campaign': list(dPools.keys()) },
+		raw = [ '_campaign', '_sender', 'weight' ]
+	):
+		lPool = dPools[d['_campaign']]
+		if d['_sender'] != lPool[0][0]:
+			lPool.append(( d['_sender'], d['weight'] or 1 ))
+
+	# Return the pools
+	return dPools
+
+def remove_by(field: Literal['_campaign', '_sender'], _id: str) -> int:
+	"""Remove By
+
+	Deletes every additional sender of a campaign, or every use of a sender \
+	in any campaign
+
+	Arguments:
+		field ('_campaign' | '_sender'): The field to match
+		_id (str): The ID of the campaign or the sender
+
+	Returns:
+		uint, the number of rows deleted
+	"""
+
+	# Get the struct
+	dStruct = CampaignSender._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "DELETE FROM `%(db)s`.`%(table)s`\n" \
+			"WHERE `%(field)s` = '%(_id)s'" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'field': field,
+		'_id': escape(_id, host = dStruct.host)
+	}
+
+	# Run it and return the count
+	return server.execute(sSQL, host = dStruct.host)
@@ -13,11 +13,16 @@ __created__		= "2024-01-11"
 # Ouroboros imports
 from config import config
 import jsonb
-from record_mysql import Storage
-from record_mysql.server import escape, execute
+from nredis import nr
+from record_mysql import server, Storage
+from record_mysql.server import escape, Select
 
 # Python imports
 from pathlib import Path
+from typing import Dict, List
+
+# Shared imports
+from shared import log
 
 # Create the Storage instance
 Contact = Storage(
@@ -44,7 +49,8 @@ Contact = Storage(
 					'fields': [ '_project', 'email_address' ],
 					'type': 'unique'
 				},
-				'i_project': '_project'
+				'i_project': '_project',
+				'i_project_name': [ '_project', 'name' ]
 			},
 			'name': 'admin_contact',
 			'revisions': [ 'user' ]
@@ -77,6 +83,425 @@ Contact = Storage(
 	}
 )
 
+FIELDS = [
+	'_id', '_created', '_updated', '_project', 'unsubscribed',
+	'email_address', 'name', 'alias', 'company', 'categories'
+]
+"""The fields that can be requested by search()"""
+
+COUNT_KEY = 'contact:count:%s'
+"""The Redis hash of the cached counts of a project's contacts"""
+
+_count = config.contacts.count({
+	'redis': None,
+	'ttl': 300
+})
+"""Where, and for how long, the counts of contacts are cached"""
+
+_log = log.get('records.contact')
+"""The logger for the contact records"""
+
+def _categories(ids: List[str], host: str) -> Dict[str, List[str]]:
+	"""Categories
+
+	Returns the category IDs of each contact, in order, with a single query
+
+	Arguments:
+		ids (str[]): The IDs of the contacts
+		host (str): The host to run the query on
+
+	Returns:
+		dict
+	"""
+
+	# Get the struct
+	dCategories = Contact._parent._complex['categories']._table._struct
+
+	# Fetch the categories of every contact
+	dRet = {}
+	for d in server.select(
+		"SELECT `_parent`, `_value`\n" \
+		"FROM `%(db)s`.`%(table)s`\n" \
+		"WHERE `_parent` IN (%(ids)s)\n" \
+		"ORDER BY `_parent`, `_a_0`" % {
+			'db': dCategories.db,
+			'table': dCategories.name,
+			'ids': ','.join([ _value(s, host) for s in ids ])
+		},
+		Select.ALL,
+		host = host
+	):
+		dRet.setdefault(d['_parent'], []).append(d['_value'])
+
+	# Return the categories
+	return dRet
+
+def _categories_condition(categories: List[str] | None, host: str) -> str:
+	"""Categories Condition
+
+	Returns the condition, starting with a newline, that only matches \
+	contacts, aliased as `c`, in at least one of the categories, or nothing \
+	if there are no categories
+
+	Arguments:
+		categories (str[] | None): The IDs of the categories
+		host (str): The host to escape for
+
+	Returns:
+		str
+	"""
+
+	# If there's none, there's no condition
+	if not categories:
+		return ''
+
+	# Get the struct
+	dCategories = Contact._parent._complex['categories']._table._struct
+
+	# Generate and return the condition
+	return "\nAND EXISTS (\n" \
+			" SELECT 1 FROM `%(db)s`.`%(table)s` as `ca`\n" \
+			" WHERE `ca`.`_parent` = `c`.`_id`\n" \
+			" AND `ca`.`_value` IN (%(categories)s)\n" \
+			")" % {
+		'db': dCategories.db,
+		'table': dCategories.name,
+		'categories': ','.join([ _value(s, host) for s in categories ])
+	}
+
+def _value(value: str | None, host: str) -> str:
+	"""Value
+
+	Returns the value escaped and quoted for an INSERT, or NULL
+
+	Arguments:
+		value (str | None): The value
+		host (str): The host to escape for
+
+	Returns:
+		str
+	"""
+	if value is None:
+		return 'NULL'
+	return "'%s'" % escape(value, host = host)
+
+def add_many(records: List[dict], revision_info: dict) -> int:
+	"""Add Many
+
+	Adds already validated contacts, their categories, and their first \
+	revision, each with a single multi-row insert run in one transaction
+
+	Arguments:
+		records (dict[]): The contacts, each with its _id and _project
+		revision_info (dict): The additional info stored with each revision
+
+	Returns:
+		uint, the number of contacts added
+	"""
+
+	# If there's none, there's nothing to do
+	if not records:
+		return 0
+
+	# Get the structs
+	dStruct = Contact._parent._table._struct
+	dCategories = Contact._parent._complex['categories']._table._struct
+
+	# Generate the contacts
+	lSQL = [
+		"INSERT INTO `%(db)s`.`%(table)s`" \
+		" (`_id`, `_project`, `unsubscribed`, `email_address`, `name`," \
+		" `alias`, `company`)\n" \
+		"VALUES %(rows)s" % {
+			'db': dStruct.db,
+			'table': dStruct.name,
+			'rows': ',\n'.join([
+				"(%s, %s, 0, %s, %s, %s, %s)" % tuple([
+					_value(d[f], dStruct.host) for f in [
+						'_id', '_project', 'email_address', 'name'
+					]
+				] + [
+					_value(d.get('alias'), dStruct.host),
+					_value(d['company'], dStruct.host)
+				]) for d in records
+			])
+		}
+	]
+
+	# Generate the categories, if there are any
+	lCategories = [
+		'(%s, %d, %s)' % (
+			_value(d['_id'], dStruct.host), i, _value(s, dStruct.host)
+		)
+		for d in records
+		for i, s in enumerate(d.get('categories') or [])
+	]
+	if lCategories:
+		lSQL.append(
+			"INSERT INTO `%(db)s`.`%(table)s` (`_parent`, `_a_0`, `_value`)\n" \
+			"VALUES %(rows)s" % {
+				'db': dCategories.db,
+				'table': dCategories.name,
+				'rows': ',\n'.join(lCategories)
+			}
+		)
+
+	# Generate the revisions, the same ones Contact.add() would
+	lSQL.append(
+		"INSERT INTO `%(db)s`.`%(table)s_revisions` (`_id`, `created`, `items`)\n" \
+		"VALUES %(rows)s" % {
+			'db': dStruct.db,
+			'table': dStruct.name,
+			'rows': ',\n'.join([
+				'(%s, CURRENT_TIMESTAMP, %s)' % (
+					_value(d['_id'], dStruct.host),
+					_value(jsonb.encode(
+						dict(revision_info, old = None, new = d)
+					), dStruct.host)
+				) for d in records
+			])
+		}
+	)
+
+	# Run the statements together
+	server.execute(lSQL, host = dStruct.host)
+
+	# The project's counts are out of date
+	count_clear(records[0]['_project'])
+
+	# Return the count added
+	return len(records)
+
+def by_emails(project_id: str, emails: List[str]) -> Dict[str, bool]:
+	"""By E-mails
+
+	Returns which of the e-mail addresses are already used by a contact in \
+	the project, and whether that contact has unsubscribed
+
+	Arguments:
+		project_id (str): The ID of the project
+		emails (str[]): The e-mail addresses to look for
+
+	Returns:
+		A dictionary of the unsubscribed flag mapped to the lowercase e-mail \
+		addresses found
+	"""
+
+	# If there's none, there's nothing to look for
+	if not emails:
+		return {}
+
+	# Get the struct
+	dStruct = Contact._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "SELECT `email_address`, `unsubscribed`\n" \
+			"FROM `%(db)s`.`%(table)s`\n" \
+			"WHERE `_project` = '%(project)s'\n" \
+			"AND `email_address` IN (%(emails)s)" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'project': escape(project_id, host = dStruct.host),
+		'emails': ','.join([ _value(s, dStruct.host) for s in emails ])
+	}
+
+	# Select the rows and return them by lowercase address
+	return {
+		d['email_address'].lower(): d['unsubscribed'] and True or False
+		for d in server.select(sSQL, Select.ALL, host = dStruct.host)
+	}
+
+def count(project_id: str, categories: List[str] = None) -> int:
+	"""Count
+
+	Returns the number of contacts in the project, or in the project and at \
+	least one of the categories. If set, counts are cached in Redis until \
+	they expire or the project's contacts change
+
+	Arguments:
+		project_id (str): The ID of the project
+		categories (str[]): Optional, the IDs of the categories
+
+	Returns:
+		uint
+	"""
+
+	# If we have a cache, look for the count in it
+	sKey = COUNT_KEY % project_id
+	sField = categories and ','.join(sorted(categories)) or '*'
+	if _count['redis']:
+		oRedis = nr(_count['redis'])
+		mCount = oRedis.hget(sKey, sField)
+		if mCount is not None:
+			return int(mCount)
+
+	# Get the struct
+	dStruct = Contact._parent._table._struct
+
+	# Count the contacts
+	iCount = int(server.select(
+		"SELECT COUNT(*)\n" \
+		"FROM `%(db)s`.`%(table)s` as `c`\n" \
+		"WHERE `c`.`_project` = '%(project)s'%(categories)s" % {
+			'db': dStruct.db,
+			'table': dStruct.name,
+			'project': escape(project_id, host = dStruct.host),
+			'categories': _categories_condition(categories, dStruct.host)
+		},
+		Select.CELL,
+		host = dStruct.host
+	))
+
+	# If we have a cache, store the count in it
+	if _count['redis']:
+		oRedis.hset(sKey, sField, iCount)
+		oRedis.expire(sKey, _count['ttl'])
+
+	# Return the count
+	return iCount
+
+def count_clear(project_id: str) -> None:
+	"""Count Clear
+
+	Removes the cached counts of the project's contacts, called whenever \
+	contacts are added, removed, or change categories
+
+	Arguments:
+		project_id (str): The ID of the project
+
+	Returns:
+		None
+	"""
+	if _count['redis']:
+		nr(_count['redis']).delete(COUNT_KEY % project_id)
+
+def page(
+	project_id: str,
+	after: str | None = None,
+	count: int = 1000
+) -> List[dict]:
+	"""Page
+
+	Returns the next `count` contacts in the project after the given ID, in \
+	order of ID, each with the IDs of its categories, so that every contact \
+	can be read a page at a time without the cost of an offset
+
+	Arguments:
+		project_id (str): The ID of the project
+		after (str | None): The ID of the last contact of the previous page, \
+			None for the first page
+		count (uint): Optional, the most contacts to return
+
+	Returns:
+		dict[]
+	"""
+
+	# Get the struct
+	dStruct = Contact._parent._table._struct
+
+	# Generate the SQL
+	sSQL = "SELECT `_id`, `_created`, `_updated`, `unsubscribed`,\n" \
+			"  `email_address`, `name`, `alias`, `company`\n" \
+			"FROM `%(db)s`.`%(table)s`\n" \
+			"WHERE `_project` = '%(project)s'%(after)s\n" \
+			"ORDER BY `_id`\n" \
+			"LIMIT %(count)d" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'project': escape(project_id, host = dStruct.host),
+		'after': after is not None and \
+			"\nAND `_id` > '%s'" % escape(after, host = dStruct.host) or '',
+		'count': count
+	}
+
+	# Fetch the contacts
+	lContacts = server.select(sSQL, Select.ALL, host = dStruct.host)
+	if not lContacts:
+		return lContacts
+
+	# Fetch the categories of every contact in the page
+	dCats = _categories([ d['_id'] for d in lContacts ], dStruct.host)
+
+	# Add them to the contacts and return the page
+	for d in lContacts:
+		d['unsubscribed'] = d['unsubscribed'] and True or False
+		d['categories'] = dCats.get(d['_id'], [])
+	return lContacts
+
+def search(
+	project_id: str,
+	categories: List[str] = None,
+	after: List[str] = None,
+	count: int = 100,
+	fields: List[str] = None
+) -> List[dict]:
+	"""Search
+
+	Returns the next `count` contacts in the project, optionally only those \
+	in at least one of the categories, in order of name, then ID. Pages are \
+	fetched by passing the name and ID of the last contact of the previous \
+	page, which walks the project / name index instead of skipping rows
+
+	Arguments:
+		project_id (str): The ID of the project
+		categories (str[]): Optional, the IDs of the categories
+		after (str[]): Optional, the name and ID of the last contact of the \
+			previous page
+		count (uint): Optional, the most contacts to return
+		fields (str[]): Optional, the fields to return, see FIELDS, the _id \
+			and name are always returned
+
+	Returns:
+		dict[]
+	"""
+
+	# Get the struct
+	dStruct = Contact._parent._table._struct
+
+	# Get the fields, the ID and name are needed for the next page
+	lFields = [
+		f for f in (fields or FIELDS)
+		if f not in [ '_id', 'name', 'categories' ]
+	]
+	bCategories = not fields or 'categories' in fields
+
+	# Generate the SQL
+	sSQL = "SELECT `c`.`_id`, `c`.`name`%(fields)s\n" \
+			"FROM `%(db)s`.`%(table)s` as `c`\n" \
+			"WHERE `c`.`_project` = '%(project)s'%(categories)s%(after)s\n" \
+			"ORDER BY `c`.`name`, `c`.`_id`\n" \
+			"LIMIT %(count)d" % {
+		'db': dStruct.db,
+		'table': dStruct.name,
+		'fields': ''.join([ ', `c`.`%s`' % f for f in lFields ]),
+		'project': escape(project_id, host = dStruct.host),
+		'categories': _categories_condition(categories, dStruct.host),
+		'after': after and \
+			"\nAND (`c`.`name` > %(name)s OR" \
+			" (`c`.`name` = %(name)s AND `c`.`_id` > %(_id)s))" % {
+				'name': _value(after[0], dStruct.host),
+				'_id': _value(after[1], dStruct.host)
+			} or '',
+		'count': count
+	}
+
+	# Fetch the contacts
+	lContacts = server.select(sSQL, Select.ALL, host = dStruct.host)
+
+	# Make the flags bools
+	if 'unsubscribed' in lFields:
+		for d in lContacts:
+			d['unsubscribed'] = d['unsubscribed'] and True or False
+
+	# If we need the categories, add them
+	if bCategories and lContacts:
+		dCats = _categories([ d['_id'] for d in lContacts ], dStruct.host)
+		for d in lContacts:
+			d['categories'] = dCats.get(d['_id'], [])
+
+	# Return the contacts
+	return lContacts
+
 def unsubscribe(_id: str, return_sql: bool = False) -> bool | str:
 	"""Unsubscribe
 
@@ -105,11 +530,11 @@ def unsubscribe(_id: str, return_sql: bool = False) -> bool | str:
 		'_id': escape(_id, host = dStruct.host)
 	}
 
-	print(sSQL)
+	_log.debug('unsubscribe', extra = { 'data': { 'sql': sSQL } })
 
 	# If we want to return the SQL
 	if return_sql:
 		return sSQL
 
 	# Else, run the statement and return the result
-	return execute(sSQL, host = dStruct.host) and True or False
\ No newline at end of file
+	return server.execute(sSQL, host = dStruct.host) and True or False
\ No newline at end of file
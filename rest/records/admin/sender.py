@@ -35,7 +35,8 @@ Sender = Storage(
 			'collate': 'utf8mb4_unicode_ci',
 			'create': [
 				'_created', '_updated', '_project', 'email_address', 'password',
-				'host', 'port', 'tls'
+				'host', 'port', 'tls', 'rate', 'burst', 'timeout_connect',
+				'timeout_command', 'timeout_data'
 			],
 			'db': config.mysql.db('contact'),
 			'indexes': {
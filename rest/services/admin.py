@@ -11,9 +11,9 @@ __created__		= "2024-01-07"
 
 # Ouroboros imports
 from body import Error, errors, Response, Service
+from config import config
 from jobject import jobject
 from record.exceptions import RecordDuplicate
-from record_mysql import Literal as MySQL_Literal
 from tools import evaluate, without
 import undefined
 
@@ -22,7 +22,11 @@ from operator import itemgetter
 
 # Import records
 from records.admin import \
-	campaign, campaign_contact, category, contact, project, sender
+	campaign, campaign_contact, campaign_sender, category, contact, project, \
+	sender
+
+# Import shared
+from shared import breaker, scheduler, templates
 
 # Import errors
 from shared.errors import \
@@ -32,6 +36,25 @@ from shared.errors import \
 
 REPLACE_ME = '00000000-0000-0000-0000-000000000000'
 
+def _campaign_undo(campaign_id: str) -> None:
+	"""Campaign Undo
+
+	Removes a campaign that couldn't be completely created, along with any \
+	senders and contacts already added to it
+
+	Arguments:
+		campaign_id (str): The ID of the campaign
+
+	Returns:
+		None
+	"""
+	campaign_contact.remove_campaign(campaign_id)
+	campaign_sender.remove_by('_campaign', campaign_id)
+	campaign.Campaign.remove(
+		campaign_id,
+		revision_info = { 'user': REPLACE_ME }
+	)
+
 class Admin(Service):
 	"""Admin Service class
 
@@ -105,6 +128,18 @@ class Admin(Service):
 				[ 'records.max_interval', 'must be larger than minimum' ]
 			)
 
+		# Make sure the subject and content only use placeholders we know about
+		lUnknown = []
+		for sField in [ 'subject', 'content' ]:
+			if sField in req.data.record and \
+				isinstance(req.data.record[sField], str):
+				lUnknown.extend([
+					[ 'record.%s' % sField, 'unknown placeholder %s' % s ]
+					for s in templates.unknown(req.data.record[sField])
+				])
+		if lUnknown:
+			return Error(errors.DATA_FIELDS, lUnknown)
+
 		# Check the project exists
 		if not project.Project.exists(req.data.record._project):
 			return Error(
@@ -128,6 +163,55 @@ class Admin(Service):
 		if dSender['_project'] != req.data.record._project:
 			return Error(errors.RIGHTS, 'invalid sender for project')
 
+		# If there are additional senders to rotate through
+		lSenders = []
+		if 'senders' in req.data:
+
+			# If it's not a list
+			if not isinstance(req.data.senders, list):
+				return Error(errors.DATA_FIELDS, [ [ 'senders', 'invalid' ] ])
+
+			# Go through each one, which can be just the ID, or the ID and a
+			#	weight
+			for i, m in enumerate(req.data.senders):
+				if isinstance(m, str):
+					m = { '_sender': m }
+				elif not isinstance(m, dict) or '_sender' not in m:
+					return Error(
+						errors.DATA_FIELDS, [ [ 'senders.%d' % i, 'invalid' ] ]
+					)
+				if not isinstance(m.get('weight', 1), int) or \
+					isinstance(m.get('weight', 1), bool) or \
+					m.get('weight', 1) < 1:
+					return Error(
+						errors.DATA_FIELDS,
+						[ [ 'senders.%d.weight' % i, 'invalid' ] ]
+					)
+				if m['_sender'] != req.data.record._sender and \
+					m['_sender'] not in [ d['_sender'] for d in lSenders ]:
+					lSenders.append({
+						'_sender': m['_sender'],
+						'weight': m.get('weight', 1)
+					})
+
+			# Make sure they all exist and are in the same project
+			if lSenders:
+				dValidSenders = {
+					d['_id']: d['_project'] for d in sender.Sender.get(
+						[ d['_sender'] for d in lSenders ],
+						raw = [ '_id', '_project' ]
+					)
+				}
+				lMissing = [
+					d['_sender'] for d in lSenders
+					if d['_sender'] not in dValidSenders
+				]
+				if lMissing:
+					return Error(errors.DB_NO_RECORD, [ lMissing, 'sender' ])
+				if set(dValidSenders.values()) != \
+					{ req.data.record._project }:
+					return Error(errors.RIGHTS, 'invalid sender for project')
+
 		# If we are adding a list of contacts by ID, or by categories they are
 		#	in
 		if req.data.contacts in [ 'categories', 'ids' ]:
@@ -166,29 +250,14 @@ class Admin(Service):
 						]
 					)
 
-			# Else, if we are adding contacts directly
-			elif req.data.contacts == 'ids':
-
-				# Make absolutely sure the contacts are unique
-				lContacts = list(set(req.data.contacts_list))
-
-				# Make sure they all exist by fetching them all
-				lValidContacts = [ d['_id'] for d in contact.Contact.get(
-					lContacts, raw = [ '_id' ]
-				) ]
-
-				# If the counts don't match
-				if len(lValidContacts) != len(lContacts):
-
-					# Get the list of IDs that don't exist and return them in an
-					#	error
-					return Error(
-						errors.DB_NO_RECORD, [
-							[ _id for _id in lContacts \
-								if _id not in lValidContacts ],
-							'contact'
-						]
-					)
+			# Else, if we are adding contacts directly, make sure we got a list.
+			#	Each ID is checked as it's added, a chunk at a time, so a huge
+			#	list never turns into a single query
+			elif not isinstance(req.data.contacts_list, list):
+				return Error(
+					errors.DATA_FIELDS,
+					[ [ 'contacts_list', 'invalid' ] ]
+				)
 
 		# Else, we better have received 'all'
 		elif req.data.contacts != 'all':
@@ -198,9 +267,21 @@ class Admin(Service):
 					'must be one of "all", "categories", or "ids"' ] ]
 			)
 
-		# If the start now flag is set
-		if 'start_now' in req.data and req.data.start_now:
-			req.data.record.next_trigger = MySQL_Literal('CURRENT_TIMESTAMP')
+		# Is the start now flag set
+		bStartNow = 'start_now' in req.data and req.data.start_now and \
+					True or False
+
+		# If the audience comes from the whole project, or its categories, it
+		#	could be huge, so leave it to be built in the background. Either
+		#	way, the campaign gets no trigger until its audience is complete
+		if req.data.contacts in [ 'all', 'categories' ]:
+			req.data.record.audience = {
+				'contacts': req.data.contacts,
+				'start_now': bStartNow
+			}
+			if req.data.contacts == 'categories':
+				req.data.record.audience['categories'] = lCategories
+			req.data.record.audience_state = 'building'
 
 		# Create and validate the record
 		try:
@@ -213,17 +294,45 @@ class Admin(Service):
 		except RecordDuplicate as e:
 			return Error(errors.DB_DUPLICATE, e.args)
 
-		# If we are adding all the projects contacts
-		if req.data.contacts == 'all':
-			campaign_contact.add_contacts_all(sID, req.data.record._project)
+		# Add any additional senders. If any of them fails, remove the
+		#	campaign and whatever was added, a campaign with part of its pool
+		#	can never be left for the daemon to find
+		try:
+			for d in lSenders:
+				d['_campaign'] = sID
+				campaign_sender.CampaignSender.add(d)
+		except Exception as e:
+			_campaign_undo(sID)
+			if isinstance(e, ValueError):
+				return Error(errors.DATA_FIELDS, e.args)
+			if isinstance(e, RecordDuplicate):
+				return Error(errors.DB_DUPLICATE, e.args)
+			raise
+
+		# If we are adding by ID, add them in chunks, checking each chunk
+		#	against the project's contacts
+		if req.data.contacts == 'ids':
+			dCounts = campaign_contact.add_contacts_list(
+				sID,
+				req.data.record._project,
+				req.data.contacts_list,
+				config.audiences.chunk(1000)
+			)
+
+			# If any don't exist, remove the campaign and return them in an
+			#	error
+			if dCounts['missing']:
+				_campaign_undo(sID)
+				return Error(
+					errors.DB_NO_RECORD, [ dCounts['missing'], 'contact' ]
+				)
 
-		# Else, if we are adding contacts by project categories
-		elif req.data.contacts == 'categories':
-			campaign_contact.add_contacts_by_categories(sID, lCategories)
+			# Mark the audience as ready with the count added, which starts
+			#	the campaign if requested
+			campaign.audience_ready(sID, dCounts['inserted'], bStartNow)
 
-		# Else, if we are adding by ID
-		elif req.data.contacts == 'ids':
-			campaign_contact.add_contacts(sID, lContacts)
+		# Let the daemons know there's a new campaign
+		scheduler.notify(sID)
 
 		# Return the ID
 		return Response(sID)
@@ -254,6 +363,22 @@ class Admin(Service):
 			'_campaign': req.data._id
 		}, raw = [ '_id', '_contact', 'sent', 'delivered', 'opened' ])
 
+		# Fetch the additional senders and add them to the record
+		dCampaign['senders'] = campaign_sender.CampaignSender.filter({
+			'_campaign': req.data._id
+		}, raw = [ '_sender', 'weight' ])
+
+		# If the daemons publish the state of their breakers, add the state of
+		#	each sender's
+		sRedis = config.campaigns.breaker.redis(None)
+		if sRedis:
+			dCampaign['breakers'] = breaker.states(
+				list(dict.fromkeys([ dCampaign['_sender'] ] + [
+					d['_sender'] for d in dCampaign['senders']
+				])),
+				sRedis
+			)
+
 		# If names are requested
 		if 'add_names' in req.data and req.data.add_names:
 
@@ -529,6 +654,9 @@ class Admin(Service):
 		except RecordDuplicate as e:
 			return Error(errors.DB_DUPLICATE, e.args)
 
+		# The project's counts are out of date
+		contact.count_clear(req.data.record._project)
+
 		# Return the result
 		return Response(sID)
 
@@ -549,7 +677,8 @@ class Admin(Service):
 			return Error(errors.DATA_FIELDS, [ [ '_id', 'missing' ] ])
 
 		# If the contact doesn't exist
-		if not contact.Contact.exists(req.data._id):
+		dContact = contact.Contact.get(req.data._id, raw = [ '_project' ])
+		if not dContact:
 			return Error(errors.DB_NO_RECORD, [ req.data._id, 'contact' ])
 
 		# If the contact has been used
@@ -571,6 +700,9 @@ class Admin(Service):
 		if dRes == None:
 			return Error(errors.DB_DELETE_FAILED, [ req.data._id, 'contact' ])
 
+		# The project's counts are out of date
+		contact.count_clear(dContact['_project'])
+
 		# Return OK
 		return Response(dRes)
 
@@ -659,13 +791,19 @@ class Admin(Service):
 		# Save the record and store the result
 		bRes = oContact.save(revision_info = { 'user' : REPLACE_ME })
 
+		# If the categories changed, the project's counts are out of date
+		if bRes and dChanges and 'categories' in dChanges:
+			contact.count_clear(oContact['_project'])
+
 		# Return the changes or False
 		return Response(bRes and dChanges or False)
 
 	def contacts_read(self, req: jobject) -> Response:
 		"""Contacts (read)
 
-		Fetches contacts by project and optionally by category
+		Fetches a page of contacts by project and optionally by category, in \
+		order of name. Pass the `next` value returned as `after` to get the \
+		following page, and `fields` to only get some of each contact's data
 
 		Arguments:
 			req (jobject): Contains data and session if available
@@ -678,21 +816,53 @@ class Admin(Service):
 		if '_project' not in req.data:
 			return Error(errors.DATA_FIELDS, [ [ '_project', 'missing' ] ])
 
-		# Init the search filter
-		dFilter = { '_project': req.data._project }
+		# Get the categories, if any
+		lCategories = 'categories' in req.data and req.data.categories or None
 
-		# If we have categories
-		if 'categories' in req.data:
-			dFilter['categories'] = req.data.categories
+		# Get the page size, never more than the maximum
+		dPage = config.contacts.page({
+			'default': 100,
+			'maximum': 1000
+		})
+		try:
+			iLimit = int('limit' in req.data and req.data.limit or \
+				dPage['default'])
+			if iLimit < 1:
+				raise ValueError
+		except (TypeError, ValueError):
+			return Error(errors.DATA_FIELDS, [ [ 'limit', 'invalid' ] ])
+		iLimit = min(iLimit, dPage['maximum'])
+
+		# If we got fields, make sure they exist
+		lFields = None
+		if 'fields' in req.data:
+			if not isinstance(req.data.fields, list) or \
+				[ f for f in req.data.fields if f not in contact.FIELDS ]:
+				return Error(errors.DATA_FIELDS, [ [ 'fields', 'invalid' ] ])
+			lFields = req.data.fields
+
+		# If we got the last contact of the previous page, make sure it's a
+		#	name and an ID
+		lAfter = None
+		if 'after' in req.data and req.data.after is not None:
+			if not isinstance(req.data.after, list) or \
+				len(req.data.after) != 2:
+				return Error(errors.DATA_FIELDS, [ [ 'after', 'invalid' ] ])
+			lAfter = req.data.after
 
 		# Request the contacts
-		lContacts = contact.Contact.filter(dFilter, raw = True)
-
-		# Sort them by name
-		lContacts.sort(key = itemgetter('name'))
+		lContacts = contact.search(
+			req.data._project, lCategories, lAfter, iLimit, lFields
+		)
 
-		# Return the records
-		return Response(lContacts)
+		# Return the page, where the next one starts if there could be one,
+		#	and the total
+		return Response({
+			'contacts': lContacts,
+			'count': contact.count(req.data._project, lCategories),
+			'next': len(lContacts) == iLimit and \
+				[ lContacts[-1]['name'], lContacts[-1]['_id'] ] or None
+		})
 
 	def project_create(self, req: jobject) -> Response:
 		"""Project (create)
@@ -934,17 +1104,23 @@ class Admin(Service):
 		if not sender.Sender.exists(req.data._id):
 			return Error(errors.DB_NO_RECORD, [ req.data._id, 'sender' ])
 
-		# Look for campaigns with the sender
-		lCampaigns = campaign.Campaign.filter({
+		# Look for campaigns with the sender, as the primary sender or as one
+		#	of the additional ones
+		lCampaigns = [ d['_id'] for d in campaign.Campaign.filter({
 			'_sender': req.data._id
-		}, raw = [ '_id' ])
+		}, raw = [ '_id' ]) ]
+		lCampaigns.extend([
+			d['_campaign'] for d in campaign_sender.CampaignSender.filter({
+				'_sender': req.data._id
+			}, raw = [ '_campaign' ])
+		])
 
 		# If there's any campaigns
 		if lCampaigns:
 
 			# Look for any campaign contacts still not sent
 			dCampaignContacts = campaign_contact.unsent_by_campaigns(
-				[ d['_id'] for d in lCampaigns ]
+				list(set(lCampaigns))
 			)
 
 			# If there's any
@@ -961,6 +1137,9 @@ class Admin(Service):
 		if dRes == None:
 			return Error(errors.DB_DELETE_FAILED, [ req.data._id, 'sender' ])
 
+		# Remove it from any campaign rotations
+		campaign_sender.remove_by('_sender', req.data._id)
+
 		# Return OK
 		return Response(dRes)
 
@@ -0,0 +1,161 @@
+# coding=utf8
+""" Adaptive
+
+Handles speeding each sender up while its relay keeps up, and backing off \
+as soon as it starts deferring messages or slowing down
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-22"
+
+# Python imports
+from typing import Dict, List
+
+# Shared imports
+from shared import metrics
+
+SPEED = metrics.Gauge(
+	'contact_sender_speed',
+	'How fast each sender is allowed to send, from 0, the campaign\'s ' \
+		'max_interval, to 1, its min_interval',
+	( 'sender', )
+)
+
+class Controller(object):
+	"""Controller
+
+	Keeps a speed between 0 and 1 for each sender using additive increase, \
+	multiplicative decrease. Every message accepted quickly adds a little \
+	speed, every deferral, or reply much slower than usual, cuts it. The \
+	speed decides how far into each campaign's min_interval / max_interval \
+	envelope the sender's next message is scheduled, and how many of its \
+	connections can be used at once
+	"""
+
+	def __init__(self,
+		start: float = 0.5,
+		increase: float = 0.05,
+		decrease: float = 0.5,
+		floor: float = 0.05,
+		slow: float = 2.0,
+		smoothing: float = 0.2
+	):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			start (float): The speed of a sender not seen yet
+			increase (float): The speed added for each message accepted
+			decrease (float): The multiplier applied to the speed when the \
+				relay pushes back
+			floor (float): The lowest the speed can go
+			slow (float): How many times the usual latency a reply has to take \
+				to count as the relay pushing back
+			smoothing (float): The weight of each new latency in the usual \
+				latency, an exponential moving average
+
+		Returns:
+			Controller
+		"""
+
+		# Store the settings
+		self._start = start
+		self._increase = increase
+		self._decrease = decrease
+		self._floor = floor
+		self._slow = slow
+		self._smoothing = smoothing
+
+		# Init the speed and usual latency by sender _id
+		self._speed: Dict[str, float] = {}
+		self._latency: Dict[str, float] = {}
+
+	def concurrency(self, sender_id: str, limit: int) -> int:
+		"""Concurrency
+
+		Returns how many messages the sender can send at once, out of the \
+		most it's allowed
+
+		Arguments:
+			sender_id (str): The ID of the sender
+			limit (uint): The most messages the sender can ever send at once
+
+		Returns:
+			uint
+		"""
+		return max(1, round(self.speed(sender_id) * limit))
+
+	def interval(self, sender_id: str, minmax: List[float]) -> List[float]:
+		"""Interval
+
+		Returns the range of seconds to wait before the sender's next message. \
+		At full speed that's the whole envelope, as the speed drops the \
+		minimum moves up towards the maximum
+
+		Arguments:
+			sender_id (str): The ID of the sender
+			minmax (float[]): The campaign's minimum and maximum seconds
+
+		Returns:
+			float[]
+		"""
+		fMin, fMax = minmax
+		return [
+			fMin + (1 - self.speed(sender_id)) * max(0, fMax - fMin),
+			fMax
+		]
+
+	def observe(self, sender_id: str, seconds: float, deferred: bool) -> float:
+		"""Observe
+
+		Adjusts the sender's speed from the outcome of a message. Only \
+		messages accepted or deferred say anything about the relay, messages \
+		refused for good should not be observed
+
+		Arguments:
+			sender_id (str): The ID of the sender
+			seconds (float): The time the relay took to answer
+			deferred (bool): True if the relay deferred the message, or timed \
+				out, or dropped the connection
+
+		Returns:
+			float, the new speed
+		"""
+
+		# Get the speed and the usual latency
+		fSpeed = self.speed(sender_id)
+		fUsual = self._latency.get(sender_id)
+
+		# If it was deferred, or far slower than usual, back off
+		if deferred or (fUsual is not None and seconds > fUsual * self._slow):
+			fSpeed = max(self._floor, fSpeed * self._decrease)
+
+		# Else, speed up
+		else:
+			fSpeed = min(1.0, fSpeed + self._increase)
+
+		# Update the usual latency with anything the relay answered
+		if not deferred:
+			self._latency[sender_id] = fUsual is None and seconds or \
+				fUsual + self._smoothing * (seconds - fUsual)
+
+		# Store the speed and return it
+		self._speed[sender_id] = fSpeed
+		SPEED.set(fSpeed, sender = sender_id)
+		return fSpeed
+
+	def speed(self, sender_id: str) -> float:
+		"""Speed
+
+		Returns the current speed of the sender
+
+		Arguments:
+			sender_id (str): The ID of the sender
+
+		Returns:
+			float
+		"""
+		return self._speed.get(sender_id, self._start)
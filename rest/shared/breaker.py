@@ -0,0 +1,287 @@
+# coding=utf8
+""" Breaker
+
+Handles keeping senders that keep failing out of every campaign until \
+they've had time to recover, and sharing their state with the admin
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-21"
+
+# Ouroboros imports
+from nredis import nr
+
+# Python imports
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, List
+
+KEY = 'contact:sender:%s:breaker'
+"""The Redis key used to publish a sender's breaker"""
+
+class Breaker(object):
+	"""Breaker
+
+	A circuit breaker per sender. It opens after `threshold` failures in a \
+	row, keeping the sender out of use for the cooldown, after which a \
+	single message is let through as a trial, and the sender stays out of \
+	use for everyone else until its result is in. If the trial succeeds the \
+	breaker closes, if it fails it opens again straight away
+	"""
+
+	def __init__(self,
+		threshold: int = 5,
+		cooldown: int = 60,
+		redis: str = None
+	):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			threshold (uint): The failures in a row that open the breaker
+			cooldown (uint): The seconds the breaker stays open
+			redis (str): Optional, the name of the Redis connection in config \
+				to publish the state of open breakers to
+
+		Returns:
+			Breaker
+		"""
+
+		# Store the limits
+		self._threshold = max(1, threshold)
+		self._cooldown = cooldown
+
+		# Init the failures in a row, the time each open breaker closes, and
+		#	when each trial was let through, by sender _id. The lock is held
+		#	while they change, results come in from other threads
+		self._failures: Dict[str, int] = {}
+		self._open: Dict[str, float] = {}
+		self._trials: Dict[str, float] = {}
+		self._lock = Lock()
+
+		# Store the Redis connection if we have one
+		self._redis = redis and nr(redis) or None
+
+	def _publish(self, sender_id: str) -> None:
+		"""Publish
+
+		Writes the state of the sender's breaker to Redis so it can be seen \
+		outside the daemon. Closed breakers are removed
+
+		Arguments:
+			sender_id (str): The ID of the sender
+
+		Returns:
+			None
+		"""
+
+		# If we have nowhere to publish, do nothing
+		if self._redis is None:
+			return
+
+		# If the breaker is closed, remove it
+		if sender_id not in self._open:
+			self._redis.delete(KEY % sender_id)
+			return
+
+		# Else, store when it lets a trial through, in real time, and expire
+		#	it a cooldown after that in case the daemon is gone before the
+		#	trial happens
+		fLeft = max(0, self._open[sender_id] - monotonic())
+		self._redis.hset(KEY % sender_id, mapping = {
+			'failures': self._failures.get(sender_id, 0),
+			'until': '%.3f' % (time() + fLeft)
+		})
+		self._redis.expire(KEY % sender_id, int(fLeft) + self._cooldown + 1)
+
+	def _on_trial(self, sender_id: str) -> bool:
+		"""On Trial
+
+		Returns True if a trial message is already out for the sender. A \
+		trial that never reported back is given up on after the cooldown
+
+		Arguments:
+			sender_id (str): The ID of the sender
+
+		Returns:
+			bool
+		"""
+		return self._trials.get(sender_id, float('-inf')) + self._cooldown > \
+				monotonic()
+
+	def closed(self, sender_id: str) -> bool:
+		"""Closed
+
+		Returns True if the sender's breaker is closed, not open or on trial
+
+		Arguments:
+			sender_id (str): The ID of the sender
+
+		Returns:
+			bool
+		"""
+		return sender_id not in self._open
+
+	def cooling(self, sender_ids: List[str]) -> float | None:
+		"""Cooling
+
+		Returns the seconds until the first of the given senders with an \
+		open breaker can be tried again, or None if none are open. Senders \
+		with a trial out count as now, the result could come at any time
+
+		Arguments:
+			sender_ids (str[]): The IDs of the senders to check
+
+		Returns:
+			float | None
+		"""
+		lUntil = [
+			self._open[s] for s in sender_ids
+			if s in self._open and not self._on_trial(s)
+		]
+		if lUntil:
+			return max(0, min(lUntil) - monotonic())
+		if any(s in self._open for s in sender_ids):
+			return 0.0
+		return None
+
+	def fail(self, sender_id: str) -> None:
+		"""Fail
+
+		Records a failure by the sender, opening its breaker if it has \
+		failed too many times in a row, or it was on trial
+
+		Arguments:
+			sender_id (str): The ID of the sender that failed
+
+		Returns:
+			None
+		"""
+		with self._lock:
+			self._trials.pop(sender_id, None)
+			self._failures[sender_id] = self._failures.get(sender_id, 0) + 1
+			if self._failures[sender_id] < self._threshold:
+				return
+			self._open[sender_id] = monotonic() + self._cooldown
+		self._publish(sender_id)
+
+	def ok(self, sender_id: str) -> None:
+		"""OK
+
+		Records a success by the sender, closing its breaker
+
+		Arguments:
+			sender_id (str): The ID of the sender that succeeded
+
+		Returns:
+			None
+		"""
+		with self._lock:
+			self._trials.pop(sender_id, None)
+			self._failures.pop(sender_id, None)
+			bWasOpen = self._open.pop(sender_id, None) is not None
+		if bWasOpen:
+			self._publish(sender_id)
+
+	def release(self, sender_id: str) -> None:
+		"""Release
+
+		Gives back a trial taken by take() that was never sent, so another \
+		message can be the trial
+
+		Arguments:
+			sender_id (str): The ID of the sender
+
+		Returns:
+			None
+		"""
+		with self._lock:
+			self._trials.pop(sender_id, None)
+
+	def take(self, sender_id: str) -> bool:
+		"""Take
+
+		Called once the sender has been picked for a message. Returns True \
+		if the sender's breaker is closed, or it has cooled down and no one \
+		else has the trial, in which case this message is the trial. Every \
+		trial taken must end with ok(), fail(), or release()
+
+		Arguments:
+			sender_id (str): The ID of the sender
+
+		Returns:
+			bool
+		"""
+		with self._lock:
+			if sender_id not in self._open:
+				return True
+			if self._open[sender_id] > monotonic() or \
+				self._on_trial(sender_id):
+				return False
+			self._trials[sender_id] = monotonic()
+			return True
+
+	def usable(self, sender_id: str) -> bool:
+		"""Usable
+
+		Returns True if the sender's breaker is closed, or has been open \
+		long enough to try it again and no one else has the trial. Only \
+		take() actually lets a trial through
+
+		Arguments:
+			sender_id (str): The ID of the sender
+
+		Returns:
+			bool
+		"""
+		if sender_id not in self._open:
+			return True
+		return self._open[sender_id] <= monotonic() and \
+				not self._on_trial(sender_id)
+
+def states(sender_ids: List[str], redis: str = 'records') -> Dict[str, dict]:
+	"""States
+
+	Returns the state of each sender's breaker, as published by the daemons, \
+	one of 'closed', 'open', or 'trial', along with the failures in a row \
+	and when an open breaker lets a trial through
+
+	Arguments:
+		sender_ids (str[]): The IDs of the senders
+		redis (str): The name of the Redis connection in config
+
+	Returns:
+		dict
+	"""
+
+	# Fetch all the breakers at once
+	oRedis = nr(redis)
+	oPipe = oRedis.pipeline()
+	for sID in sender_ids:
+		oPipe.hgetall(KEY % sID)
+	lBreakers = oPipe.execute()
+
+	# Go through each one and figure out its state
+	fNow = time()
+	dRet = {}
+	for sID, dBreaker in zip(sender_ids, lBreakers):
+		if not dBreaker:
+			dRet[sID] = { 'state': 'closed', 'failures': 0, 'until': None }
+			continue
+		dBreaker = {
+			(isinstance(k, bytes) and k.decode() or k):
+				(isinstance(v, bytes) and v.decode() or v)
+			for k,v in dBreaker.items()
+		}
+		fUntil = float(dBreaker['until'])
+		dRet[sID] = {
+			'state': fUntil > fNow and 'open' or 'trial',
+			'failures': int(dBreaker['failures']),
+			'until': int(fUntil)
+		}
+
+	# Return the states
+	return dRet
@@ -0,0 +1,48 @@
+# coding=utf8
+""" Daemon
+
+Handles what every daemon has to do before it starts
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-25"
+
+# Ouroboros imports
+from config import config
+import record_mysql
+
+# Shared imports
+from shared import log
+
+def setup(name: str) -> None:
+	"""Setup
+
+	Adds the primary MySQL host and sends the logging through the queue to \
+	the background writer, using the log settings in the daemon's section \
+	of config
+
+	Arguments:
+		name (str): The daemon's section of config, e.g. 'campaigns'
+
+	Returns:
+		None
+	"""
+
+	# Add the primary host
+	record_mysql.add_host(config.mysql.primary({
+		'charset': 'utf8',
+		'host': 'localhost',
+		'passwd': '',
+		'port': 3306,
+		'user': 'mysql'
+	}))
+
+	# Start the logging
+	dLog = config[name].log({
+		'level': 'info',
+		'per_second': 10,
+		'size': 10000
+	})
+	log.setup(dLog['level'], dLog['size'], dLog['per_second'])
@@ -0,0 +1,139 @@
+# coding=utf8
+""" Exporter
+
+Handles turning pages of rows read from the DB into CSV or NDJSON, a chunk \
+of bytes at a time, so that exports can be streamed as they're read without \
+ever holding the whole result
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-24"
+
+# Ouroboros imports
+import jsonb
+
+# Python imports
+import csv
+from io import StringIO
+from typing import Callable, Iterable, Iterator, List
+
+CAMPAIGN_FIELDS = [
+	'_contact', 'email_address', 'name', 'state', 'sent', 'delivered',
+	'opened', 'unsubscribed', 'attempts', 'smtp_code'
+]
+"""The fields exported for each contact in a campaign"""
+
+CONTACT_FIELDS = [
+	'_id', '_created', '_updated', 'email_address', 'name', 'alias',
+	'company', 'unsubscribed', 'categories'
+]
+"""The fields exported for each contact"""
+
+CONTENT_TYPES = {
+	'csv': 'text/csv; charset=utf-8',
+	'ndjson': 'application/x-ndjson; charset=utf-8'
+}
+"""The content type of each format"""
+
+def _cell(value: any) -> any:
+	"""Cell
+
+	Returns the value the way it's written to CSV, lists are joined with \
+	semicolons, the way they are imported, bools are 1 or 0, and None is \
+	left empty
+
+	Arguments:
+		value (any): The value
+
+	Returns:
+		any
+	"""
+	if value is None:
+		return ''
+	if isinstance(value, bool):
+		return value and 1 or 0
+	if isinstance(value, list):
+		return ';'.join(value)
+	return value
+
+def rows(
+	page: Callable[[str | None, int], List[dict]],
+	key: str,
+	size: int = 1000
+) -> Iterator[dict]:
+	"""Rows
+
+	Yields every row by reading one page at a time, each page starting \
+	after the key of the last row of the previous one
+
+	Arguments:
+		page (callable): Takes the key to start after, or None, and the page \
+			size, and returns the rows in order of the key
+		key (str): The field the pages are ordered by
+		size (uint): Optional, the number of rows in each page
+
+	Returns:
+		iterator
+	"""
+	mAfter = None
+	while True:
+		lRows = page(mAfter, size)
+		yield from lRows
+		if len(lRows) < size:
+			return
+		mAfter = lRows[-1][key]
+
+def encode(
+	rows_: Iterable[dict],
+	format: str,
+	fields: List[str],
+	chunk: int = 65536
+) -> Iterator[bytes]:
+	"""Encode
+
+	Turns the rows into CSV, with a header line, or NDJSON, and yields it in \
+	chunks of about `chunk` bytes. The header is yielded on its own so the \
+	response starts before the first page is read
+
+	Arguments:
+		rows_ (iterable): The rows
+		format (str): 'csv' or 'ndjson'
+		fields (str[]): The fields to include, in order
+		chunk (uint): Optional, about how many bytes to yield at once
+
+	Returns:
+		iterator
+	"""
+
+	# Create the buffer
+	oBuffer = StringIO()
+
+	# If we want CSV, write the header and send it immediately
+	if format == 'csv':
+		oWriter = csv.writer(oBuffer, lineterminator = '\r\n')
+		oWriter.writerow(fields)
+		yield oBuffer.getvalue().encode('utf-8')
+		oBuffer.seek(0)
+		oBuffer.truncate()
+
+	# Go through each row
+	for d in rows_:
+
+		# Add it to the buffer
+		if format == 'csv':
+			oWriter.writerow([ _cell(d[f]) for f in fields ])
+		else:
+			oBuffer.write(jsonb.encode({ f: d[f] for f in fields }))
+			oBuffer.write('\n')
+
+		# If the buffer is big enough, send it
+		if oBuffer.tell() >= chunk:
+			yield oBuffer.getvalue().encode('utf-8')
+			oBuffer.seek(0)
+			oBuffer.truncate()
+
+	# Send anything left
+	if oBuffer.tell():
+		yield oBuffer.getvalue().encode('utf-8')
@@ -0,0 +1,322 @@
+# coding=utf8
+""" Importer
+
+Handles adding contacts in bulk from CSV or NDJSON. Every stage is a \
+generator working on one row, or one batch of rows, at a time, so the memory \
+used doesn't grow with the size of the file
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-24"
+
+# Ouroboros imports
+import jsonb
+from record.exceptions import RecordDuplicate
+
+# Python imports
+import csv
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple
+from uuid import uuid4
+
+# Record imports
+from records.admin import category, contact
+
+FIELDS = [ 'email_address', 'name', 'alias', 'company', 'categories' ]
+"""The fields that can be set on each imported contact"""
+
+FORMATS = [ 'csv', 'ndjson' ]
+"""The formats contacts can be imported from"""
+
+Row = Tuple[int, dict | None, list | None]
+"""The line number, the data if it's usable, and the errors if it isn't"""
+
+def batches(rows: Iterable[Row], size: int) -> Iterator[List[Row]]:
+	"""Batches
+
+	Groups the rows into lists of `size`, the last one can be smaller
+
+	Arguments:
+		rows (iterable): The rows
+		size (uint): The number of rows in each batch
+
+	Returns:
+		iterator
+	"""
+	oRows = iter(rows)
+	while True:
+		lBatch = list(islice(oRows, size))
+		if not lBatch:
+			return
+		yield lBatch
+
+def categories(project_id: str) -> Dict[str, str]:
+	"""Categories
+
+	Returns the IDs of the project's categories by lowercase name and by ID, \
+	so imported rows can use either
+
+	Arguments:
+		project_id (str): The ID of the project
+
+	Returns:
+		dict
+	"""
+	dRet = {}
+	for d in category.Category.filter(
+		{ '_project': project_id }, raw = [ '_id', 'name' ]
+	):
+		dRet[d['_id']] = d['_id']
+		dRet[d['name'].lower()] = d['_id']
+	return dRet
+
+def csv_rows(lines: Iterable[str]) -> Iterator[Row]:
+	"""CSV Rows
+
+	Reads CSV with a header line naming the fields. Categories are separated \
+	by semicolons, and empty optional fields are left out
+
+	Arguments:
+		lines (iterable): The lines of text
+
+	Returns:
+		iterator
+	"""
+	oReader = csv.DictReader(lines)
+	for dRow in oReader:
+
+		# Leave out anything empty or not named in the header
+		dData = {
+			k: v.strip() for k, v in dRow.items()
+			if k is not None and isinstance(v, str) and v.strip()
+		}
+
+		# Split the categories
+		if 'categories' in dData:
+			dData['categories'] = [
+				s.strip() for s in dData['categories'].split(';') if s.strip()
+			]
+
+		# Pass it along
+		yield oReader.line_num, dData, None
+
+def ndjson_rows(lines: Iterable[str]) -> Iterator[Row]:
+	"""NDJSON Rows
+
+	Reads one JSON object per line, skipping blank lines
+
+	Arguments:
+		lines (iterable): The lines of text
+
+	Returns:
+		iterator
+	"""
+	for i, s in enumerate(lines, 1):
+
+		# Skip anything blank
+		s = s.strip()
+		if not s:
+			continue
+
+		# Decode the line
+		try:
+			mData = jsonb.decode(s)
+		except ValueError as e:
+			yield i, None, [ [ 'line', 'invalid json: %s' % str(e) ] ]
+			continue
+
+		# If it's not an object
+		if not isinstance(mData, dict):
+			yield i, None, [ [ 'line', 'must be an object' ] ]
+			continue
+
+		# Pass it along
+		yield i, mData, None
+
+def records(
+	rows: Iterable[Row],
+	project_id: str,
+	categories_: Dict[str, str]
+) -> Iterator[Row]:
+	"""Records
+
+	Turns each row into a new contact in the project and validates it \
+	against the contact definition. Categories are swapped for their IDs
+
+	Arguments:
+		rows (iterable): The rows read from the file
+		project_id (str): The ID of the project the contacts are added to
+		categories_ (dict): The category IDs by name and ID, see categories()
+
+	Returns:
+		iterator
+	"""
+	for iLine, dData, lErrors in rows:
+
+		# If the row couldn't be read, pass it along
+		if lErrors:
+			yield iLine, None, lErrors
+			continue
+
+		# Keep only the fields that can be set
+		dRecord = { k: dData[k] for k in FIELDS if k in dData }
+		dRecord['_id'] = str(uuid4())
+		dRecord['_project'] = project_id
+		dRecord['unsubscribed'] = False
+
+		# Swap the categories for their IDs
+		if 'categories' in dRecord:
+			if not isinstance(dRecord['categories'], list):
+				yield iLine, None, [ [ 'categories', 'must be a list' ] ]
+				continue
+			lUnknown = [
+				s for s in dRecord['categories']
+				if not isinstance(s, str) or s.lower() not in categories_
+			]
+			if lUnknown:
+				yield iLine, None, [ [ 'categories', 'unknown %s' % ', '.join(
+					[ str(m) for m in lUnknown ]
+				) ] ]
+				continue
+			dRecord['categories'] = list(dict.fromkeys([
+				categories_[s.lower()] for s in dRecord['categories']
+			]))
+		else:
+			dRecord['categories'] = []
+
+		# Validate it
+		if not contact.Contact.valid(dRecord):
+			yield iLine, None, contact.Contact.validation_failures
+			continue
+
+		# Pass it along
+		yield iLine, dRecord, None
+
+def insert(
+	rows: Iterable[Row],
+	project_id: str,
+	revision_info: dict,
+	size: int = 500
+) -> Iterator[Tuple[int, str, any]]:
+	"""Insert
+
+	Adds the valid rows in batches. Each batch is checked against the \
+	project's existing contacts with a single query, and anything new is \
+	added with a single insert per table
+
+	Arguments:
+		rows (iterable): The validated rows
+		project_id (str): The ID of the project
+		revision_info (dict): The additional info stored with each revision
+		size (uint): Optional, the number of rows in each batch
+
+	Returns:
+		An iterator of the line number, the outcome, one of 'inserted', \
+		'duplicate', 'unsubscribed', or 'invalid', and the contact's ID, or \
+		the errors
+	"""
+	for lBatch in batches(rows, size):
+
+		# Report the invalid rows, and keep only the first of any address
+		#	repeated in the batch
+		dNew = {}
+		for iLine, dRecord, lErrors in lBatch:
+			if lErrors:
+				yield iLine, 'invalid', lErrors
+				continue
+			sEmail = dRecord['email_address'].lower()
+			if sEmail in dNew:
+				yield iLine, 'duplicate', dRecord['email_address']
+				continue
+			dNew[sEmail] = (iLine, dRecord)
+
+		# Find the addresses already in the project, and report them
+		dExisting = contact.by_emails(project_id, [
+			t[1]['email_address'] for t in dNew.values()
+		])
+		for sEmail, bUnsubscribed in dExisting.items():
+			if sEmail in dNew:
+				iLine, dRecord = dNew.pop(sEmail)
+				yield iLine, bUnsubscribed and 'unsubscribed' or \
+					'duplicate', dRecord['email_address']
+
+		# Add the rest
+		try:
+			contact.add_many([ t[1] for t in dNew.values() ], revision_info)
+			for iLine, dRecord in dNew.values():
+				yield iLine, 'inserted', dRecord['_id']
+
+		# If one was added by someone else since we looked, or only matches
+		#	an existing one by the DB's rules, add them one at a time
+		except RecordDuplicate:
+			for iLine, dRecord in dNew.values():
+				try:
+					contact.add_many([ dRecord ], revision_info)
+					yield iLine, 'inserted', dRecord['_id']
+				except RecordDuplicate:
+					yield iLine, 'duplicate', dRecord['email_address']
+
+def run(
+	lines: Iterable[str],
+	format: str,
+	project_id: str,
+	revision_info: dict,
+	size: int = 500
+) -> Iterator[Tuple[int, str, any]]:
+	"""Run
+
+	Connects the stages to import contacts from lines of CSV or NDJSON
+
+	Arguments:
+		lines (iterable): The lines of text
+		format (str): The format of the lines, 'csv' or 'ndjson'
+		project_id (str): The ID of the project the contacts are added to
+		revision_info (dict): The additional info stored with each revision
+		size (uint): Optional, the number of rows in each batch
+
+	Raises:
+		ValueError if the format is unknown
+
+	Returns:
+		An iterator of the outcome of each row, see insert()
+	"""
+	if format not in FORMATS:
+		raise ValueError('format', 'must be one of %s' % ', '.join(FORMATS))
+	return insert(
+		records(
+			format == 'csv' and csv_rows(lines) or ndjson_rows(lines),
+			project_id,
+			categories(project_id)
+		),
+		project_id,
+		revision_info,
+		size
+	)
+
+def summary(
+	outcomes: Iterable[Tuple[int, str, any]],
+	max_errors: int = 100
+) -> dict:
+	"""Summary
+
+	Counts the outcomes, keeping only the first `max_errors` rows that were \
+	not inserted so that the summary stays small
+
+	Arguments:
+		outcomes (iterable): The outcome of each row, see insert()
+		max_errors (uint): Optional, the most rows not inserted to keep
+
+	Returns:
+		dict
+	"""
+	dRet = {
+		'inserted': 0, 'duplicate': 0, 'unsubscribed': 0, 'invalid': 0,
+		'errors': []
+	}
+	for iLine, sOutcome, mDetail in outcomes:
+		dRet[sOutcome] += 1
+		if sOutcome != 'inserted' and len(dRet['errors']) < max_errors:
+			dRet['errors'].append([ iLine, sOutcome, mDetail ])
+	return dRet
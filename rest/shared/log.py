@@ -0,0 +1,258 @@
+# coding=utf8
+""" Log
+
+Handles structured, levelled logging that never blocks the caller. Records \
+are put on a bounded queue and written by a background thread, busy \
+messages are sampled, and anything that doesn't fit is dropped and counted
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-19"
+
+# Python imports
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+import sys
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple
+
+# Shared imports
+from shared import metrics
+
+ROOT = 'contact'
+"""The name of the logger everything in the project logs under"""
+
+DROPPED = metrics.Counter(
+	'contact_log_dropped_total',
+	'Log records dropped, by reason, one of full or sampled',
+	( 'reason', )
+)
+
+__listener: QueueListener | None = None
+"""The listener writing the queue, once setup() has been called"""
+
+def get(name: str) -> logging.Logger:
+	"""Get
+
+	Returns the logger for a part of the project
+
+	Arguments:
+		name (str): The name of the part, e.g. 'daemons.campaigns'
+
+	Returns:
+		logging.Logger
+	"""
+	return logging.getLogger('%s.%s' % (ROOT, name))
+
+class JSONFormatter(logging.Formatter):
+	"""JSON Formatter
+
+	Writes each record as a single line of JSON, with any fields passed in \
+	`extra = { 'data': {...} }` merged in
+	"""
+
+	def format(self, record: logging.LogRecord) -> str:
+		"""Format
+
+		Returns the record as JSON
+
+		Arguments:
+			record (logging.LogRecord): The record to format
+
+		Returns:
+			str
+		"""
+		dLine = {
+			'ts': round(record.created, 3),
+			'level': record.levelname.lower(),
+			'logger': record.name,
+			'msg': record.getMessage()
+		}
+		if isinstance(getattr(record, 'data', None), dict):
+			dLine.update(record.data)
+		if record.exc_info:
+			dLine['exc'] = self.formatException(record.exc_info)
+		elif record.exc_text:
+			dLine['exc'] = record.exc_text
+		return json.dumps(dLine, default = str, ensure_ascii = False)
+
+class Sampler(logging.Filter):
+	"""Sampler
+
+	Lets at most a set number of records with the same logger and message \
+	through each second, below error. Errors always pass
+	"""
+
+	def __init__(self, per_second: int = 10):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			per_second (uint): The records allowed per logger and message \
+				each second, 0 to allow everything
+
+		Returns:
+			Sampler
+		"""
+		super().__init__()
+		self._per_second = per_second
+		self._lock = Lock()
+		self._windows: Dict[Tuple[str, str], list] = {}
+
+	def filter(self, record: logging.LogRecord) -> bool:
+		"""Filter
+
+		Returns True if the record should be logged
+
+		Arguments:
+			record (logging.LogRecord): The record to check
+
+		Returns:
+			bool
+		"""
+
+		# If we aren't sampling, or it's important, let it through
+		if not self._per_second or record.levelno >= logging.ERROR:
+			return True
+
+		# Get the current window for the logger and message
+		tKey = ( record.name, record.msg )
+		iSecond = int(monotonic())
+		with self._lock:
+			lWindow = self._windows.get(tKey)
+
+			# If it's a new second, start a new window, and let the first
+			#	record through with the count of those dropped in the last one
+			if lWindow is None or lWindow[0] != iSecond:
+				if lWindow and lWindow[2]:
+					record.sampled = lWindow[2]
+				self._windows[tKey] = [ iSecond, 1, 0 ]
+				return True
+
+			# If we still have room, let it through
+			if lWindow[1] < self._per_second:
+				lWindow[1] += 1
+				return True
+
+			# Else, drop it
+			lWindow[2] += 1
+
+		# Count it and let logging know to skip it
+		DROPPED.inc(reason = 'sampled')
+		return False
+
+class _Handler(QueueHandler):
+	"""Handler
+
+	Puts records on the queue without blocking, and without formatting \
+	them, which is left to the background thread
+	"""
+
+	def enqueue(self, record: logging.LogRecord) -> None:
+		"""Enqueue
+
+		Puts the record on the queue, or drops it if the queue is full
+
+		Arguments:
+			record (logging.LogRecord): The record to queue
+
+		Returns:
+			None
+		"""
+		try:
+			self.queue.put_nowait(record)
+		except Full:
+			DROPPED.inc(reason = 'full')
+
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		"""Prepare
+
+		Merges the arguments into the message and renders any traceback, so \
+		the record no longer refers to anything that might change before \
+		it's written
+
+		Arguments:
+			record (logging.LogRecord): The record to prepare
+
+		Returns:
+			logging.LogRecord
+		"""
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(
+				record.exc_info
+			)
+			record.exc_info = None
+		if getattr(record, 'sampled', None):
+			record.data = dict(getattr(record, 'data', None) or {})
+			record.data['sampled_out'] = record.sampled
+		return record
+
+def setup(
+	level: str = 'info',
+	size: int = 10000,
+	per_second: int = 10,
+	stream = None
+) -> None:
+	"""Setup
+
+	Sends everything logged under the project's logger through the queue to \
+	a background thread that writes it as JSON lines. Must be called from \
+	the process that logs, after any forking
+
+	Arguments:
+		level (str): The lowest level written
+		size (uint): The most records that can wait to be written
+		per_second (uint): The records allowed per logger and message each \
+			second, below error
+		stream (file): Optional, where to write, defaults to stdout
+
+	Returns:
+		None
+	"""
+	global __listener
+
+	# If we're already setup, stop the old listener
+	if __listener is not None:
+		__listener.stop()
+
+	# Create the writer
+	oWriter = logging.StreamHandler(stream or sys.stdout)
+	oWriter.setFormatter(JSONFormatter())
+
+	# Create the queue, and the handler that adds to it
+	oQueue = Queue(size)
+	oHandler = _Handler(oQueue)
+	oHandler.addFilter(Sampler(per_second))
+
+	# Replace any handlers on the project's logger
+	oLogger = logging.getLogger(ROOT)
+	for o in list(oLogger.handlers):
+		oLogger.removeHandler(o)
+	oLogger.addHandler(oHandler)
+	oLogger.setLevel(level.upper())
+	oLogger.propagate = False
+
+	# Start writing
+	__listener = QueueListener(oQueue, oWriter)
+	__listener.start()
+
+def stop() -> None:
+	"""Stop
+
+	Writes anything still on the queue and stops the background thread
+
+	Returns:
+		None
+	"""
+	global __listener
+	if __listener is not None:
+		__listener.stop()
+		__listener = None
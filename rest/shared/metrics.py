@@ -0,0 +1,539 @@
+# coding=utf8
+""" Metrics
+
+Handles counting and timing what the daemon and the HTTP nodes do, and \
+serving it all in the Prometheus text format. Every process keeps its own \
+values, so with more than one gunicorn worker each scrape only sees the \
+worker that answered it
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-18"
+
+# Ouroboros imports
+from record_mysql import server
+
+# Pip imports
+import bottle
+
+# Python imports
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+BUCKETS = (
+	0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+	10.0, 30.0
+)
+"""The default histogram buckets, in seconds"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+"""The content type of the text format"""
+
+_registry: List['_Metric'] = []
+"""Every metric created, in the order they were created"""
+
+def _labels(names: Tuple[str], values: Tuple[str]) -> str:
+	"""Labels
+
+	Returns the label block for a sample
+
+	Arguments:
+		names (str[]): The label names
+		values (str[]): The label values
+
+	Returns:
+		str
+	"""
+	if not names:
+		return ''
+	return '{%s}' % ','.join(
+		'%s="%s"' % (
+			n,
+			str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		) for n, v in zip(names, values)
+	)
+
+class _Metric(object):
+	"""Metric
+
+	The base of every type of metric
+	"""
+
+	type = 'untyped'
+	"""The type written in the TYPE line"""
+
+	def __init__(self, name: str, help: str, labels: Tuple[str] = ()):
+		"""Constructor
+
+		Creates a new instance and adds it to those rendered
+
+		Arguments:
+			name (str): The name of the metric
+			help (str): The description written in the HELP line
+			labels (str[]): The names of the labels, if any
+
+		Returns:
+			_Metric
+		"""
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self._lock = Lock()
+		self._values: Dict[tuple, any] = {}
+		_registry.append(self)
+
+	def _key(self, labels: dict) -> tuple:
+		"""Key
+
+		Returns the label values in the order of the label names
+
+		Arguments:
+			labels (dict): The label values by name
+
+		Returns:
+			tuple
+		"""
+		return tuple(labels[n] for n in self.labels)
+
+	def samples(self) -> List[str]:
+		"""Samples
+
+		Returns the sample lines of the metric
+
+		Returns:
+			str[]
+		"""
+		with self._lock:
+			return [
+				'%s%s %s' % (self.name, _labels(self.labels, k), repr(v))
+				for k, v in self._values.items()
+			]
+
+	def render(self) -> str:
+		"""Render
+
+		Returns the metric in the text format
+
+		Returns:
+			str
+		"""
+		return '\n'.join([
+			'# HELP %s %s' % (self.name, self.help),
+			'# TYPE %s %s' % (self.name, self.type),
+			*self.samples()
+		])
+
+class Counter(_Metric):
+	"""Counter
+
+	A value that only ever goes up
+	"""
+
+	type = 'counter'
+
+	def inc(self, amount: float = 1, **labels) -> None:
+		"""Increment
+
+		Adds to the counter
+
+		Arguments:
+			amount (float): The amount to add
+			**labels (str): The label values
+
+		Returns:
+			None
+		"""
+		tKey = self._key(labels)
+		with self._lock:
+			self._values[tKey] = self._values.get(tKey, 0) + amount
+
+class Gauge(Counter):
+	"""Gauge
+
+	A value that can go up and down
+	"""
+
+	type = 'gauge'
+
+	def dec(self, amount: float = 1, **labels) -> None:
+		"""Decrement
+
+		Takes from the gauge
+
+		Arguments:
+			amount (float): The amount to take
+			**labels (str): The label values
+
+		Returns:
+			None
+		"""
+		self.inc(-amount, **labels)
+
+	def replace(self, values: Dict[tuple, float]) -> None:
+		"""Replace
+
+		Replaces every value of the gauge at once, dropping any label values \
+		not included
+
+		Arguments:
+			values (dict): The values by tuple of label values
+
+		Returns:
+			None
+		"""
+		with self._lock:
+			self._values = dict(values)
+
+	def set(self, value: float, **labels) -> None:
+		"""Set
+
+		Sets the gauge
+
+		Arguments:
+			value (float): The new value
+			**labels (str): The label values
+
+		Returns:
+			None
+		"""
+		tKey = self._key(labels)
+		with self._lock:
+			self._values[tKey] = value
+
+class Histogram(_Metric):
+	"""Histogram
+
+	Counts observations into buckets, along with their sum and count
+	"""
+
+	type = 'histogram'
+
+	def __init__(self,
+		name: str,
+		help: str,
+		labels: Tuple[str] = (),
+		buckets: Tuple[float] = BUCKETS
+	):
+		"""Constructor
+
+		Creates a new instance and adds it to those rendered
+
+		Arguments:
+			name (str): The name of the metric
+			help (str): The description written in the HELP line
+			labels (str[]): The names of the labels, if any
+			buckets (float[]): The upper bounds of the buckets
+
+		Returns:
+			Histogram
+		"""
+		super().__init__(name, help, labels)
+		self._buckets = tuple(sorted(buckets))
+
+	def observe(self, value: float, **labels) -> None:
+		"""Observe
+
+		Adds an observation
+
+		Arguments:
+			value (float): The value observed
+			**labels (str): The label values
+
+		Returns:
+			None
+		"""
+
+		# Find the first bucket the value fits in
+		i = 0
+		for fBound in self._buckets:
+			if value <= fBound:
+				break
+			i += 1
+
+		# Add it
+		tKey = self._key(labels)
+		with self._lock:
+			try:
+				lCounts, fSum = self._values[tKey]
+			except KeyError:
+				lCounts, fSum = [ 0 ] * (len(self._buckets) + 1), 0.0
+			lCounts[i] += 1
+			self._values[tKey] = ( lCounts, fSum + value )
+
+	def samples(self) -> List[str]:
+		"""Samples
+
+		Returns the cumulative bucket, sum, and count lines of the histogram
+
+		Returns:
+			str[]
+		"""
+
+		# Copy the values so we don't hold the lock while formatting
+		with self._lock:
+			lValues = [ ( k, list(t[0]), t[1] ) for k, t in self._values.items() ]
+
+		# Go through each set of labels
+		lLines = []
+		tNames = self.labels + ( 'le', )
+		for tKey, lCounts, fSum in lValues:
+			iTotal = 0
+			for fBound, iCount in zip(self._buckets + ( '+Inf', ), lCounts):
+				iTotal += iCount
+				lLines.append('%s_bucket%s %d' % (
+					self.name,
+					_labels(tNames, tKey + ( fBound, )),
+					iTotal
+				))
+			lLines.append('%s_sum%s %s' % (
+				self.name, _labels(self.labels, tKey), repr(fSum)
+			))
+			lLines.append('%s_count%s %d' % (
+				self.name, _labels(self.labels, tKey), iTotal
+			))
+
+		# Return the lines
+		return lLines
+
+	@contextmanager
+	def time(self, **labels):
+		"""Time
+
+		Observes how long the with block takes, whether it succeeds or not
+
+		Arguments:
+			**labels (str): The label values
+		"""
+		fStart = perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(perf_counter() - fStart, **labels)
+
+def render() -> str:
+	"""Render
+
+	Returns every metric in the text format
+
+	Returns:
+		str
+	"""
+	return '\n'.join(m.render() for m in _registry) + '\n'
+
+# Metrics shared by more than one part of the system
+HTTP_REQUESTS = Counter(
+	'contact_http_requests_total',
+	'HTTP requests handled, by node, route, and status',
+	( 'node', 'route', 'status' )
+)
+HTTP_SECONDS = Histogram(
+	'contact_http_request_seconds',
+	'Time spent handling HTTP requests, by node and route',
+	( 'node', 'route' )
+)
+MYSQL_ERRORS = Counter(
+	'contact_mysql_errors_total',
+	'record_mysql calls that raised, by call',
+	( 'call', )
+)
+MYSQL_SECONDS = Histogram(
+	'contact_mysql_seconds',
+	'Time spent in record_mysql calls, by call',
+	( 'call', )
+)
+RENDER_SECONDS = Histogram(
+	'contact_template_render_seconds',
+	'Time spent rendering a campaign subject or content',
+	buckets = ( 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05 )
+)
+SMTP_ERRORS = Counter(
+	'contact_smtp_errors_total',
+	'SMTP steps that failed, by step',
+	( 'step', )
+)
+SMTP_SECONDS = Histogram(
+	'contact_smtp_seconds',
+	'Time spent on SMTP steps, by step, one of connect, login, or send',
+	( 'step', )
+)
+
+@contextmanager
+def smtp(step: str):
+	"""SMTP
+
+	Times an SMTP step, and counts it if it fails
+
+	Arguments:
+		step (str): The step, one of 'connect', 'login', or 'send'
+	"""
+	fStart = perf_counter()
+	try:
+		yield
+	except Exception:
+		SMTP_ERRORS.inc(step = step)
+		raise
+	finally:
+		SMTP_SECONDS.observe(perf_counter() - fStart, step = step)
+
+def instrument_mysql() -> None:
+	"""Instrument MySQL
+
+	Times every execute, insert, and select made through record_mysql, \
+	both by the records themselves and by our own SQL helpers, which all \
+	call through the server module. Safe to call more than once
+
+	Returns:
+		None
+	"""
+
+	# Go through each call, and the position of its errcnt argument
+	for sCall, iErrCnt in [ ( 'execute', 2 ), ( 'insert', 2 ), ( 'select', 4 ) ]:
+
+		# If it's already wrapped, skip it
+		fOriginal = getattr(server, sCall)
+		if getattr(fOriginal, '_metrics', False):
+			continue
+
+		# Wrap it. The calls retry themselves on connection errors, so only
+		#	the outermost call is timed
+		def wrap(func: Callable, call: str, errcnt: int) -> Callable:
+			@wraps(func)
+			def wrapped(*args, **kwargs):
+				if kwargs.get('errcnt') or \
+					(len(args) > errcnt and args[errcnt]):
+					return func(*args, **kwargs)
+				fStart = perf_counter()
+				try:
+					return func(*args, **kwargs)
+				except Exception:
+					MYSQL_ERRORS.inc(call = call)
+					raise
+				finally:
+					MYSQL_SECONDS.observe(perf_counter() - fStart, call = call)
+			wrapped._metrics = True
+			return wrapped
+		setattr(server, sCall, wrap(fOriginal, sCall, iErrCnt))
+
+class Plugin(object):
+	"""Plugin
+
+	A bottle plugin that counts and times every request to the app it's \
+	installed on
+	"""
+
+	api = 2
+	name = 'metrics'
+
+	def __init__(self, node: str):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			node (str): The name of the node, used as a label
+
+		Returns:
+			Plugin
+		"""
+		self._node = node
+
+	def apply(self, callback: Callable, route: bottle.Route) -> Callable:
+		"""Apply
+
+		Called by bottle to wrap each route's callback
+
+		Arguments:
+			callback (callable): The route's callback
+			route (bottle.Route): The route
+
+		Returns:
+			callable
+		"""
+
+		# Use the rule, not the URL, so IDs don't create new labels
+		sRoute = '%s %s' % ( route.method, route.rule )
+
+		@wraps(callback)
+		def wrapped(*args, **kwargs):
+			fStart = perf_counter()
+			iStatus = 500
+			try:
+				mRes = callback(*args, **kwargs)
+				iStatus = isinstance(mRes, bottle.BaseResponse) and \
+					mRes.status_code or bottle.response.status_code
+				return mRes
+			except bottle.HTTPResponse as e:
+				iStatus = e.status_code
+				raise
+			finally:
+				HTTP_SECONDS.observe(
+					perf_counter() - fStart, node = self._node, route = sRoute
+				)
+				HTTP_REQUESTS.inc(
+					node = self._node, route = sRoute, status = str(iStatus)
+				)
+		return wrapped
+
+def endpoint() -> str:
+	"""Endpoint
+
+	A bottle callback that returns every metric in the text format
+
+	Returns:
+		str
+	"""
+	bottle.response.headers['Content-Type'] = CONTENT_TYPE
+	return render()
+
+def add_routes(app: bottle.Bottle, node: str, path: str = '/metrics') -> None:
+	"""Add Routes
+
+	Counts and times every request to the app, and adds the endpoint to it
+
+	Arguments:
+		app (bottle.Bottle): The app to instrument
+		node (str): The name of the node, used as a label
+		path (str): The path to serve the metrics on
+
+	Returns:
+		None
+	"""
+	app.install(Plugin(node))
+	app.route(path, 'GET', endpoint, skip = [ Plugin ])
+
+class _QuietHandler(WSGIRequestHandler):
+	"""Quiet Handler
+
+	Keeps scrapes out of the daemon's output
+	"""
+
+	def log_message(self, *args):
+		pass
+
+def serve(host: str, port: int) -> Thread:
+	"""Serve
+
+	Serves the endpoint from a background thread, for processes that \
+	aren't already HTTP servers
+
+	Arguments:
+		host (str): The address to bind to
+		port (uint): The port to bind to
+
+	Returns:
+		Thread
+	"""
+	oApp = bottle.Bottle()
+	oApp.route('/metrics', 'GET', endpoint)
+	oServer = make_server(host, port, oApp, handler_class = _QuietHandler)
+	oThread = Thread(
+		target = oServer.serve_forever, name = 'metrics', daemon = True
+	)
+	oThread.start()
+	return oThread
@@ -0,0 +1,165 @@
+# coding=utf8
+""" Rate Limit
+
+Handles limiting how many messages each sender can send, across every \
+campaign using it, with a token bucket per sender
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-15"
+
+# Ouroboros imports
+from nredis import nr
+
+# Python imports
+from time import monotonic
+from typing import Dict, Tuple
+
+KEY = 'contact:sender:%s:bucket'
+"""The Redis key used to store a sender's bucket"""
+
+_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= 1 then
+	tokens = tokens - 1
+else
+	wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+"""Refills and takes a token from a bucket in one step, returning the \
+seconds to wait if there wasn't one"""
+
+def limits(sender: dict) -> Tuple[float, float] | None:
+	"""Limits
+
+	Returns the rate, in tokens per second, and the burst of the sender, or \
+	None if the sender isn't limited
+
+	Arguments:
+		sender (dict): The sender record
+
+	Returns:
+		tuple | None
+	"""
+
+	# If there's no rate, there's no limit
+	if not sender.get('rate'):
+		return None
+
+	# Convert the hourly rate, and default the burst to a single message
+	return (
+		sender['rate'] / 3600.0,
+		float(max(1, sender.get('burst') or 1))
+	)
+
+class Local(object):
+	"""Local
+
+	Keeps the buckets in memory, only useful when a single daemon process \
+	is sending
+	"""
+
+	def __init__(self):
+		"""Constructor
+
+		Creates a new instance
+
+		Returns:
+			Local
+		"""
+
+		# Init the buckets of (tokens, last refill) by sender _id
+		self._buckets: Dict[str, Tuple[float, float]] = {}
+
+	def take(self, sender: dict) -> float:
+		"""Take
+
+		Takes a token from the sender's bucket if there is one
+
+		Arguments:
+			sender (dict): The sender record
+
+		Returns:
+			float, 0 if a token was taken, else the seconds until there will \
+			be one
+		"""
+
+		# If the sender isn't limited, there's always a token
+		tLimits = limits(sender)
+		if tLimits is None:
+			return 0
+		fRate, fBurst = tLimits
+
+		# Refill the bucket from the time passed since it was last touched
+		fNow = monotonic()
+		fTokens, fAt = self._buckets.get(sender['_id'], (fBurst, fNow))
+		fTokens = min(fBurst, fTokens + (fNow - fAt) * fRate)
+
+		# Take a token, or figure out how long until there is one
+		fWait = 0
+		if fTokens >= 1:
+			fTokens -= 1
+		else:
+			fWait = (1 - fTokens) / fRate
+
+		# Store the bucket and return the wait
+		self._buckets[sender['_id']] = (fTokens, fNow)
+		return fWait
+
+class Redis(object):
+	"""Redis
+
+	Keeps the buckets in Redis so that every daemon process sending with \
+	the same sender draws from the same bucket
+	"""
+
+	def __init__(self, name: str = 'records'):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			name (str): The name of the Redis connection in config
+
+		Returns:
+			Redis
+		"""
+		self._redis = nr(name)
+		self._take = self._redis.register_script(_TAKE)
+
+	def take(self, sender: dict) -> float:
+		"""Take
+
+		Takes a token from the sender's bucket if there is one
+
+		Arguments:
+			sender (dict): The sender record
+
+		Returns:
+			float, 0 if a token was taken, else the seconds until there will \
+			be one
+		"""
+
+		# If the sender isn't limited, there's always a token
+		tLimits = limits(sender)
+		if tLimits is None:
+			return 0
+
+		# Refill and take in Redis and return the wait
+		return float(self._take(
+			keys = [ KEY % sender['_id'] ],
+			args = [ repr(tLimits[0]), repr(tLimits[1]) ]
+		))
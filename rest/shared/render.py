@@ -0,0 +1,96 @@
+# coding=utf8
+""" Render
+
+Handles turning a campaign's pre-encoded message into the bytes sent to a \
+single contact, and reading the subject and content back out for logging
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-23"
+
+# Python imports
+import email
+import email.header
+from email.message import Message
+from typing import Dict, Tuple
+
+# Shared imports
+from shared.templates import Skeleton
+
+def content(message_: Message | bytes) -> Tuple[str, str]:
+	"""Content
+
+	Returns the subject and content of a message generated by raw(), or any \
+	other single part message, for logging
+
+	Arguments:
+		message_ (Message | bytes): The message
+
+	Returns:
+		str, str
+	"""
+	if isinstance(message_, bytes):
+		message_ = email.message_from_bytes(message_)
+	oPart = message_.get_payload(0)
+	return str(email.header.make_header(
+		email.header.decode_header(message_['Subject'])
+	)), oPart.get_payload(decode = True).decode(
+		oPart.get_content_charset() or 'utf-8'
+	)
+
+def raw(
+	sender: str,
+	contact: dict,
+	skeleton: Skeleton,
+	unsubscribe_root: str
+) -> bytes:
+	"""Raw
+
+	Splices the contact's details into the campaign's pre-encoded message \
+	and returns the bytes to send them, without building or encoding any \
+	MIME
+
+	Arguments:
+		sender (str): The e-mail address of the sender
+		contact (dict): The contact, with their campaign contact ID, name, \
+			alias, company, and email address
+		skeleton (Skeleton): The pre-encoded message of the campaign
+		unsubscribe_root (str): The URL used to generate unsubscribe links
+
+	Returns:
+		bytes
+	"""
+	return skeleton.render(values(contact, unsubscribe_root), {
+		'From': sender,
+		'To': contact['email_address'],
+		'List-Unsubscribe': '<%soneclick/%s>' % (
+			unsubscribe_root, contact['campaign_contact_id']
+		)
+	})
+
+def values(contact: dict, unsubscribe_root: str) -> Dict[str, str]:
+	"""Values
+
+	Returns the value of each placeholder for the contact, if the alias is \
+	missing, the name is used
+
+	Arguments:
+		contact (dict): The contact, with their campaign contact ID, name, \
+			alias, company, and email address
+		unsubscribe_root (str): The URL used to generate unsubscribe links
+
+	Returns:
+		dict
+	"""
+	return {
+		'_id': contact['campaign_contact_id'],
+		'name': contact['name'],
+		'alias': contact.get('alias') or contact['name'],
+		'company': contact['company'],
+		'email_address': contact['email_address'],
+		'unsubscribe_url': '%s%s' % (
+			unsubscribe_root, contact['campaign_contact_id']
+		)
+	}
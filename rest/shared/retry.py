@@ -0,0 +1,113 @@
+# coding=utf8
+""" Retry
+
+Handles deciding whether a failed message should be tried again, and when
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-20"
+
+# Pip imports
+import aiosmtplib
+
+# Python imports
+import asyncio
+from random import uniform
+import smtplib
+from typing import Tuple
+
+SENDER_ERRORS = (
+	smtplib.SMTPAuthenticationError, smtplib.SMTPConnectError,
+	smtplib.SMTPHeloError, smtplib.SMTPNotSupportedError,
+	smtplib.SMTPSenderRefused,
+	aiosmtplib.SMTPAuthenticationError, aiosmtplib.SMTPConnectError,
+	aiosmtplib.SMTPHeloError, aiosmtplib.SMTPNotSupported,
+	aiosmtplib.SMTPSenderRefused
+)
+"""Errors caused by the sender or its server, not the recipient, so the \
+message is always worth trying again, even with a 5xx code"""
+
+def backoff(attempts: int, base: float = 60, cap: float = 3600) -> float:
+	"""Backoff
+
+	Returns the seconds to wait before the next attempt, doubling with each \
+	attempt up to the cap, with half of it random so that failures from the \
+	same outage don't all come back at once
+
+	Arguments:
+		attempts (uint): The number of attempts already made
+		base (float): The seconds to wait after the first attempt
+		cap (float): The most seconds to ever wait
+
+	Returns:
+		float
+	"""
+	fDelay = min(cap, base * (2 ** max(0, attempts - 1)))
+	return fDelay / 2 + uniform(0, fDelay / 2)
+
+def code(error: Exception) -> int | None:
+	"""Code
+
+	Returns the SMTP reply code of the error, if it has one
+
+	Arguments:
+		error (Exception): The error raised while sending
+
+	Returns:
+		uint | None
+	"""
+
+	# If it's a refused recipient, use its code, we only ever send to one
+	if isinstance(error, smtplib.SMTPRecipientsRefused):
+		lCodes = [ t[0] for t in error.recipients.values() ]
+		return lCodes and max(lCodes) or None
+	if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+		lCodes = [ o.code for o in error.recipients ]
+		return lCodes and max(lCodes) or None
+
+	# If it's any other reply from the server
+	if isinstance(error, smtplib.SMTPResponseException):
+		return error.smtp_code
+	if isinstance(error, aiosmtplib.SMTPResponseException):
+		return error.code
+
+	# Else, there is no code
+	return None
+
+def classify(error: Exception) -> Tuple[bool, int | None]:
+	"""Classify
+
+	Returns whether the error is transient, and its SMTP code if it has one. \
+	4xx replies, dropped connections, timeouts, and anything wrong with the \
+	sender are transient. 5xx replies about the recipient or the message, \
+	and anything else, are permanent
+
+	Arguments:
+		error (Exception): The error raised while sending
+
+	Returns:
+		(bool, uint | None)
+	"""
+
+	# Get the code
+	iCode = code(error)
+
+	# If the sender is the problem, it's not the recipient's fault
+	if isinstance(error, SENDER_ERRORS):
+		return True, iCode
+
+	# If we have a code, 4xx is transient, anything else is permanent
+	if iCode is not None:
+		return 400 <= iCode < 500, iCode
+
+	# Connection problems and timeouts are transient. smtplib's errors are
+	#	all OSErrors
+	if isinstance(error, (
+		OSError, asyncio.TimeoutError, aiosmtplib.SMTPException
+	)):
+		return True, None
+
+	# Anything else is a bug in the message, and won't get better
+	return False, None
@@ -0,0 +1,119 @@
+# coding=utf8
+""" Rotation
+
+Handles spreading a campaign's messages across its pool of senders, \
+skipping any whose breaker is open
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-16"
+
+# Python imports
+from typing import Dict, List, Tuple
+
+# Shared imports
+from shared import breaker
+
+class Rotation(object):
+	"""Rotation
+
+	Orders each campaign's senders using smooth weighted round-robin, so a \
+	sender with twice the weight gets every other message instead of two \
+	in a row, and skips any sender whose breaker is open
+	"""
+
+	def __init__(self, breaker_: breaker.Breaker):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			breaker_ (breaker.Breaker): The breakers of the senders
+
+		Returns:
+			Rotation
+		"""
+
+		# Store the breakers
+		self._breaker = breaker_
+
+		# Init the current weights by campaign then sender
+		self._current: Dict[str, Dict[str, int]] = {}
+
+	def order(self,
+		campaign_id: str,
+		senders: List[Tuple[str, int]]
+	) -> List[str]:
+		"""Order
+
+		Returns the IDs of the campaign's usable senders, in the order they \
+		should be tried. Nothing changes until use() is called with the one \
+		actually used
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+			senders ((str, uint)[]): The ID and weight of each sender
+
+		Returns:
+			str[]
+		"""
+
+		# Get the current weights of the campaign
+		dCurrent = self._current.get(campaign_id, {})
+
+		# Get the senders whose breakers let them through
+		lSenders = [ t for t in senders if self._breaker.usable(t[0]) ]
+
+		# Sort them by the weight they will have once the round is added
+		lSenders.sort(
+			key = lambda t: dCurrent.get(t[0], 0) + t[1],
+			reverse = True
+		)
+
+		# Return the IDs
+		return [ t[0] for t in lSenders ]
+
+	def use(self,
+		campaign_id: str,
+		sender_id: str,
+		senders: List[Tuple[str, int]]
+	) -> None:
+		"""Use
+
+		Records that the given sender was used for the campaign's message, \
+		moving it to the back of the rotation
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+			sender_id (str): The ID of the sender used
+			senders ((str, uint)[]): The ID and weight of each sender
+
+		Returns:
+			None
+		"""
+
+		# Get the current weights of the campaign, dropping any senders no
+		#	longer in it
+		dOld = self._current.get(campaign_id, {})
+		dCurrent = { s: dOld.get(s, 0) + i for s, i in senders }
+
+		# Take the total from the one used
+		dCurrent[sender_id] -= sum(i for _, i in senders)
+
+		# Store the weights
+		self._current[campaign_id] = dCurrent
+
+	def remove(self, campaign_id: str) -> None:
+		"""Remove
+
+		Forgets a campaign
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+
+		Returns:
+			None
+		"""
+		self._current.pop(campaign_id, None)
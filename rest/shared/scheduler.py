@@ -0,0 +1,392 @@
+# coding=utf8
+""" Scheduler
+
+Keeps track of when each campaign is next due so the daemon can sleep until \
+exactly then, and lets other processes wake it early when campaigns change
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-12"
+
+# Ouroboros imports
+from nredis import nr
+
+# Python imports
+import heapq
+from threading import Event
+from time import monotonic, time
+from typing import Dict, List, Tuple
+
+# Record imports
+from records.admin import campaign
+
+# Shared imports
+from shared import log
+
+CHANNEL = 'contact:campaigns'
+"""The Redis channel used to let the daemon know a campaign changed"""
+
+__notifier = None
+"""The notifier used by notify()"""
+
+_log = log.get('scheduler')
+"""The logger for the scheduler"""
+
+class Local(object):
+	"""Local
+
+	An in-process stand in for the Redis channel, used by tests and when the \
+	daemon and the services that change campaigns share a process
+	"""
+
+	def __init__(self):
+		"""Constructor
+
+		Creates a new instance
+
+		Returns:
+			Local
+		"""
+		self._event = Event()
+
+	def publish(self, message: str) -> None:
+		"""Publish
+
+		Wakes up anyone waiting
+
+		Arguments:
+			message (str): The message, ignored
+
+		Returns:
+			None
+		"""
+		self._event.set()
+
+	def wait(self, timeout: float) -> bool:
+		"""Wait
+
+		Waits until a message is published or the timeout passes
+
+		Arguments:
+			timeout (float): The maximum seconds to wait
+
+		Returns:
+			bool, True if a message was published
+		"""
+		bRes = self._event.wait(timeout)
+		self._event.clear()
+		return bRes
+
+class Redis(object):
+	"""Redis
+
+	Publishes and waits on a Redis pub/sub channel so that the services \
+	can wake the daemon from another process or server
+	"""
+
+	def __init__(self, name: str = 'records', channel: str = CHANNEL):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			name (str): The name of the Redis connection in config
+			channel (str): The channel to publish and listen on
+
+		Returns:
+			Redis
+		"""
+		self._redis = nr(name)
+		self._channel = channel
+		self._pubsub = None
+
+	def publish(self, message: str) -> None:
+		"""Publish
+
+		Sends a message to anyone listening on the channel
+
+		Arguments:
+			message (str): The message to send
+
+		Returns:
+			None
+		"""
+		self._redis.publish(self._channel, message)
+
+	def wait(self, timeout: float) -> bool:
+		"""Wait
+
+		Waits until a message is published or the timeout passes
+
+		Arguments:
+			timeout (float): The maximum seconds to wait
+
+		Returns:
+			bool, True if a message was published
+		"""
+
+		# If we aren't subscribed yet
+		if self._pubsub is None:
+			self._pubsub = self._redis.pubsub(ignore_subscribe_messages = True)
+			self._pubsub.subscribe(self._channel)
+
+		# Keep checking until we get a message or run out of time, the
+		#	subscribe confirmation can return early with nothing
+		fEnd = monotonic() + timeout
+		while True:
+			fLeft = fEnd - monotonic()
+			if fLeft <= 0:
+				return False
+			if self._pubsub.get_message(timeout = fLeft):
+				break
+
+		# Clear out anything else that came in at the same time
+		while self._pubsub.get_message(timeout = 0):
+			pass
+
+		# Let the caller know we were woken
+		return True
+
+def notifier(set_: Local | Redis = None) -> Local | Redis:
+	"""Notifier
+
+	Sets/Gets the notifier used by notify(). Defaults to the Redis channel on \
+	the "records" connection
+
+	Arguments:
+		set_ (Local | Redis): Optional, the notifier to use from now on
+
+	Returns:
+		Local | Redis
+	"""
+	global __notifier
+	if set_ is not None:
+		__notifier = set_
+	elif __notifier is None:
+		__notifier = Redis()
+	return __notifier
+
+def notify(campaign_id: str) -> bool:
+	"""Notify
+
+	Lets the daemon know a campaign was created or changed so it can \
+	reschedule without waiting. Failing to notify is not fatal, the daemon \
+	will see the change on its next refresh
+
+	Arguments:
+		campaign_id (str): The ID of the campaign that changed
+
+	Returns:
+		bool
+	"""
+	try:
+		notifier().publish(campaign_id)
+		return True
+	except Exception as e:
+		_log.warning('notify failed', extra = { 'data': {
+			'campaign': campaign_id, 'error': str(e)
+		} })
+		return False
+
+class Scheduler(object):
+	"""Scheduler
+
+	Keeps a min-heap of campaign triggers refreshed incrementally from the DB
+	"""
+
+	def __init__(self, notifier_: Local | Redis = None, max_wait: int = 300):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			notifier_ (Local | Redis): Optional, what to wait on between \
+				triggers, defaults to notifier()
+			max_wait (uint): The maximum seconds to wait before checking the \
+				DB for changes even if no one told us about any
+
+		Returns:
+			Scheduler
+		"""
+
+		# Store the notifier and the max wait
+		self._notifier = notifier_ or notifier()
+		self._max_wait = max_wait
+
+		# Init the heap of (trigger, _id) and the current trigger by ID. The
+		#	heap can hold outdated entries, only the ones matching the current
+		#	trigger are valid
+		self._heap: List[Tuple[int, str]] = []
+		self._triggers: Dict[str, int] = {}
+
+		# The newest `_updated` value seen
+		self._updated: int | None = None
+
+	def __len__(self) -> int:
+		"""Length (__len__)
+
+		Returns the count of campaigns scheduled
+
+		Returns:
+			uint
+		"""
+		return len(self._triggers)
+
+	def ids(self) -> List[str]:
+		"""IDs
+
+		Returns the IDs of every campaign scheduled
+
+		Returns:
+			str[]
+		"""
+		return list(self._triggers.keys())
+
+	def _peek(self) -> Tuple[int, str] | None:
+		"""Peek
+
+		Drops any outdated entries from the top of the heap and returns the \
+		earliest valid one
+
+		Returns:
+			tuple | None
+		"""
+		while self._heap:
+			iTrigger, _id = self._heap[0]
+			if self._triggers.get(_id) == iTrigger:
+				return self._heap[0]
+			heapq.heappop(self._heap)
+		return None
+
+	def due(self, now: int = None) -> List[str]:
+		"""Due
+
+		Removes and returns the IDs of every campaign whose trigger is at or \
+		before now. They stay off the schedule until set() or refresh() \
+		puts them back
+
+		Arguments:
+			now (uint): Optional, the timestamp to compare against
+
+		Returns:
+			str[]
+		"""
+
+		# If we didn't get a time, use now
+		if now is None:
+			now = int(time())
+
+		# Pop everything that's due
+		lIDs = []
+		while True:
+			tTop = self._peek()
+			if tTop is None or tTop[0] > now:
+				break
+			heapq.heappop(self._heap)
+			del self._triggers[tTop[1]]
+			lIDs.append(tTop[1])
+
+		# Return the IDs
+		return lIDs
+
+	def refresh(self) -> int:
+		"""Refresh
+
+		Fetches any campaigns changed since the last refresh, or all \
+		triggered campaigns the first time, and updates the schedule. The \
+		daemon's own triggers and pauses leave `_updated` alone, so only \
+		campaigns that were edited, or whose audience was just finished, are \
+		fetched again
+
+		Returns:
+			uint, the number of campaigns fetched
+		"""
+
+		# If this is the first time, get every campaign with a trigger, else
+		#	get everything changed since the last time. Timestamps are only
+		#	to the second so we include the last second seen again
+		if self._updated is None:
+			dFilter = { 'next_trigger': { 'neq': None } }
+		else:
+			dFilter = { '_updated': { 'gte': self._updated } }
+
+		# Fetch the campaigns
+		lCampaigns = campaign.Campaign.filter(
+			dFilter,
+			raw = [ '_id', '_updated', 'next_trigger' ]
+		)
+
+		# Go through each one and update the schedule and the last updated
+		for d in lCampaigns:
+			self.set(d['_id'], d['next_trigger'])
+			if self._updated is None or d['_updated'] > self._updated:
+				self._updated = d['_updated']
+
+		# Return the count
+		return len(lCampaigns)
+
+	def set(self, campaign_id: str, trigger: int | None) -> None:
+		"""Set
+
+		Sets, or removes, the next trigger for a campaign
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+			trigger (int | None): The timestamp of the next trigger, None to \
+				remove the campaign from the schedule
+
+		Returns:
+			None
+		"""
+
+		# If there's no trigger, remove it
+		if trigger is None:
+			self._triggers.pop(campaign_id, None)
+			return
+
+		# If it's unchanged, do nothing
+		if self._triggers.get(campaign_id) == trigger:
+			return
+
+		# Store the new trigger and add it to the heap
+		self._triggers[campaign_id] = trigger
+		heapq.heappush(self._heap, (trigger, campaign_id))
+
+	def timeout(self) -> float:
+		"""Timeout
+
+		Returns the seconds until the earliest campaign is due, or the max \
+		wait if that comes first
+
+		Returns:
+			float
+		"""
+
+		# Figure out how long until the next trigger
+		fWait = self._max_wait
+		tTop = self._peek()
+		if tTop is not None:
+			fWait = min(fWait, tTop[0] - time())
+
+		# Never return less than nothing
+		return max(0, fWait)
+
+	def wait(self) -> bool:
+		"""Wait
+
+		Sleeps until the earliest campaign is due, we are notified of a \
+		change, or the max wait passes, whichever comes first
+
+		Returns:
+			bool, True if we were notified
+		"""
+
+		# If it's already due, don't wait
+		fWait = self.timeout()
+		if fWait <= 0:
+			return False
+
+		# Wait
+		return self._notifier.wait(fWait)
@@ -0,0 +1,778 @@
+# coding=utf8
+""" SMTP
+
+Handles keeping authenticated SMTP connections open between messages, for \
+both the blocking and the asyncio daemons
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-12"
+
+# Python imports
+import asyncio
+from contextlib import asynccontextmanager
+from email.message import Message
+import smtplib
+from time import monotonic
+from typing import Callable, Dict, List
+
+# Pip imports
+import aiosmtplib
+
+# Shared imports
+from shared import metrics
+
+TIMEOUTS = { 'connect': 10, 'command': 30, 'data': 120 }
+"""The default seconds allowed to connect, for each command, and to send \
+the message"""
+
+def observed(
+	observe: Callable[[str, float, Exception | None], None] | None,
+	sender_id: str,
+	start: float,
+	error: Exception = None
+) -> None:
+	"""Observed
+
+	Passes the time the server took to handle a message, and the error it \
+	failed with, if any, to the pool's observer, if it has one
+
+	Arguments:
+		observe (callable | None): The observer
+		sender_id (str): The unique ID of the sender
+		start (float): The monotonic time the message was started
+		error (Exception): Optional, the error the message failed with
+
+	Returns:
+		None
+	"""
+	if observe is not None:
+		observe(sender_id, monotonic() - start, error)
+
+def timeouts(sender: dict, defaults: Dict[str, float]) -> Dict[str, float]:
+	"""Timeouts
+
+	Returns the connect, command, and data timeouts of the sender, using \
+	the defaults for any it doesn't set
+
+	Arguments:
+		sender (dict): The sender record
+		defaults (dict): The default timeouts
+
+	Returns:
+		dict
+	"""
+	return {
+		k: sender.get('timeout_%s' % k) or defaults.get(k) or TIMEOUTS[k]
+		for k in TIMEOUTS
+	}
+
+class _SMTP(smtplib.SMTP):
+	"""SMTP
+
+	A blocking connection that remembers if DATA was sent, after which the \
+	server may have accepted the message even if the connection dropped
+	"""
+
+	data_sent = False
+	"""Set when DATA is sent, cleared by the pool before each message"""
+
+	def data(self, msg):
+		"""Data
+
+		Notes that DATA was sent, then sends it
+
+		Arguments:
+			msg (bytes | str): The message
+
+		Returns:
+			tuple, the code and message of the reply
+		"""
+		self.data_sent = True
+		return super().data(msg)
+
+class _AsyncSMTP(aiosmtplib.SMTP):
+	"""Async SMTP
+
+	An asyncio connection that remembers if DATA was sent, after which the \
+	server may have accepted the message even if the connection dropped
+	"""
+
+	data_sent = False
+	"""Set when DATA is sent, cleared by the pool before each message"""
+
+	async def data(self, message, *args, **kwargs):
+		"""Data
+
+		Notes that DATA was sent, then sends it
+
+		Arguments:
+			message (bytes | str): The message
+
+		Returns:
+			aiosmtplib.SMTPResponse
+		"""
+		self.data_sent = True
+		return await super().data(message, *args, **kwargs)
+
+class Pool(object):
+	"""Pool
+
+	Keeps one authenticated SMTP session open per sender so that messages \
+	after the first only cost a MAIL / RCPT / DATA exchange instead of a full \
+	connect, STARTTLS, and login
+	"""
+
+	def __init__(self,
+		max_idle: int = 300,
+		noop_after: int = 30,
+		timeouts: Dict[str, float] = None,
+		observe: Callable[[str, float, Exception | None], None] = None
+	):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			max_idle (uint): The number of seconds a connection can sit unused \
+				before it's closed
+			noop_after (uint): The number of seconds a connection can sit \
+				unused before it's checked with a NOOP before being reused
+			timeouts (dict): Optional, the default connect, command, and data \
+				timeouts, in seconds, for senders that don't set their own
+			observe (callable): Optional, called with the sender _id, the \
+				seconds the server took, and the error, if any, after each \
+				message
+
+		Returns:
+			Pool
+		"""
+
+		# Store the limits
+		self._max_idle = max_idle
+		self._noop_after = noop_after
+		self._timeouts = timeouts or {}
+		self._observe = observe
+
+		# Init the connections, keyed by sender _id
+		self._connections: Dict[str, dict] = {}
+
+	def __enter__(self):
+		"""Enter (__enter__)
+
+		Allows the pool to be used in a with statement
+
+		Returns:
+			Pool
+		"""
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		"""Exit (__exit__)
+
+		Closes all connections when the with statement ends
+
+		Returns:
+			False
+		"""
+		self.close()
+		return False
+
+	def _connect(self, sender: dict) -> smtplib.SMTP:
+		"""Connect
+
+		Opens and authenticates a new connection for the sender
+
+		Arguments:
+			sender (dict): The sender record
+
+		Returns:
+			smtplib.SMTP
+		"""
+
+		# Get the timeouts
+		dTimeouts = timeouts(sender, self._timeouts)
+
+		# Connect to the SMTP server, giving up if it doesn't answer in time
+		with metrics.smtp('connect'):
+			oSMTP = _SMTP(
+				sender['host'],
+				sender['port'],
+				timeout = dTimeouts['connect']
+			)
+
+		# If anything fails before we are logged in, don't leave the socket
+		#	hanging
+		try:
+
+			# From now on, each command gets its own timeout. The TLS socket
+			#	keeps the timeout of the one it wraps
+			oSMTP.timeout = dTimeouts['command']
+			oSMTP.sock.settimeout(dTimeouts['command'])
+
+			with metrics.smtp('login'):
+
+				# If we need tls
+				if sender['tls']:
+					oSMTP.starttls()
+
+				# Login
+				oSMTP.login(sender['email_address'], sender['password'])
+
+		except Exception:
+			self._quit(oSMTP)
+			raise
+
+		# Store the connection and return it
+		self._connections[sender['_id']] = {
+			'smtp': oSMTP,
+			'timeouts': dTimeouts,
+			'updated': sender.get('_updated'),
+			'used': monotonic()
+		}
+		return oSMTP
+
+	def _get(self, sender: dict) -> smtplib.SMTP:
+		"""Get
+
+		Returns an open connection for the sender, re-using the existing one \
+		if it's still healthy, else opening a new one
+
+		Arguments:
+			sender (dict): The sender record
+
+		Returns:
+			smtplib.SMTP
+		"""
+
+		# If we have no connection, make one
+		try:
+			dConn = self._connections[sender['_id']]
+		except KeyError:
+			return self._connect(sender)
+
+		# If the sender was changed since we connected, or the connection has
+		#	been idle too long, start again
+		fIdle = monotonic() - dConn['used']
+		if dConn['updated'] != sender.get('_updated') or \
+			fIdle > self._max_idle:
+			self.discard(sender['_id'])
+			return self._connect(sender)
+
+		# If it's been a while, make sure the server is still listening
+		if fIdle > self._noop_after:
+			try:
+				iCode, _ = dConn['smtp'].noop()
+			except smtplib.SMTPException:
+				iCode = None
+			if iCode != 250:
+				self.discard(sender['_id'])
+				return self._connect(sender)
+
+		# Return the existing connection
+		return dConn['smtp']
+
+	@staticmethod
+	def _quit(smtp: smtplib.SMTP) -> None:
+		"""Quit
+
+		Closes a connection, ignoring any errors from a server that has \
+		already gone away
+
+		Arguments:
+			smtp (smtplib.SMTP): The connection to close
+
+		Returns:
+			None
+		"""
+		try:
+			smtp.quit()
+		except Exception:
+			smtp.close()
+
+	def close(self) -> None:
+		"""Close
+
+		Closes every open connection
+
+		Returns:
+			None
+		"""
+		for _id in list(self._connections.keys()):
+			self.discard(_id)
+
+	def discard(self, sender_id: str) -> None:
+		"""Discard
+
+		Closes and forgets the connection for a single sender
+
+		Arguments:
+			sender_id (str): The unique ID of the sender
+
+		Returns:
+			None
+		"""
+		try:
+			dConn = self._connections.pop(sender_id)
+		except KeyError:
+			return
+		self._quit(dConn['smtp'])
+
+	def prune(self) -> int:
+		"""Prune
+
+		Closes any connections that have been idle longer than allowed
+
+		Returns:
+			uint, the number of connections closed
+		"""
+
+		# Get the oldest allowed use time
+		fOldest = monotonic() - self._max_idle
+
+		# Find the connections that have been sitting too long and close them
+		lIDs = [
+			k for k,d in self._connections.items() if d['used'] < fOldest
+		]
+		for _id in lIDs:
+			self.discard(_id)
+
+		# Return the count
+		return len(lIDs)
+
+	def send(self,
+		sender: dict,
+		message: Message | bytes,
+		to: str = None
+	) -> dict:
+		"""Send
+
+		Sends a message using the sender's connection. If the server dropped \
+		the connection since it was last used, a new one is opened and the \
+		message is sent again once. If it dropped after DATA was sent, the \
+		server may already have the message, so the error is raised instead \
+		and resending is left to the campaign's retries
+
+		Arguments:
+			sender (dict): The sender record
+			message (email.message.Message | bytes): The message to send, \
+				either as a Message, or already encoded
+			to (str): The recipient, required if the message is encoded
+
+		Raises:
+			smtplib.SMTPException
+
+		Returns:
+			dict, any refused recipients, see smtplib.SMTP.sendmail
+		"""
+
+		# Try at most twice
+		for i in range(2):
+
+			# Get a connection
+			oSMTP = self._get(sender)
+
+			# Try to send the message, allowing longer for the data than any
+			#	other command
+			dTimeouts = self._connections[sender['_id']]['timeouts']
+			fStart = monotonic()
+			oSMTP.data_sent = False
+			try:
+				oSMTP.sock.settimeout(dTimeouts['data'])
+				with metrics.smtp('send'):
+					if isinstance(message, bytes):
+						dRefused = oSMTP.sendmail(
+							sender['email_address'], [ to ], message
+						)
+					else:
+						dRefused = oSMTP.send_message(message)
+				oSMTP.sock.settimeout(dTimeouts['command'])
+				observed(self._observe, sender['_id'], fStart)
+
+			# If the server hung up on us, forget the connection, and if it
+			#	happened before the message was sent, try one more time with a
+			#	fresh one
+			except smtplib.SMTPServerDisconnected as e:
+				self.discard(sender['_id'])
+				if i == 1 or oSMTP.data_sent:
+					observed(self._observe, sender['_id'], fStart, e)
+					raise
+
+			# If the message failed for any other reason, reset the session so
+			#	the next message starts clean
+			except smtplib.SMTPException as e:
+				observed(self._observe, sender['_id'], fStart, e)
+				try:
+					oSMTP.sock.settimeout(dTimeouts['command'])
+					oSMTP.rset()
+					self._connections[sender['_id']]['used'] = monotonic()
+				except Exception:
+					self.discard(sender['_id'])
+				raise
+
+			# If the socket timed out, or failed, we have no idea what state
+			#	the session is in, so throw it away
+			except OSError as e:
+				observed(self._observe, sender['_id'], fStart, e)
+				self.discard(sender['_id'])
+				raise
+
+			# Else, it was sent, mark the connection as used and return
+			else:
+				self._connections[sender['_id']]['used'] = monotonic()
+				return dRefused
+
+class AsyncPool(object):
+	"""Async Pool
+
+	The asyncio version of Pool. Each sender can have several sessions open \
+	at once, up to its concurrency limit, and idle sessions are re-used by \
+	the next message for the same sender
+	"""
+
+	def __init__(self,
+		max_idle: int = 300,
+		noop_after: int = 30,
+		per_sender: int = 1,
+		limits: Dict[str, int] = None,
+		timeouts: Dict[str, float] = None,
+		concurrency: Callable[[str, int], int] = None,
+		observe: Callable[[str, float, Exception | None], None] = None
+	):
+		"""Constructor
+
+		Creates a new instance
+
+		Arguments:
+			max_idle (uint): The number of seconds a connection can sit unused \
+				before it's closed
+			noop_after (uint): The number of seconds a connection can sit \
+				unused before it's checked with a NOOP before being reused
+			per_sender (uint): The default number of messages that can be \
+				sent at once by a single sender
+			limits (dict): Optional, per_sender overrides by sender _id
+			timeouts (dict): Optional, the default connect, command, and data \
+				timeouts, in seconds, for senders that don't set their own
+			concurrency (callable): Optional, called with the sender _id and \
+				its limit before each message, returns how many messages the \
+				sender can send at once right now
+			observe (callable): Optional, called with the sender _id, the \
+				seconds the server took, and the error, if any, after each \
+				message, not counting any wait for a slot
+
+		Returns:
+			AsyncPool
+		"""
+
+		# Store the limits
+		self._max_idle = max_idle
+		self._noop_after = noop_after
+		self._per_sender = per_sender
+		self._limits = limits or {}
+		self._timeouts = timeouts or {}
+		self._concurrency = concurrency
+		self._observe = observe
+
+		# Init the idle connections, the messages being sent, and the
+		#	conditions waited on for a slot, keyed by sender _id
+		self._idle: Dict[str, List[dict]] = {}
+		self._sending: Dict[str, int] = {}
+		self._conditions: Dict[str, asyncio.Condition] = {}
+
+	async def _connect(self, sender: dict) -> dict:
+		"""Connect
+
+		Opens and authenticates a new connection for the sender
+
+		Arguments:
+			sender (dict): The sender record
+
+		Returns:
+			dict
+		"""
+
+		# Get the timeouts
+		dTimeouts = timeouts(sender, self._timeouts)
+
+		# Connect to the SMTP server, upgrading to TLS if necessary, giving up
+		#	if it doesn't answer in time
+		oSMTP = _AsyncSMTP(
+			hostname = sender['host'],
+			port = sender['port'],
+			start_tls = sender['tls'] and True or False,
+			timeout = dTimeouts['command']
+		)
+		with metrics.smtp('connect'):
+			await oSMTP.connect(timeout = dTimeouts['connect'])
+
+		# Login, closing the socket if it fails
+		try:
+			with metrics.smtp('login'):
+				await oSMTP.login(sender['email_address'], sender['password'])
+		except Exception:
+			oSMTP.close()
+			raise
+
+		# Return the connection
+		return {
+			'smtp': oSMTP,
+			'timeouts': dTimeouts,
+			'updated': sender.get('_updated'),
+			'used': monotonic()
+		}
+
+	async def _get(self, sender: dict) -> dict:
+		"""Get
+
+		Returns an idle connection for the sender if there's a healthy one, \
+		else opens a new one
+
+		Arguments:
+			sender (dict): The sender record
+
+		Returns:
+			dict
+		"""
+
+		# Go through the idle connections, newest first
+		lIdle = self._idle.setdefault(sender['_id'], [])
+		while lIdle:
+			dConn = lIdle.pop()
+
+			# If the sender changed, it's been idle too long, or it's been
+			#	disconnected, throw it away
+			fIdle = monotonic() - dConn['used']
+			if dConn['updated'] != sender.get('_updated') or \
+				fIdle > self._max_idle or \
+				not dConn['smtp'].is_connected:
+				await self._quit(dConn['smtp'])
+				continue
+
+			# If it's been a while, make sure the server is still listening
+			if fIdle > self._noop_after:
+				try:
+					oRes = await dConn['smtp'].noop()
+					iCode = oRes.code
+				except aiosmtplib.SMTPException:
+					iCode = None
+				if iCode != 250:
+					await self._quit(dConn['smtp'])
+					continue
+
+			# Return the connection
+			return dConn
+
+		# We have nothing, open a new one
+		return await self._connect(sender)
+
+	@staticmethod
+	async def _quit(smtp: aiosmtplib.SMTP) -> None:
+		"""Quit
+
+		Closes a connection, ignoring any errors from a server that has \
+		already gone away
+
+		Arguments:
+			smtp (aiosmtplib.SMTP): The connection to close
+
+		Returns:
+			None
+		"""
+		try:
+			await smtp.quit()
+		except Exception:
+			smtp.close()
+
+	def _limit(self, sender_id: str) -> int:
+		"""Limit
+
+		Returns how many messages the sender can send at once right now
+
+		Arguments:
+			sender_id (str): The unique ID of the sender
+
+		Returns:
+			uint
+		"""
+		iLimit = self._limits.get(sender_id, self._per_sender)
+		if self._concurrency:
+			iLimit = self._concurrency(sender_id, iLimit)
+		return max(1, iLimit)
+
+	@asynccontextmanager
+	async def _slot(self, sender_id: str):
+		"""Slot
+
+		Waits until the sender is sending fewer messages than it can, and \
+		holds one of its slots until the with block ends
+
+		Arguments:
+			sender_id (str): The unique ID of the sender
+		"""
+
+		# Wait for a slot
+		oCondition = self._conditions.setdefault(
+			sender_id, asyncio.Condition()
+		)
+		async with oCondition:
+			await oCondition.wait_for(
+				lambda: self._sending.get(sender_id, 0) < \
+					self._limit(sender_id)
+			)
+			self._sending[sender_id] = self._sending.get(sender_id, 0) + 1
+
+		# Hold it until we're done, then give it back and let the others
+		#	check again, the limit may have changed. The slot is given back
+		#	before waiting on the lock so it's freed even if we're cancelled
+		#	while waiting
+		try:
+			yield
+		finally:
+			self._sending[sender_id] -= 1
+			async with oCondition:
+				oCondition.notify_all()
+
+	async def close(self) -> None:
+		"""Close
+
+		Closes every idle connection
+
+		Returns:
+			None
+		"""
+		for sID in list(self._idle.keys()):
+			for dConn in self._idle.pop(sID):
+				await self._quit(dConn['smtp'])
+
+	async def prune(self) -> int:
+		"""Prune
+
+		Closes any connections that have been idle longer than allowed
+
+		Returns:
+			uint, the number of connections closed
+		"""
+
+		# Get the oldest allowed use time
+		fOldest = monotonic() - self._max_idle
+
+		# Take the old connections out of each sender's idle ones without
+		#	waiting on anything, so that sends running at the same time can't
+		#	change the lists, or take one of them, while we look
+		lOld = []
+		for sID, lIdle in list(self._idle.items()):
+			lKeep = []
+			for dConn in lIdle:
+				if dConn['used'] < fOldest:
+					lOld.append(dConn)
+				else:
+					lKeep.append(dConn)
+			lIdle[:] = lKeep
+
+		# Now close them, no one else can get at them
+		for dConn in lOld:
+			await self._quit(dConn['smtp'])
+
+		# Return the count
+		return len(lOld)
+
+	async def send(self,
+		sender: dict,
+		message: Message | bytes,
+		to: str = None
+	) -> dict:
+		"""Send
+
+		Sends a message using one of the sender's connections, waiting if \
+		the sender is already sending as many messages as it's allowed. If \
+		the server dropped the connection since it was last used, a new one \
+		is opened and the message is sent again once. If it dropped after \
+		DATA was sent, the server may already have the message, so the error \
+		is raised instead and resending is left to the campaign's retries
+
+		Arguments:
+			sender (dict): The sender record
+			message (email.message.Message | bytes): The message to send, \
+				either as a Message, or already encoded
+			to (str): The recipient, required if the message is encoded
+
+		Raises:
+			aiosmtplib.SMTPException, OSError
+
+		Returns:
+			dict, any refused recipients
+		"""
+
+		# Wait for our turn with the sender
+		async with self._slot(sender['_id']):
+
+			# Try at most twice
+			for i in range(2):
+
+				# Get a connection
+				dConn = await self._get(sender)
+
+				# Try to send the message, allowing longer for the data than
+				#	any other command
+				fStart = monotonic()
+				dConn['smtp'].data_sent = False
+				try:
+					with metrics.smtp('send'):
+						if isinstance(message, bytes):
+							dRefused, _ = await dConn['smtp'].sendmail(
+								sender['email_address'],
+								[ to ],
+								message,
+								timeout = dConn['timeouts']['data']
+							)
+						else:
+							dRefused, _ = await dConn['smtp'].send_message(
+								message,
+								timeout = dConn['timeouts']['data']
+							)
+					observed(self._observe, sender['_id'], fStart)
+
+				# If the server hung up on us, throw the connection away, and
+				#	if it happened before the message was sent, try one more
+				#	time with a fresh one
+				except aiosmtplib.SMTPServerDisconnected as e:
+					dConn['smtp'].close()
+					if i == 1 or dConn['smtp'].data_sent:
+						observed(self._observe, sender['_id'], fStart, e)
+						raise
+
+				# If the server stopped answering, we have no idea what state
+				#	the session is in, so throw it away
+				except aiosmtplib.SMTPTimeoutError as e:
+					observed(self._observe, sender['_id'], fStart, e)
+					dConn['smtp'].close()
+					raise
+
+				# If the message failed for any other reason, reset the session
+				#	so the next message starts clean
+				except aiosmtplib.SMTPException as e:
+					observed(self._observe, sender['_id'], fStart, e)
+					try:
+						await dConn['smtp'].rset()
+						dConn['used'] = monotonic()
+						self._idle[sender['_id']].append(dConn)
+					except Exception:
+						dConn['smtp'].close()
+					raise
+
+				# If the socket failed, or we were cancelled part way through,
+				#	we have no idea what state the session is in, so close it
+				#	instead of leaving it open and forgotten
+				except BaseException as e:
+					if isinstance(e, Exception):
+						observed(self._observe, sender['_id'], fStart, e)
+					dConn['smtp'].close()
+					raise
+
+				# Else, it was sent, put the connection back and return
+				else:
+					dConn['used'] = monotonic()
+					self._idle[sender['_id']].append(dConn)
+					return dRefused
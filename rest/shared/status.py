@@ -0,0 +1,280 @@
+# coding=utf8
+""" Status
+
+Handles buffering the sent / delivered status of campaign contacts so they \
+can be written to the DB a few statements at a time instead of one per email
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-14"
+
+# Python imports
+import fcntl
+from glob import glob
+import os
+from time import monotonic
+from typing import Dict, IO, List, Tuple
+
+# Record imports
+from records.admin import campaign_contact
+
+class Writer(object):
+	"""Writer
+
+	Buffers outcomes in memory and flushes them as one UPDATE per status \
+	once enough have been collected, or the oldest has waited long enough. \
+	Every outcome is also appended to a journal file before it's buffered, \
+	so that outcomes not yet flushed when the process stops can be written \
+	by open() on the next start, before anything is sent again. Each process \
+	needs its own journal, it's locked for as long as the process runs so \
+	that no one else can take it over. The journal is flushed to the OS but \
+	never synced to disk, so it survives the process crashing, not the host
+	"""
+
+	def __init__(self, size: int = 100, age: float = 5.0):
+		"""Constructor
+
+		Creates a new instance. Outcomes are only kept in memory until open() \
+		is called with the path of a journal
+
+		Arguments:
+			size (uint): The number of outcomes that triggers a flush
+			age (float): The seconds the oldest outcome can wait before it \
+				triggers a flush
+
+		Returns:
+			Writer
+		"""
+
+		# Store the limits
+		self._size = size
+		self._age = age
+
+		# Init the buffer and when the first outcome was added to it
+		self._buffer: List[Tuple[str, bool, int | None]] = []
+		self._since: float | None = None
+
+		# Init the journal
+		self._journal = None
+
+	def __len__(self) -> int:
+		"""Length (__len__)
+
+		Returns the number of outcomes waiting to be flushed
+
+		Returns:
+			uint
+		"""
+		return len(self._buffer)
+
+	def add(self, _id: str, delivered: bool, code: int = None) -> None:
+		"""Add
+
+		Adds the outcome of a single message, flushing if the buffer is full \
+		or old enough
+
+		Arguments:
+			_id (str): The campaign contact ID
+			delivered (bool): True if the SMTP server accepted the message
+			code (uint): Optional, the SMTP code the message failed with
+
+		Returns:
+			None
+		"""
+
+		# Write it to the journal first
+		if self._journal:
+			self._journal.write('%s\t%d\t%s\n' % (
+				_id, delivered and 1 or 0, code is not None and code or ''
+			))
+			self._journal.flush()
+
+		# Add it to the buffer
+		if not self._buffer:
+			self._since = monotonic()
+		self._buffer.append((_id, delivered, code))
+
+		# If it's time, flush
+		if self.due():
+			self.flush()
+
+	def close(self) -> None:
+		"""Close
+
+		Flushes anything left and closes the journal
+
+		Returns:
+			None
+		"""
+		self.flush()
+		if self._journal:
+			self._journal.close()
+			self._journal = None
+
+	def due(self) -> bool:
+		"""Due
+
+		Returns True if the buffer is full or its oldest outcome has waited \
+		long enough
+
+		Returns:
+			bool
+		"""
+		return len(self._buffer) >= self._size or (
+			self._since is not None and \
+			monotonic() - self._since >= self._age
+		)
+
+	def flush(self) -> int:
+		"""Flush
+
+		Writes everything in the buffer to the DB, one statement per status \
+		and failure code, then empties the journal
+
+		Returns:
+			uint, the number of outcomes written
+		"""
+
+		# If there's nothing, do nothing
+		if not self._buffer:
+			return 0
+
+		# Split the IDs by status, and the failures by code
+		lDelivered = []
+		dSent: Dict[int | None, List[str]] = {}
+		for sID, bDelivered, iCode in self._buffer:
+			if bDelivered:
+				lDelivered.append(sID)
+			else:
+				dSent.setdefault(iCode, []).append(sID)
+
+		# Write them
+		if lDelivered:
+			campaign_contact.sent_and_delivered(lDelivered)
+		for iCode, lSent in dSent.items():
+			campaign_contact.sent(lSent, iCode)
+
+		# Clear the buffer and the journal
+		iCount = len(self._buffer)
+		self._buffer = []
+		self._since = None
+		if self._journal:
+			self._journal.truncate(0)
+			self._journal.flush()
+
+		# Return the count
+		return iCount
+
+	@staticmethod
+	def _lock(journal: str, wait: bool) -> IO | None:
+		"""Lock
+
+		Opens a journal and locks it. If the file is removed by whoever held \
+		the lock before us, it's opened again so we never hold a file no one \
+		else can see
+
+		Arguments:
+			journal (str): The path of the journal file
+			wait (bool): True to wait for the lock, False to give up if \
+				someone else holds it
+
+		Returns:
+			The open file, or None if someone else holds it
+		"""
+		while True:
+
+			# Open the file, creating it if it's missing, and lock it
+			oFile = open(journal, 'a+', encoding = 'utf-8')
+			try:
+				fcntl.flock(
+					oFile, fcntl.LOCK_EX | (not wait and fcntl.LOCK_NB or 0)
+				)
+			except BlockingIOError:
+				oFile.close()
+				return None
+
+			# If it's still the file at the path, it's ours
+			try:
+				if os.fstat(oFile.fileno()).st_ino == os.stat(journal).st_ino:
+					return oFile
+			except FileNotFoundError:
+				pass
+
+			# Else, try again, or give up if we don't wait
+			oFile.close()
+			if not wait:
+				return None
+
+	def _read(self, file: IO) -> None:
+		"""Read
+
+		Adds every outcome in a journal to the buffer. An outcome that was \
+		being written when the process stopped may be cut off, if so, it's \
+		ignored. Journals written before failure codes were recorded only \
+		have two fields
+
+		Arguments:
+			file (IO): The open journal
+
+		Returns:
+			None
+		"""
+		file.seek(0)
+		for sLine in file:
+			lFields = sLine.rstrip('\n').split('\t')
+			if len(lFields) == 2:
+				lFields.append('')
+			if len(lFields) != 3 or lFields[1] not in ('0', '1'):
+				continue
+			if lFields[2] and not lFields[2].isdigit():
+				continue
+			self._buffer.append((
+				lFields[0],
+				lFields[1] == '1',
+				lFields[2] and int(lFields[2]) or None
+			))
+
+	def open(self, journal: str, others: str = None) -> int:
+		"""Open
+
+		Locks the journal and writes any outcomes left in it by a previous \
+		run that stopped before it could flush them, then keeps it open to \
+		record new outcomes. Any other journal matching `others` that isn't \
+		locked, because the process that wrote it is gone, is written as \
+		well, then removed. Must be called before any contacts are claimed
+
+		Arguments:
+			journal (str): The path of this process's journal file
+			others (str): Optional, a glob matching the journals of every \
+				process on the host
+
+		Returns:
+			uint, the number of outcomes recovered
+		"""
+
+		# Lock our journal, waiting if someone is recovering it, and read it
+		self._journal = self._lock(journal, True)
+		self._read(self._journal)
+
+		# Take over, and read, any other journals no one holds
+		lOrphans = []
+		for sPath in others and sorted(glob(others)) or []:
+			if os.path.abspath(sPath) == os.path.abspath(journal):
+				continue
+			oFile = self._lock(sPath, False)
+			if oFile:
+				self._read(oFile)
+				lOrphans.append(( sPath, oFile ))
+
+		# Flush everything recovered
+		iCount = self.flush()
+
+		# Remove the journals we took over, then let them go
+		for sPath, oFile in lOrphans:
+			os.unlink(sPath)
+			oFile.close()
+
+		# Return the count
+		return iCount
@@ -0,0 +1,356 @@
+# coding=utf8
+""" Templates
+
+Handles compiling campaign subjects and contents once so that each message \
+only costs a single join
+"""
+
+__author__		= "Chris Nasr"
+__copyright__	= "Ouroboros Coding Inc."
+__email__		= "chris@ouroboroscoding.com"
+__created__		= "2024-02-13"
+
+# Python imports
+from email import quoprimime
+from email.header import Header
+import re
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+from uuid import uuid4
+
+# Shared imports
+from shared import metrics
+
+PLACEHOLDERS = (
+	'_id', 'name', 'alias', 'company', 'email_address', 'unsubscribe_url'
+)
+"""The placeholders that can be used in a campaign's subject and content"""
+
+TOKEN = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}')
+"""Matches anything that looks like a placeholder, CSS blocks and other \
+braces with spaces or punctuation in them are left alone"""
+
+class Template(object):
+	"""Template
+
+	A string split into literal segments and placeholder slots
+	"""
+
+	def __init__(self, text: str):
+		"""Constructor
+
+		Compiles the text
+
+		Arguments:
+			text (str): The text to compile
+
+		Returns:
+			Template
+		"""
+
+		# Init the parts, the even indexes are literals and the odd indexes
+		#	are placeholder names
+		self._parts: List[str] = []
+
+		# Go through each token found
+		iLast = 0
+		for oMatch in TOKEN.finditer(text):
+
+			# If it's not a placeholder we know, leave it in the literal
+			if oMatch.group(1) not in PLACEHOLDERS:
+				continue
+
+			# Add the literal before it, and the slot
+			self._parts.append(text[iLast:oMatch.start()])
+			self._parts.append(oMatch.group(1))
+			iLast = oMatch.end()
+
+		# Add whatever is left
+		self._parts.append(text[iLast:])
+
+		# Store the indexes of the slots
+		self._slots = range(1, len(self._parts), 2)
+
+	def render(self, values: Dict[str, str]) -> str:
+		"""Render
+
+		Returns the text with each placeholder replaced by its value
+
+		Arguments:
+			values (dict): The values by placeholder name
+
+		Returns:
+			str
+		"""
+
+		# Copy the parts, fill in the slots, and join it all together
+		fStart = perf_counter()
+		lParts = self._parts[:]
+		for i in self._slots:
+			lParts[i] = values[lParts[i]]
+		sRet = ''.join(lParts)
+		metrics.RENDER_SECONDS.observe(perf_counter() - fStart)
+		return sRet
+
+	def map(self, fn: Callable[[str], str]) -> 'Template':
+		"""Map
+
+		Returns a new template with the same placeholders, and each literal \
+		segment passed through fn
+
+		Arguments:
+			fn (callable): Called with each literal, returns its replacement
+
+		Returns:
+			Template
+		"""
+		oRet = Template.__new__(Template)
+		oRet._parts = [
+			i % 2 and s or fn(s) for i, s in enumerate(self._parts)
+		]
+		oRet._slots = self._slots
+		return oRet
+
+class Skeleton(object):
+	"""Skeleton
+
+	A campaign's whole message with the boundaries, the MIME headers, and \
+	the quoted-printable body encoded once. Each piece of the body is \
+	encoded to start at the beginning of a line and end with a soft line \
+	break, so the encoded values of a contact can be spliced in between \
+	them as is, and the result is the bytes handed to sendmail
+	"""
+
+	def __init__(self, subject: Template, content: Template):
+		"""Constructor
+
+		Encodes the content and the parts of the message that never change
+
+		Arguments:
+			subject (Template): The compiled subject
+			content (Template): The compiled content, HTML
+
+		Returns:
+			Skeleton
+		"""
+
+		# Store the subject, and encode the literals of the content
+		self._subject = subject
+		self._body = content.map(qp)
+
+		# Generate a boundary. Quoted-printable always encodes '=' so it can
+		#	never show up in the body
+		sBoundary = '=_%s' % uuid4().hex
+
+		# Generate everything around the headers of each message
+		self._head = 'Content-Type: multipart/mixed; boundary="%s"\r\n' \
+						'MIME-Version: 1.0\r\n' % sBoundary
+		self._part = '\r\n--%s\r\n' \
+						'Content-Type: text/html; charset="utf-8"\r\n' \
+						'MIME-Version: 1.0\r\n' \
+						'Content-Transfer-Encoding: quoted-printable\r\n' \
+						'\r\n' % sBoundary
+		self._end = '\r\n--%s--\r\n' % sBoundary
+
+	def render(self, values: Dict[str, str], headers: Dict[str, str]) -> bytes:
+		"""Render
+
+		Returns the message for a single contact
+
+		Arguments:
+			values (dict): The values by placeholder name
+			headers (dict): The headers that change with each message, e.g. \
+				From and To, the subject is added from the values
+
+		Returns:
+			bytes
+		"""
+
+		# Generate the headers
+		lParts = [ self._head ]
+		for sName, sValue in headers.items():
+			lParts.append(header(sName, sValue))
+		lParts.append(header('Subject', self._subject.render(values)))
+
+		# Add the body, with the values encoded the same way as the literals
+		lParts.append(self._part)
+		lParts.append(self._body.render({
+			k: qp(v or '') for k, v in values.items()
+		}))
+		lParts.append(self._end)
+
+		# Join it all and return it, everything is already 7-bit
+		return ''.join(lParts).encode('ascii')
+
+class Cache(object):
+	"""Cache
+
+	Keeps the compiled subject, content, and skeleton of each campaign, \
+	re-compiling only when the campaign's `_updated` changes. The daemon's \
+	own writes to the campaign, its triggers, pauses, and audience progress, \
+	leave `_updated` alone, so it only changes when the campaign is edited
+	"""
+
+	def __init__(self):
+		"""Constructor
+
+		Creates a new instance
+
+		Returns:
+			Cache
+		"""
+		self._campaigns: Dict[
+			str, Tuple[int, Template, Template, Skeleton]
+		] = {}
+
+	def current(self, campaign_id: str, updated: int) -> bool:
+		"""Current
+
+		Returns True if we have the given version of the campaign compiled. \
+		The version is the campaign's `_updated`, which only changes when the \
+		campaign is edited, never when it's sent or rescheduled
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+			updated (uint): The `_updated` value of the campaign
+
+		Returns:
+			bool
+		"""
+		try:
+			return self._campaigns[campaign_id][0] == updated
+		except KeyError:
+			return False
+
+	def skeleton(self, campaign_id: str) -> Skeleton:
+		"""Skeleton
+
+		Returns the pre-encoded message of the campaign
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+
+		Raises:
+			KeyError
+
+		Returns:
+			Skeleton
+		"""
+		return self._campaigns[campaign_id][3]
+
+	def get(self, campaign_id: str) -> Tuple[Template, Template]:
+		"""Get
+
+		Returns the compiled subject and content of the campaign
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+
+		Raises:
+			KeyError
+
+		Returns:
+			Template, Template
+		"""
+		tCached = self._campaigns[campaign_id]
+		return tCached[1], tCached[2]
+
+	def remove(self, campaign_id: str) -> None:
+		"""Remove
+
+		Forgets a campaign
+
+		Arguments:
+			campaign_id (str): The ID of the campaign
+
+		Returns:
+			None
+		"""
+		self._campaigns.pop(campaign_id, None)
+
+	def set(self, campaign: dict) -> None:
+		"""Set
+
+		Compiles and stores the subject and content of the campaign, and \
+		the pre-encoded message made from them
+
+		Arguments:
+			campaign (dict): The campaign record, must include `_id`, \
+				`_updated`, `subject`, and `content`
+
+		Returns:
+			None
+		"""
+		oSubject = Template(campaign['subject'])
+		oContent = Template(campaign['content'])
+		self._campaigns[campaign['_id']] = (
+			campaign['_updated'],
+			oSubject,
+			oContent,
+			Skeleton(oSubject, oContent)
+		)
+
+def header(name: str, value: str) -> str:
+	"""Header
+
+	Returns a single header line, encoded and folded if necessary. Line \
+	breaks in the value are replaced so it can never add headers of its own
+
+	Arguments:
+		name (str): The name of the header
+		value (str): The value of the header
+
+	Returns:
+		str
+	"""
+	value = ' '.join(value.splitlines())
+	return '%s: %s\r\n' % (name, Header(
+		value,
+		value.isascii() and 'us-ascii' or 'utf-8',
+		header_name = name
+	).encode(linesep = '\r\n'))
+
+def qp(text: str) -> str:
+	"""QP
+
+	Returns the text encoded as UTF-8 quoted-printable, ending with a soft \
+	line break unless it ends with a real one, so that whatever is added \
+	after it starts on a new line, and no line is ever too long
+
+	Arguments:
+		text (str): The text to encode
+
+	Returns:
+		str
+	"""
+
+	# If there's nothing, there's nothing to encode
+	if not text:
+		return ''
+
+	# Encode the bytes, leaving room at the end of the last line for the soft
+	#	break
+	sRet = quoprimime.body_encode(
+		text.encode('utf-8').decode('latin-1'), 75, '\r\n'
+	)
+
+	# Make sure the next piece starts on its own line
+	if not sRet.endswith('\r\n'):
+		sRet += '=\r\n'
+	return sRet
+
+def unknown(text: str) -> List[str]:
+	"""Unknown
+
+	Returns any tokens in the text that look like placeholders but aren't \
+	one of the known ones
+
+	Arguments:
+		text (str): The text to check
+
+	Returns:
+		str[]
+	"""
+	return [
+		'{%s}' % s for s in TOKEN.findall(text) if s not in PLACEHOLDERS
+	]
@@ -17,6 +17,7 @@ import React, { useEffect, useState } from 'react';
 
 // Material UI
 import Box from '@mui/material/Box';
+import Button from '@mui/material/Button';
 import IconButton from '@mui/material/IconButton';
 import Paper from '@mui/material/Paper';
 import Select from '@mui/material/Select';
@@ -62,6 +63,10 @@ const ContactTree = new Tree(ContactDef, {
 });
 
 // Constants
+const FIELDS = [
+	'_id', '_created', '_updated', 'email_address', 'name', 'alias',
+	'company', 'categories'
+];
 const GRID_SIZES = {
 	__default__: { xs: 12 },
 	_project: { xs: 12 },
@@ -85,7 +90,9 @@ const GRID_SIZES = {
 export default function Contacts(props) {
 
 	// State
+	const [ count, countSet ] = useState(0);
 	const [ create, createSet ] = useState(false);
+	const [ next, nextSet ] = useState(null);
 	const [ project, projectSet ] = useState('');
 	const [ projects, projectsSet ] = useState([]);
 	const [ results, resultsSet ] = useState(false);
@@ -103,19 +110,39 @@ export default function Contacts(props) {
 		if(project === '') {
 			createSet(false);
 			resultsSet(false);
+			nextSet(null);
+			countSet(0);
 			CategoryOptions.set([]);
 		} else {
 
 			body.read('admin', '__list', [
-				[ 'contacts', { '_project': project } ],
+				[ 'contacts', { '_project': project, fields: FIELDS } ],
 				[ 'categories', { '_project': project } ]
 			]).then(data => {
-				resultsSet(data[0][1].data);
+				pageSet(data[0][1].data, false);
 				CategoryOptions.set(data[1][1].data.map(o => [ o._id, o.name ]))
 			}, Message.error);
 		}
 	}, [ project ]);
 
+	// Called to fetch the first page of contacts, or the one after the last
+	//	one fetched
+	function contactsFetch(more) {
+		body.read('admin', 'contacts', {
+			'_project': project,
+			after: more ? next : null,
+			fields: FIELDS
+		}).then(data => pageSet(data, more), Message.error);
+	}
+
+	// Called to store a page of contacts, added to the ones already shown, or
+	//	replacing them
+	function pageSet(data, more) {
+		resultsSet(l => more ? l.concat(data.contacts) : data.contacts);
+		countSet(data.count);
+		nextSet(data.next);
+	}
+
 	// Called when the create form is submitted
 	function createSubmit(record) {
 
@@ -135,11 +162,7 @@ export default function Contacts(props) {
 				Message.success('Contact created. Refreshing contact list.');
 
 				// Fetch the latest results
-				body.read('admin', 'contacts', {
-					'_project': project
-				}).then(resultsSet, error => {
-					Message.error(error);
-				});
+				contactsFetch(false);
 
 				// Resolve ok
 				resolve(true);
@@ -166,6 +189,7 @@ export default function Contacts(props) {
 
 				// Find the record and remove it
 				resultsSet(l => arrayFindDelete(l, '_id', key, true));
+				countSet(i => i - 1);
 			}
 		}, Message.error);
 	}
@@ -186,11 +210,7 @@ export default function Contacts(props) {
 				Message.success('Contact updated. Refreshing contact list.');
 
 				// Fetch the latest results
-				body.read('admin', 'contacts', {
-					'_project': project
-				}).then(resultsSet, error => {
-					Message.error(error);
-				});
+				contactsFetch(false);
 
 				// Resolve ok
 				resolve(true);
@@ -244,14 +264,28 @@ export default function Contacts(props) {
 			) || (results.length === 0 &&
 				<Typography>No Contacts found.</Typography>
 			) ||
-				<Results
-					data={results}
-					gridSizes={GRID_SIZES}
-					onDelete={resultRemove}
-					onUpdate={updateSubmit}
-					orderBy="name"
-					tree={ContactTree}
-				/>
+				<React.Fragment>
+					<Results
+						data={results}
+						gridSizes={GRID_SIZES}
+						onDelete={resultRemove}
+						onUpdate={updateSubmit}
+						orderBy="name"
+						tree={ContactTree}
+					/>
+					<Box className="flexColumns">
+						<Typography className="flexDynamic">
+							Showing {results.length} of {count}
+						</Typography>
+						{next !== null &&
+							<Button
+								className="flexStatic"
+								onClick={() => contactsFetch(true)}
+								variant="contained"
+							>Load More</Button>
+						}
+					</Box>
+				</React.Fragment>
 			}
 		</Box>
 	);
@@ -33,8 +33,14 @@ import SenderDef from 'definitions/admin/sender';
 // Generate the Tree
 const SenderTree = new Tree(SenderDef, {
 	__ui__: {
-		__create__: [ 'email_address', 'password', 'host', 'port', 'tls' ],
-		__update__: [ 'email_address', 'password', 'host', 'port', 'tls' ],
+		__create__: [
+			'email_address', 'password', 'host', 'port', 'tls', 'rate', 'burst',
+			'timeout_connect', 'timeout_command', 'timeout_data'
+		],
+		__update__: [
+			'email_address', 'password', 'host', 'port', 'tls', 'rate', 'burst',
+			'timeout_connect', 'timeout_command', 'timeout_data'
+		],
 		__results__: [
 			'_created', '_updated', 'email_address', 'host', 'port', 'tls'
 		]
@@ -43,7 +49,12 @@ const SenderTree = new Tree(SenderDef, {
 	_updated: { __ui__: { __title__: 'Last Updated' } },
 	email_address: { __ui__: { __title__: 'E-Mail Address' } },
 	password: { __ui__: { __type__: 'password' } },
-	tls: { __ui__: { __title__: 'Enable TLS' } }
+	tls: { __ui__: { __title__: 'Enable TLS' } },
+	rate: { __ui__: { __title__: 'Messages per Hour' } },
+	burst: { __ui__: { __title__: 'Burst' } },
+	timeout_connect: { __ui__: { __title__: 'Connect Timeout (seconds)' } },
+	timeout_command: { __ui__: { __title__: 'Command Timeout (seconds)' } },
+	timeout_data: { __ui__: { __title__: 'Data Timeout (seconds)' } }
 });
 
 // Constants
@@ -53,7 +64,12 @@ const GRID_SIZES = {
 	password: { xs: 12, md: 6 },
 	host: { xs: 12, md: 6 },
 	port: { xs: 6, md: 4 },
-	tls: { xs: 6, md: 2 }
+	tls: { xs: 6, md: 2 },
+	rate: { xs: 6, md: 3 },
+	burst: { xs: 6, md: 3 },
+	timeout_connect: { xs: 4 },
+	timeout_command: { xs: 4 },
+	timeout_data: { xs: 4 }
 };
 
 /**